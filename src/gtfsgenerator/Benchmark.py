@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import contextlib
+import copy
+import io
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+from termcolor import colored
+from veryprettytable import VeryPrettyTable
+
+from gtfsgenerator.GTFS import GtfsWrite
+from gtfsgenerator.SheetSource import MemorySheetClient
+from gtfsgenerator.SheetSource import MemoryWorkbook
+from gtfsgenerator.SheetSource import MemoryWorksheet
+from gtfsgenerator.SheetSource import memory_clients
+
+
+# Synthetic agency sizes: workbooks, worksheets per workbook, stops per route, trips per worksheet, shape points.
+scales = {
+    'small':  {'workbooks': 1, 'worksheets': 2,  'stops': 10, 'trips': 8,  'points': 200},
+    'medium': {'workbooks': 2, 'worksheets': 5,  'stops': 25, 'trips': 24, 'points': 1000},
+    'large':  {'workbooks': 4, 'worksheets': 10, 'stops': 40, 'trips': 60, 'points': 5000},
+}
+
+# Trace stages reported per scale, with the functions they time.
+stages = {
+    'stop_times': 'write_stop_times_file',
+    'shapes': 'write_shape_from_kml, write_coords_to_file',
+    'zip': 'create_gtfs_zip',
+    'merge': 'merge_files',
+}
+
+# Merge timings of every scale: merge_files over the worksheet files of the last run, serial and sharded.
+merge_stages = {
+    'merge_serial': 'merge_files, 1 worker',
+    'merge_parallel': 'merge_files, sharded on --merge_workers',
+}
+
+# Sheet layout the synthetic worksheets are written in, as in the agency configurations.
+layout = {'head_data_rows': '2, 3, 6', 'row_idx': '7',
+          'stop_data_columns': '2, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25'}
+
+
+def parse_scale(name):
+    '''
+    A scale by name, or given as workbooks:worksheets:stops:trips:points, ie., 2:5:25:24:1000.
+    :return: dictionary of scale parameters
+    '''
+    if name in scales:
+        return dict(scales[name])
+    values = name.split(':')
+    if len(values) != 5 or not all(value.isdigit() and int(value) > 0 for value in values):
+        raise ValueError('Unknown benchmark scale {}: use {} or N:M:K:T:P.'.format(name, ', '.join(sorted(scales))))
+    return dict(zip(['workbooks', 'worksheets', 'stops', 'trips', 'points'], [int(value) for value in values]))
+
+
+def synthetic_rows(route_id, shape_id, stops, trips):
+    '''
+    Rows of a synthetic route worksheet: headings in row 2, route, trip and calendar data in row 3, trip start
+        times in row 6 and one stop per row from row 7, departures every 15 minutes from 5:00, two minutes
+        between stops, timed at every other stop.
+    :param route_id: route_id and service label of the worksheet
+    :param shape_id: shape_id of the route's KML file
+    :param stops: stops on the route
+    :param trips: trips of the worksheet
+    :return: list of row values, row 1 first
+    '''
+    width = max(27 + trips, 40)
+    rows = [[''] * width for row in range(6 + stops)]
+    data = rows[2]
+    data[10:18] = [route_id, route_id, 'Route {}'.format(route_id), '', '3', '', '', '']
+    data[18:28] = [route_id, 'wkdy', route_id, 'Downtown', '', '0', '', shape_id, '', '']
+    data[28:36] = ['wkdy', '1', '1', '1', '1', '1', '0', '0']
+    for trip in range(trips):
+        start = 300 + trip * 15
+        rows[5][27 + trip] = '{}{:02d}'.format(start // 60, start % 60)
+    for stop in range(stops):
+        row = rows[6 + stop]
+        row[2] = '{}'.format(stop + 1)
+        row[3] = 'S{}'.format(stop + 1)
+        row[10:22] = ['', 'Stop {}'.format(stop + 1), '', '{:.6f}'.format(38.0 + stop * 0.001),
+                      '{:.6f}'.format(-81.0 - stop * 0.001), '', '', '0', '', '', '0', '']
+        row[22:26] = ['', '0', '0', '']
+        if stop % 2 == 0:
+            for trip in range(trips):
+                departure = 300 + trip * 15 + stop * 2
+                row[27 + trip] = '{}:{:02d}:00'.format(departure // 60, departure % 60)
+    return rows
+
+
+def write_synthetic_kml(kml_file, shape_id, points):
+    '''
+    A KML file with one LineString of points coordinates.
+    '''
+    coordinates = ' '.join('{:.6f},{:.6f},0'.format(-81.0 - point * 0.0001, 38.0 + point * 0.0001)
+                           for point in range(points))
+    with open(kml_file, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2"><Document>'
+                '<name>{}</name><Placemark><LineString><coordinates>{}</coordinates></LineString></Placemark>'
+                '</Document></kml>\n'.format(shape_id, coordinates))
+
+
+def synthetic_agency(name, scale, kml_files_root):
+    '''
+    Generate a synthetic agency offline: its worksheets in a MemorySheetClient registered as name, and one KML
+        shape per route in kml_files_root.
+    :param name: name of the client in memory_clients
+    :param scale: dictionary of scale parameters
+    :param kml_files_root: directory of the KML files
+    :return: comma separated workbook names
+    '''
+    if not os.path.exists(kml_files_root):
+        os.makedirs(kml_files_root)
+    workbooks = {}
+    for workbook in range(scale['workbooks']):
+        workbook_title = 'WB{}'.format(workbook + 1)
+        sheets = []
+        for worksheet in range(scale['worksheets']):
+            route_id = '{}'.format((workbook + 1) * 100 + worksheet + 1)
+            shape_id = 'shape{}'.format(route_id)
+            write_synthetic_kml(os.path.join(kml_files_root, '{}.kml'.format(shape_id)), shape_id, scale['points'])
+            sheets.append(MemoryWorksheet(route_id, synthetic_rows(route_id, shape_id, scale['stops'], scale['trips']),
+                                          '2000-01-01T00:00:00.000000Z'))
+        workbooks[workbook_title] = MemoryWorkbook(workbook_title, sheets)
+    memory_clients[name] = MemorySheetClient(workbooks)
+    return ','.join(sorted(workbooks))
+
+
+def benchmark_configs(configs, scale_name, root):
+    '''
+    The configuration of a benchmark run: the run's options on a synthetic agency under root, rebuilt every time.
+    '''
+    bench = copy.copy(configs)
+    bench.source_type = 'memory'
+    bench.sheet_source_root = 'benchmark-{}'.format(scale_name)
+    bench.kml_files_root = os.path.join(root, 'kml')
+    bench.gtfs_path_root = os.path.join(root, 'gtfs')
+    bench.report_path = os.path.join(root, 'reports')
+    bench.agency_id = 'benchmark'
+    bench.ignore_sheets = ''
+    bench.rebuild = True
+    bench.resume = False
+    bench.metrics_dir = None
+    for key, value in layout.items():
+        setattr(bench, key, value)
+    return bench
+
+
+def stage_seconds(trace_file):
+    '''
+    Seconds per stage and of the run in the trace of a generate run.
+    :return: dictionary of stage name to seconds, 'generate' for the run
+    '''
+    seconds = {}
+    with open(trace_file, 'r') as f:
+        for line in f:
+            record = json.loads(line)
+            if record['kind'] == 'run':
+                seconds['generate'] = record['ms'] / 1000.0
+            elif record['kind'] == 'stage' and record['name'] in stages:
+                seconds[record['name']] = seconds.get(record['name'], 0.0) + record['ms'] / 1000.0
+    return seconds
+
+
+def merge_workers(configs):
+    '''
+    Workers of the sharded merge timed against the serial one: --merge_workers, or 4 if it is 1.
+    '''
+    workers = int(configs.merge_workers) if configs.merge_workers else 1
+    return workers if workers > 1 else 4
+
+
+def time_merge(bench, workers, repeat):
+    '''
+    Time merge_files over the worksheet files of a benchmark run.
+    :param bench: Configuration object of the benchmark run
+    :param workers: merge workers, 1 for the serial merge
+    :param repeat: number of runs; the fastest is reported
+    :return: seconds
+    '''
+    merge_configs = copy.copy(bench)
+    merge_configs.merge_workers = workers
+    workbooks = memory_clients[bench.sheet_source_root].workbooks
+    wrkbk_dict = dict((title, [sheet.title for sheet in workbook.sheets]) for title, workbook in workbooks.items())
+    best = None
+    for run in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            seconds = time.perf_counter()
+            GtfsWrite().merge_files(wrkbk_dict, merge_configs)
+            seconds = time.perf_counter() - seconds
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def run_scale(configs, generate, scale_name, repeat):
+    '''
+    Generate the synthetic agency of a scale repeat times.
+    :param configs: Configuration object of the run, for its options, ie., --jobs, --pipeline or --assemble.
+    :param generate: the generate function
+    :param scale_name: scale name or N:M:K:T:P
+    :param repeat: number of runs; the fastest is reported
+    :return: dictionary of the scale's parameters, the seconds of every run, the best seconds per stage and the
+        merge workers of merge_parallel. With worksheet files, the merge of the last run's files is also timed
+        serial, merge_serial, and sharded, merge_parallel.
+    '''
+    scale = parse_scale(scale_name)
+    root = tempfile.mkdtemp(prefix='gtfsgenerator_benchmark_')
+    try:
+        bench = benchmark_configs(configs, scale_name, root)
+        bench.google_workbook_names = synthetic_agency(bench.sheet_source_root, scale, bench.kml_files_root)
+        runs = []
+        for run in range(repeat):
+            output = io.StringIO()
+            # The runs' output is shown with --verbose, or when a run fails.
+            with contextlib.redirect_stdout(output) if not configs.verbose else contextlib.nullcontext():
+                wall = time.perf_counter()
+                result = generate(copy.copy(bench))
+                wall = time.perf_counter() - wall
+            if result != 0:
+                raise RuntimeError('Benchmark {} run {} failed:\n{}'.format(scale_name, run + 1,
+                                                                            output.getvalue()[-2000:]))
+            seconds = stage_seconds(os.path.join(bench.report_path, 'trace.jsonl'))
+            seconds['wall'] = wall
+            runs.append(seconds)
+        merge = {}
+        if not bench.assemble or bench.worksheet_files:
+            merge['merge_serial'] = time_merge(bench, 1, repeat)
+            merge['merge_parallel'] = time_merge(bench, merge_workers(configs), repeat)
+    finally:
+        memory_clients.pop('benchmark-{}'.format(scale_name), None)
+        shutil.rmtree(root, ignore_errors=True)
+    names = sorted(set(name for seconds in runs for name in seconds))
+    best = dict((name, round(min(seconds.get(name, 0.0) for seconds in runs), 6)) for name in names)
+    best.update((name, round(seconds, 6)) for name, seconds in merge.items())
+    return {'scale': scale, 'runs': runs, 'best': best, 'merge_workers': merge_workers(configs) if merge else None}
+
+
+def compare(results, baseline, threshold, minimum=0.05):
+    '''
+    Regressions of results against a baseline: a stage of a scale that is more than threshold slower than in the
+        baseline, and at least minimum seconds slower, so the noise of stages taking milliseconds is ignored.
+    :return: list of (scale, stage, baseline seconds, seconds)
+    '''
+    regressions = []
+    for scale_name, result in sorted(results['scales'].items()):
+        base = baseline.get('scales', {}).get(scale_name)
+        if base is None:
+            continue
+        if base['scale'] != result['scale']:
+            print(colored('Benchmark scale {} differs from the baseline, not compared.'.format(scale_name), 'yellow'))
+            continue
+        for name, seconds in sorted(result['best'].items()):
+            before = base['best'].get(name)
+            if before is not None and seconds > before * (1.0 + threshold) and seconds - before >= minimum:
+                regressions.append((scale_name, name, before, seconds))
+    return regressions
+
+
+def run_benchmark(configs, generate):
+    '''
+    Benchmark generate on synthetic agencies at the --benchmark_scales, with the options of the run, ie., --jobs.
+        Results are written to <report_path>/benchmark.json. With --benchmark_baseline, they are compared to the
+        stored baseline, or stored as the baseline if there is none yet.
+    :param configs: Configuration object
+    :param generate: the generate function
+    :return: 0, or 1 if a stage regressed beyond --benchmark_threshold
+    '''
+    options = dict((key, getattr(configs, key, None)) for key in
+                   ('jobs', 'pipeline', 'assemble', 'store', 'incremental', 'merge_workers', 'zip_level'))
+    results = {'python': platform.python_version(), 'host': platform.node(), 'started': round(time.time(), 3),
+               'options': options, 'repeat': configs.benchmark_repeat, 'scales': {}}
+    for scale_name in [name.strip() for name in configs.benchmark_scales.split(',') if name.strip()]:
+        print(colored('Benchmark {} {}'.format(scale_name, parse_scale(scale_name)), 'magenta'))
+        results['scales'][scale_name] = run_scale(configs, generate, scale_name, configs.benchmark_repeat)
+
+    table = VeryPrettyTable(['Scale', 'Stage', 'Functions', 'Best s'])
+    table.align['Stage'] = 'l'
+    table.align['Functions'] = 'l'
+    for scale_name, result in results['scales'].items():
+        for name, seconds in sorted(result['best'].items()):
+            table.add_row([scale_name, name, stages.get(name, merge_stages.get(name, '')), '{:.3f}'.format(seconds)])
+    print(table)
+    for scale_name, result in results['scales'].items():
+        best = result['best']
+        if best.get('merge_parallel'):
+            print('Merge {}: {:.3f}s serial, {:.3f}s on {} workers, {:.2f}x'.format(
+                scale_name, best['merge_serial'], best['merge_parallel'], result['merge_workers'],
+                best['merge_serial'] / best['merge_parallel']))
+
+    report_path = os.path.expanduser(configs.report_path)
+    if not os.path.exists(report_path):
+        os.makedirs(report_path)
+    results_file = os.path.join(report_path, 'benchmark.json')
+    with open(results_file, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    print('Benchmark results {}'.format(results_file))
+
+    if not configs.benchmark_baseline:
+        return 0
+    baseline_file = os.path.expanduser(configs.benchmark_baseline)
+    if not os.path.isfile(baseline_file):
+        shutil.copyfile(results_file, baseline_file)
+        print('No baseline {}; these results are stored as the baseline.'.format(baseline_file))
+        return 0
+    with open(baseline_file, 'r') as f:
+        baseline = json.load(f)
+    if baseline.get('options') != options:
+        print(colored('Baseline {} was run with options {}, this run with {}.'.format(
+            baseline_file, baseline.get('options'), options), 'yellow'))
+    regressions = compare(results, baseline, configs.benchmark_threshold)
+    for scale_name, name, before, seconds in regressions:
+        print(colored('Regression {} {}: {:.3f}s, baseline {:.3f}s (+{:.0%})'.format(
+            scale_name, name, seconds, before, seconds / before - 1.0), 'red'))
+    if regressions:
+        return 1
+    print(colored('No regression beyond {:.0%} against {}'.format(configs.benchmark_threshold, baseline_file),
+                  'green'))
+    return 0
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+
+import pandas as pd
+
+
+# Configuration values, by section, that worksheet outputs are built from. A change to any of them makes every
+# worksheet out of date. Paths of the reports and the merged feed are not inputs of a worksheet.
+config_sections = {
+    'source':   ['source_type', 'stop_data_columns', 'kml_files_root', 'head_data_rows', 'row_idx'],
+    'gtfs':     ['dist_units', 'default_route_type'],
+    'agency':   ['agency_name', 'agency_url', 'agency_timezone', 'agency_id', 'agency_lang', 'agency_phone',
+                 'agency_fare_url'],
+    'feed':     ['feed_publisher_name', 'feed_publisher_url', 'feed_lang', 'feed_start_date', 'feed_end_date',
+                 'delta_max'],
+    'fare':     ['currency', 'payment_method', 'fare_ids', 'origin_id', 'destination_id', 'prices', 'transfers',
+                 'durations'],
+    'service':  ['holidays'],
+}
+
+
+def config_hash(configs):
+    '''
+    SHA-256 of the config values in config_sections. Without a feed_start_date the calendar starts on the run
+        date, so the date is hashed too.
+    :param configs: Configuration object
+    :return: hex digest
+    '''
+    values = dict((key, '{}'.format(getattr(configs, key, None)))
+                  for keys in config_sections.values() for key in keys)
+    if not getattr(configs, 'feed_start_date', None):
+        values['run_date'] = pd.datetime.today().strftime('%Y%m%d')
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def sheet_hash(row_list, stops_column_list, ws_data):
+    '''
+    SHA-256 of the retrieved worksheet data.
+    :return: hex digest
+    '''
+    content = json.dumps([row_list, stops_column_list, ws_data], separators=(',', ':'))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class BuildGraph():
+    '''
+    The BuildGraph class records what each worksheet was last built from, in the SQLite build database
+        <report_path>/build_graph.sqlite. A worksheet's outputs (its tables, exceptions, zip and validation
+        results) depend on its sheet content hash, the KML files of its shape under kml_files_root and the
+        config values in config_sections. A worksheet whose inputs are unchanged is up to date; its previous
+        tables and exceptions are returned from the database, its zip and validation results are left in place.
+        The worksheet data of the last build is kept as a snapshot to diff the next fetch against.
+
+     Attributes:
+        db_file: path of the build database
+        config: config hash of this run
+        kml_root: kml_files_root, expanded
+        rebuild: find no worksheet up to date; builds are still recorded
+        reused: worksheets found up to date
+        patched: worksheets patched trip by trip
+        rebuilt: worksheets recorded after a build
+    '''
+
+    def __init__(self, db_file, configs, rebuild=False):
+        self.db_file = db_file
+        self.rebuild = rebuild
+        self.config = config_hash(configs)
+        self.kml_root = os.path.expanduser(configs.kml_files_root)
+        self.reused = 0
+        self.patched = 0
+        self.rebuilt = 0
+        self._lock = threading.Lock()
+        # KML file states seen in this run; files shared by several shapes are hashed once.
+        self._kml_states = {}
+        path = os.path.dirname(db_file)
+        if path and not os.path.exists(path):
+            os.makedirs(path)
+        with self.connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS worksheets (source TEXT PRIMARY KEY, sheet_hash TEXT, '
+                               'updated TEXT, config_hash TEXT, kml TEXT, files INTEGER, outputs BLOB, built TEXT, '
+                               'snapshot TEXT, stored INTEGER, output_hash TEXT)')
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(worksheets)')]
+            for column, column_type in (('snapshot', 'TEXT'), ('stored', 'INTEGER'), ('output_hash', 'TEXT')):
+                if column not in columns:
+                    connection.execute('ALTER TABLE worksheets ADD COLUMN {} {}'.format(column, column_type))
+
+    def connect(self):
+        '''
+        A connection per call, so fetch threads can look worksheets up.
+        '''
+        return sqlite3.connect(self.db_file, timeout=60)
+
+    def kml_files(self, shape_id):
+        '''
+        KML files a shape is built from, as write_shape_from_kml finds them: <shape_id>.kml, else the
+            <shape_id>.txt list and the KML files it names. Both candidates are inputs, present or not.
+        :param shape_id: shape id from the worksheet
+        :return: list of paths
+        '''
+        paths = [os.path.join(self.kml_root, '{}.kml'.format(shape_id)),
+                 os.path.join(self.kml_root, '{}.txt'.format(shape_id))]
+        if not os.path.isfile(paths[0]) and os.path.isfile(paths[1]):
+            with open(paths[1], 'r') as kml_list:
+                paths += [os.path.join(self.kml_root, item) for item in kml_list.readline().split(',')]
+        return paths
+
+    def kml_state(self, path):
+        '''
+        [path, mtime, size, sha256] of a KML input; mtime, size and hash are None for a missing file.
+        '''
+        with self._lock:
+            if path in self._kml_states:
+                return self._kml_states[path]
+        try:
+            stat = os.stat(path)
+            state = [path, stat.st_mtime_ns, stat.st_size, file_hash(path)]
+        except OSError:
+            state = [path, None, None, None]
+        with self._lock:
+            self._kml_states[path] = state
+        return state
+
+    def kml_changed(self, recorded):
+        '''
+        Compare recorded KML states with the files: mtime and size first, the hash only when they differ, so a
+            touched but unchanged file does not cause a rebuild.
+        :param recorded: list of [path, mtime, size, sha256]
+        :return: True if any file changed.
+        '''
+        for path, mtime, size, digest in recorded:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                if digest is not None:
+                    return True
+                continue
+            if digest is None:
+                return True
+            if (stat.st_mtime_ns, stat.st_size) != (mtime, size) and self.kml_state(path)[3] != digest:
+                return True
+        return False
+
+    def inputs(self, row_list, stops_column_list, ws_data, updated=None):
+        '''
+        Inputs of a worksheet build.
+        :param row_list: row numbers with stop data
+        :param stops_column_list: column numbers with trip times
+        :param ws_data: worksheet data
+        :param updated: the worksheet's last update time reported by Google, or None
+        :return: dictionary with sheet, updated, kml and snapshot
+        '''
+        shape_id = ws_data[1][25] if len(ws_data) > 1 and len(ws_data[1]) > 25 else ''
+        return {'sheet': sheet_hash(row_list, stops_column_list, ws_data), 'updated': updated,
+                'kml': [self.kml_state(path) for path in self.kml_files(shape_id)],
+                'snapshot': [row_list, stops_column_list, ws_data]}
+
+    def _lookup(self, source, zip_file, match, count=True):
+        if self.rebuild:
+            return None
+        with self.connect() as connection:
+            record = connection.execute('SELECT sheet_hash, updated, config_hash, kml, files, outputs, snapshot '
+                                        'FROM worksheets WHERE source = ?', (source,)).fetchone()
+        if record is None:
+            return None
+        sheet, updated, config, kml, built_files, outputs, snapshot = record
+        if not match(sheet, updated) or config != self.config:
+            return None
+        if zip_file and not (built_files and os.path.isfile(zip_file)):
+            return None
+        if self.kml_changed(json.loads(kml)):
+            return None
+        if count:
+            with self._lock:
+                self.reused += 1
+        return pickle.loads(outputs), json.loads(snapshot) if snapshot else None
+
+    def unchanged(self, source, updated, zip_file=None):
+        '''
+        Outputs of a worksheet whose update time matches the last build, so it need not be fetched.
+        :param source: workbook.worksheet
+        :param updated: the worksheet's last update time reported by Google, or None
+        :param zip_file: the worksheet zip when worksheet files are wanted, or None
+        :return: (stops, the worksheet's tables as a Feed, exceptions), or None to fetch and check the content.
+        '''
+        if not updated:
+            return None
+        found = self._lookup(source, zip_file, lambda sheet, recorded: recorded == updated)
+        return found[0] if found else None
+
+    def up_to_date(self, source, inputs, zip_file=None):
+        '''
+        Outputs of a worksheet whose inputs are those of the last build.
+        :param source: workbook.worksheet
+        :param inputs: dictionary from inputs()
+        :param zip_file: the worksheet zip when worksheet files are wanted, or None
+        :return: (stops, the worksheet's tables as a Feed, exceptions), or None if the worksheet must be built.
+        '''
+        found = self._lookup(source, zip_file, lambda sheet, updated: sheet == inputs['sheet'])
+        return found[0] if found else None
+
+    def previous(self, source, zip_file=None):
+        '''
+        Outputs and worksheet data of the last build of a worksheet whose sheet changed but whose KML files and
+            config did not, for SheetDiff to tell whether it can be patched.
+        :param source: workbook.worksheet
+        :param zip_file: the worksheet zip when worksheet files are wanted, or None
+        :return: ((stops, the worksheet's tables as a Feed, exceptions), [row_list, stops_column_list, ws_data]),
+            or None
+        '''
+        found = self._lookup(source, zip_file, lambda sheet, updated: True, count=False)
+        if found is None or found[1] is None:
+            return None
+        return found
+
+    def record(self, source, inputs, outputs, files=False, patched=False, stored=False):
+        '''
+        Record a worksheet build.
+        :param source: workbook.worksheet
+        :param inputs: dictionary from inputs()
+        :param outputs: (stops, the worksheet's tables as a Feed, exceptions)
+        :param files: worksheet files and zip were written
+        :param patched: the worksheet was patched rather than built
+        :param stored: the outputs were written to the SQLite store
+        :return:
+        '''
+        blob = pickle.dumps(outputs, pickle.HIGHEST_PROTOCOL)
+        with self.connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO worksheets (source, sheet_hash, updated, config_hash, kml, '
+                               'files, outputs, built, snapshot, stored, output_hash) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (source, inputs['sheet'], inputs['updated'], self.config, json.dumps(inputs['kml']),
+                                int(bool(files)), blob, pd.to_datetime('now').strftime('%c'),
+                                json.dumps(inputs['snapshot']), int(stored), hashlib.sha256(blob).hexdigest()))
+        with self._lock:
+            if patched:
+                self.patched += 1
+            else:
+                self.rebuilt += 1
+
+    def hashes(self, source):
+        '''
+        (sheet hash, output hash) of a worksheet's last recorded build, for the run checkpoint.
+        '''
+        with self.connect() as connection:
+            record = connection.execute('SELECT sheet_hash, output_hash, outputs FROM worksheets WHERE source = ?',
+                                        (source,)).fetchone()
+        if record is None:
+            return None, None
+        sheet, output_hash, outputs = record
+        # Recorded before output hashes were.
+        if output_hash is None and outputs is not None:
+            output_hash = hashlib.sha256(outputs).hexdigest()
+        return sheet, output_hash
+
+    def resumed(self, source, output_hash, zip_file=None):
+        '''
+        Outputs of a worksheet done in the run being resumed, if its last recorded build is the one checkpointed.
+            The worksheet is not fetched; --rebuild does not apply, the interrupted run built it.
+        :param source: workbook.worksheet
+        :param output_hash: output hash from the checkpoint
+        :param zip_file: the worksheet zip when worksheet files are wanted, or None
+        :return: (stops, the worksheet's tables as a Feed, exceptions), or None if the worksheet must be fetched.
+        '''
+        with self.connect() as connection:
+            record = connection.execute('SELECT files, outputs FROM worksheets WHERE source = ?',
+                                        (source,)).fetchone()
+        if record is None or record[1] is None or hashlib.sha256(record[1]).hexdigest() != output_hash:
+            return None
+        if zip_file and not (record[0] and os.path.isfile(zip_file)):
+            return None
+        with self._lock:
+            self.reused += 1
+        return pickle.loads(record[1])
+
+    def stored(self, source):
+        '''
+        True when the SQLite store received the worksheet's last recorded outputs, so its rows there are current.
+        '''
+        with self.connect() as connection:
+            record = connection.execute('SELECT stored FROM worksheets WHERE source = ?', (source,)).fetchone()
+        return bool(record and record[0])
+
+    def set_stored(self, source):
+        with self.connect() as connection:
+            connection.execute('UPDATE worksheets SET stored = 1 WHERE source = ?', (source,))
+
+    def stats(self):
+        return 'reused:{} patched:{} rebuilt:{}'.format(self.reused, self.patched, self.rebuilt)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import os
+import sqlite3
+
+import pandas as pd
+
+
+class Checkpoint():
+    '''
+    The Checkpoint class records the progress of a generate run in the SQLite database
+        <report_path>/checkpoint.sqlite. Every worksheet is recorded as soon as its outputs are in the build graph:
+        done with its sheet and output hashes, or failed with the error. Each record is committed before the next
+        worksheet starts, so an interrupted or failed run can be resumed (--resume): worksheets done in it are
+        taken from the build graph without being fetched, the others are fetched and built, then the feed is merged.
+
+     Attributes:
+        db_file: path of the checkpoint database
+        config: config hash of this run
+        resumed: this run continues an unfinished run
+    '''
+
+    def __init__(self, db_file, config):
+        self.db_file = db_file
+        self.config = config
+        self.resumed = False
+        path = os.path.dirname(db_file)
+        if path and not os.path.exists(path):
+            os.makedirs(path)
+        with self.connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS run (config_hash TEXT, started TEXT, finished TEXT)')
+            connection.execute('CREATE TABLE IF NOT EXISTS worksheets (source TEXT PRIMARY KEY, state TEXT, '
+                               'sheet_hash TEXT, output_hash TEXT, error TEXT, recorded TEXT)')
+
+    def connect(self):
+        '''
+        A connection per call, so fetch threads can record worksheets.
+        '''
+        return sqlite3.connect(self.db_file, timeout=60)
+
+    def begin(self, resume=False):
+        '''
+        Start a run. With resume, an unfinished run with the same config hash is continued; otherwise the
+            records of the last run are cleared.
+        :param resume: continue the last run if it did not finish
+        :return: True if the last run is continued.
+        '''
+        with self.connect() as connection:
+            run = connection.execute('SELECT config_hash, started, finished FROM run').fetchone()
+            self.resumed = bool(resume and run is not None and run[2] is None and run[0] == self.config)
+            if self.resumed:
+                # Failed worksheets are tried again.
+                connection.execute("DELETE FROM worksheets WHERE state = 'failed'")
+            else:
+                connection.execute('DELETE FROM run')
+                connection.execute('DELETE FROM worksheets')
+                connection.execute('INSERT INTO run (config_hash, started, finished) VALUES (?, ?, NULL)',
+                                   (self.config, pd.to_datetime('now').strftime('%c')))
+        return self.resumed
+
+    def done(self, source):
+        '''
+        Output hash of a worksheet done in the run being resumed.
+        :param source: workbook.worksheet
+        :return: output hash, or None
+        '''
+        if not self.resumed:
+            return None
+        with self.connect() as connection:
+            record = connection.execute("SELECT output_hash FROM worksheets WHERE source = ? AND state = 'done'",
+                                        (source,)).fetchone()
+        return record[0] if record else None
+
+    def complete(self, source, sheet_hash, output_hash):
+        with self.connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO worksheets (source, state, sheet_hash, output_hash, error, '
+                               "recorded) VALUES (?, 'done', ?, ?, NULL, ?)",
+                               (source, sheet_hash, output_hash, pd.to_datetime('now').strftime('%c')))
+
+    def fail(self, source, error):
+        with self.connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO worksheets (source, state, sheet_hash, output_hash, error, '
+                               "recorded) VALUES (?, 'failed', NULL, NULL, ?, ?)",
+                               (source, error, pd.to_datetime('now').strftime('%c')))
+
+    def counts(self):
+        '''
+        Worksheets recorded in the run, by state.
+        :return: dictionary of state to count
+        '''
+        with self.connect() as connection:
+            return dict(connection.execute('SELECT state, COUNT(*) FROM worksheets GROUP BY state').fetchall())
+
+    def finish(self):
+        '''
+        Mark the run finished: every worksheet was built and the feed merged. There is nothing left to resume.
+        '''
+        with self.connect() as connection:
+            connection.execute('UPDATE run SET finished = ?', (pd.to_datetime('now').strftime('%c'),))
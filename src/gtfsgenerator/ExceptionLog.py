@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+from gtfsgenerator.Metrics import write_atomic
+
+
+# An exception found building the feed. row is the 1-based worksheet row, column the worksheet column letters, both
+# None when the exception is not about a cell; time is seconds since the epoch; trip_id the trip a trip-level
+# exception belongs to, for patch_worksheet to replace it. Records are tuples, so worker processes return them with
+# a worksheet's outputs and the build graph keeps them with its last build.
+ExceptionRecord = namedtuple('ExceptionRecord', 'message workbook worksheet time row column code trip_id')
+
+
+def exception_record(exception):
+    '''
+    An ExceptionRecord of a record, or of a tuple recorded by a build graph before exceptions were typed:
+        (exception, workbook, worksheet, time), or (exception, workbook, worksheet, time, code, trip_id).
+    '''
+    if isinstance(exception, ExceptionRecord):
+        return exception
+    message, workbook, worksheet, now = exception[:4]
+    code, trip_id = exception[4:6] if len(exception) >= 6 else (None, None)
+    return ExceptionRecord(message, workbook, worksheet, now, None, None, code, trip_id)
+
+
+def format_time(now, iso=False):
+    '''
+    A record's time, readable or ISO 8601 UTC; the time of an untyped record is already formatted.
+    '''
+    if isinstance(now, str):
+        return now
+    if iso:
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now))
+    return time.strftime('%c', time.localtime(now))
+
+
+class ExceptionLog():
+    '''
+    The ExceptionLog class collects the exceptions of a generate run, from every workbook, and writes them once at
+        the end of the run: <report_path>/exceptions.jsonl, a JSON line per exception, and
+        <report_path>/exceptions.txt, the exceptions grouped by worksheet and code with their counts. Worker
+        processes and the pipeline buffer their exceptions and the coordinator adds them in worksheet order; a
+        pickled ExceptionLog, ie., on a worker, starts empty.
+
+     Attributes:
+        report_path: directory of the exception files, expanded
+        started: wall clock time the run started, seconds since the epoch
+        records: list of ExceptionRecord, in the order they were added
+    '''
+
+    def __init__(self, report_path):
+        self.report_path = os.path.expanduser(report_path)
+        self.started = time.time()
+        self.records = []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'report_path': self.report_path, 'started': self.started}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, records):
+        '''
+        Add exceptions; fetch threads and the coordinator add them concurrently.
+        :param records: ExceptionRecords, or tuples of an older build graph, see exception_record
+        :return:
+        '''
+        records = [exception_record(record) for record in records]
+        with self._lock:
+            self.records.extend(records)
+
+    def counts(self):
+        '''
+        Exceptions by code; exceptions recorded without a code count as ''.
+        :return: dictionary of code to count
+        '''
+        counts = {}
+        for record in self.records:
+            counts[record.code or ''] = counts.get(record.code or '', 0) + 1
+        return counts
+
+    def groups(self):
+        '''
+        The exceptions grouped by worksheet, then code, each in the order the first of its exceptions was added.
+        :return: list of ((workbook, worksheet), list of (code, list of ExceptionRecord))
+        '''
+        sheets = {}
+        for record in self.records:
+            codes = sheets.setdefault((record.workbook, '{}'.format(record.worksheet)), {})
+            codes.setdefault(record.code or '', []).append(record)
+        return [(sheet, list(codes.items())) for sheet, codes in sheets.items()]
+
+    def summary(self):
+        '''
+        The readable exceptions.txt.
+        :return: str
+        '''
+        lines = ['GTFS Generator Process start:{}'.format(format_time(self.started)),
+                 '{} exceptions in {} worksheets.'.format(len(self.records), len(self.groups()))]
+        for (workbook, worksheet), codes in self.groups():
+            lines.append('')
+            lines.append('Workbook: {} Worksheet:{}  {} exceptions'.format(
+                workbook, worksheet, sum(len(records) for code, records in codes)))
+            for code, records in codes:
+                lines.append('  {}: {}'.format(code or 'other', len(records)))
+                for record in records:
+                    cell = ''
+                    if record.column and record.row is not None:
+                        cell = '{}{} '.format(record.column, record.row)
+                    elif record.row is not None:
+                        cell = 'row {} '.format(record.row)
+                    lines.append('    {}exception:{}  {}'.format(cell, record.message, format_time(record.time)))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        '''
+        Write exceptions.jsonl and exceptions.txt, replacing those of the last run.
+        :return: path of exceptions.jsonl
+        '''
+        jsonl_file = os.path.join(self.report_path, 'exceptions.jsonl')
+        with self._lock:
+            lines = [json.dumps(dict(record._asdict(), time=format_time(record.time, True)), sort_keys=True)
+                     for record in self.records]
+            write_atomic(jsonl_file, ''.join(line + '\n' for line in lines))
+            write_atomic(os.path.join(self.report_path, 'exceptions.txt'), self.summary())
+        return jsonl_file
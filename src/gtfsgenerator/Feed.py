@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import io
+import os
+
+from gtfsgenerator.FeedZip import FeedZip
+from gtfsgenerator.GTFS import GtfsTable
+from gtfsgenerator.GTFS import GtfsWrite
+
+
+class Feed():
+    '''
+    The Feed class assembles a complete GTFS feed in memory. Worksheets contribute rows directly to one
+        GtfsTable per GTFS file, keyed by primary key, and the tables are serialized once into the agency zip.
+
+     Attributes:
+        tables: dictionary of gtfs file name (without the 'txt' extension) to GtfsTable
+    '''
+
+    def __init__(self):
+        self.tables = {}
+        for gtfs_file in GtfsWrite().gtfs_filelist:
+            self.tables[gtfs_file] = GtfsTable(gtfs_file)
+
+    def add_rows(self, gtfs_file, rows, source=''):
+        '''
+        Add a worksheet's rows of one GTFS file to the feed.
+        :param gtfs_file: GTFS file name, ie., stops, stop_times, trips.
+        :param rows: sequence of rows, each in header order.
+        :param source: label of the contributing worksheet (workbook.worksheet).
+        :return: number of rows added.
+        '''
+        table = self.tables[gtfs_file]
+        added = 0
+        for row in rows:
+            if table.add(row, source):
+                added += 1
+        return added
+
+    def conflicts(self):
+        '''
+        Return the primary key conflicts of all tables as (gtfs file, key, kept source, rejected source).
+        '''
+        conflicts = []
+        for gtfs_file, table in sorted(self.tables.items()):
+            for conflict in table.conflicts:
+                conflicts.append((gtfs_file,) + conflict)
+        return conflicts
+
+    def report(self, configs):
+        '''
+        Print row, duplicate and conflict counts for every table and write the conflict report.
+        :param configs: arguments from the configuration file.
+        :return:
+        '''
+        for gtfs_file, table in sorted(self.tables.items()):
+            print('{}: rows:{} duplicates removed:{} key conflicts:{}'.format(gtfs_file, len(table.rows),
+                                                                               table.duplicates, len(table.conflicts)))
+        GtfsWrite().write_conflicts(self.conflicts(), configs)
+
+    def add_feed(self, sheet, source, names=None):
+        '''
+        Add the tables of a worksheet's feed to this feed.
+        :param sheet: Feed of one worksheet.
+        :param source: label of the worksheet (workbook.worksheet).
+        :param names: gtfs file names to add; all when None.
+        :return:
+        '''
+        for gtfs_file, table in sorted(sheet.tables.items()):
+            if names is None or gtfs_file in names:
+                self.add_rows(gtfs_file, table.sorted_rows(), source)
+
+    def write(self, path, names=None):
+        '''
+        Write the tables as <path>/<gtfs file>.txt.
+        :param path: output directory.
+        :param names: gtfs file names to write; all when None.
+        :return:
+        '''
+        for gtfs_file, table in sorted(self.tables.items()):
+            if names is None or gtfs_file in names:
+                table.write(path)
+
+    def write_zip(self, zip_file, compresslevel=6, threads=1, static_tables=None):
+        '''
+        Serialize every table straight into a zip archive, without intermediate text files.
+        :param zip_file: path of the zip archive, i.e., gtfs_path_root/<agency_id>.zip
+        :param compresslevel: zlib compression level.
+        :param threads: threads rendering members while they are compressed; 1 streams rows into the members.
+        :param static_tables: StaticTables whose rendered bytes replace the feed's copy of those files, or None.
+        :return: True if the archive was written, False if its content was unchanged.
+        '''
+        zfile = FeedZip(zip_file, compresslevel, threads)
+        for gtfs_file, table in sorted(self.tables.items()):
+            if static_tables is not None and gtfs_file in static_tables.content:
+                zfile.add('{}.txt'.format(gtfs_file), static_tables.content[gtfs_file])
+            else:
+                zfile.add('{}.txt'.format(gtfs_file), table.serialize)
+        return zfile.close()
+
+
+class StaticTables():
+    '''
+    The StaticTables class holds the GTFS files derived only from the configuration file, rendered once per run.
+        Worksheet directories, worksheet zips and the master feed all receive the same bytes and feed_version.
+
+     Attributes:
+        feed_version: feed_version stamped on this run
+        tables: dictionary of gtfs file name to GtfsTable
+        content: dictionary of gtfs file name to the rendered file (header included) as bytes
+    '''
+
+    names = ['agency', 'fare_attributes', 'fare_rules', 'feed_info']
+
+    def __init__(self, rows, feed_version):
+        self.feed_version = feed_version
+        self.tables = {}
+        self.content = {}
+        for gtfs_file in self.names:
+            table = GtfsTable(gtfs_file)
+            for row in rows[gtfs_file]:
+                table.add(row, source='config')
+            f = io.StringIO(newline='')
+            table.serialize(f)
+            self.tables[gtfs_file] = table
+            self.content[gtfs_file] = f.getvalue().encode('utf-8')
+
+    def add_to(self, feed):
+        '''
+        Add the static rows to an assembling feed.
+        :param feed: Feed object.
+        :return:
+        '''
+        for gtfs_file in self.names:
+            feed.add_rows(gtfs_file, self.tables[gtfs_file].sorted_rows(), source='config')
+
+    def write(self, path):
+        '''
+        Write the rendered bytes as <path>/<gtfs file>.txt.
+        :param path: output directory, a worksheet directory or gtfs_path_root.
+        :return:
+        '''
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for gtfs_file in self.names:
+            with open(os.path.join(path, '{}.txt'.format(gtfs_file)), 'wb') as f:
+                f.write(self.content[gtfs_file])
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import csv
+import io
+import os
+import zipfile
+
+from gtfsgenerator.FeedStore import FeedStore
+from gtfsgenerator.GTFS import GtfsHeader
+from gtfsgenerator.GTFS import GtfsWrite
+from gtfsgenerator.GTFS import time_to_seconds
+
+# pyarrow is optional; it is only needed for the columnar export.
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+# Columns read back as int32 seconds past midnight of the service day; 25:10:00 is 90600.
+time_columns = {'arrival_time', 'departure_time'}
+
+# Columns read back as float64.
+float_columns = {'stop_lat', 'stop_lon', 'shape_pt_lat', 'shape_pt_lon', 'shape_dist_traveled', 'price'}
+
+# Id columns without the _id suffix; dictionary-encoded like the others.
+id_columns = {'parent_station'}
+
+formats = {'arrow': '.arrow', 'parquet': '.parquet'}
+
+
+def to_number(value, number_type):
+    try:
+        return number_type(value)
+    except ValueError:
+        return None
+
+
+def column_array(column, values):
+    '''
+    Build the typed Arrow array of one GTFS column.
+        Times become int32 seconds, coordinates and distances float64, integer fields int32, and ids
+        dictionary-encoded strings so zero-padded ids such as '007' survive. Other fields stay strings.
+    :param column: column name
+    :param values: list of text values
+    :return: pyarrow array
+    '''
+    if column in time_columns:
+        return pa.array([time_to_seconds(value) for value in values], type=pa.int32())
+    if column in float_columns:
+        return pa.array([to_number(value, float) if value else None for value in values], type=pa.float64())
+    if column in FeedStore.integer_columns:
+        return pa.array([to_number(value, int) if value else None for value in values], type=pa.int32())
+    if column.endswith('_id') or column in id_columns:
+        return pa.array(values, type=pa.string()).dictionary_encode()
+    return pa.array(values, type=pa.string())
+
+
+def read_member(zfile, gtfs_file):
+    '''
+    Read the rows of one GTFS file from the feed zip, without its header.
+    :return: list of rows, each padded to the header width.
+    '''
+    width = len(GtfsHeader().columns(gtfs_file))
+    rows = []
+    with zfile.open('{}.txt'.format(gtfs_file)) as member:
+        reader = csv.reader(io.TextIOWrapper(member, encoding='utf-8', newline=''))
+        next(reader, None)
+        for row in reader:
+            if not row:
+                continue
+            row = [value.strip() for value in row[:width]]
+            rows.append(row + [''] * (width - len(row)))
+    return rows
+
+
+def get_columnar_dir(configs):
+    '''
+    Directory of the columnar export, <gtfs_path_root>/<agency_id>_<format>, next to the agency zip.
+    '''
+    return os.path.join(os.path.expanduser(configs.gtfs_path_root), '{}_{}'.format(configs.agency_id, configs.columnar))
+
+
+def write_columnar(zip_file, out_dir, out_format='arrow'):
+    '''
+    Export every table of a GTFS zip as a typed columnar file, <out_dir>/<gtfs file>.arrow (Arrow IPC, readable
+        memory-mapped with load_table) or <gtfs file>.parquet.
+    :param zip_file: path of the agency zip
+    :param out_dir: output directory
+    :param out_format: 'arrow' or 'parquet'
+    :return: list of files written, empty when pyarrow is not installed.
+    '''
+    if pa is None:
+        print('pyarrow is not installed, skipping the {} export.'.format(out_format))
+        return []
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    written = []
+    x = GtfsHeader()
+    with zipfile.ZipFile(zip_file) as zfile:
+        names = zfile.namelist()
+        for gtfs_file in GtfsWrite().gtfs_filelist:
+            if '{}.txt'.format(gtfs_file) not in names:
+                continue
+            columns = x.columns(gtfs_file)
+            rows = read_member(zfile, gtfs_file)
+            arrays = [column_array(column, [row[i] for row in rows]) for i, column in enumerate(columns)]
+            table = pa.Table.from_arrays(arrays, names=columns)
+
+            out_file = os.path.join(out_dir, gtfs_file + formats[out_format])
+            tmp_file = out_file + '.tmp'
+            if out_format == 'parquet':
+                pq.write_table(table, tmp_file)
+            else:
+                with pa.OSFile(tmp_file, 'wb') as sink:
+                    with pa.ipc.new_file(sink, table.schema) as writer:
+                        writer.write_table(table)
+            os.replace(tmp_file, out_file)
+            written.append(out_file)
+    return written
+
+
+def load_table(out_dir, gtfs_file, out_format='arrow'):
+    '''
+    Load one exported table, memory-mapped. table.to_pandas() gives a typed DataFrame.
+    :param out_dir: directory of the columnar export
+    :param gtfs_file: GTFS file name, ie., stops, stop_times, trips.
+    :param out_format: 'arrow' or 'parquet'
+    :return: pyarrow Table
+    '''
+    in_file = os.path.join(out_dir, gtfs_file + formats[out_format])
+    if out_format == 'parquet':
+        return pq.read_table(in_file, memory_map=True)
+    return pa.ipc.open_file(pa.memory_map(in_file, 'r')).read_all()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+from gtfsgenerator.GTFS import time_to_seconds
+
+
+class FeedCheck():
+    '''
+    The FeedCheck class validates GTFS tables in memory, right after a worksheet is built. References between
+        tables are resolved through hash sets of the referenced keys; stop_times are checked trip by trip.
+        feedvalidator.py is still run on the final feed.
+
+     Attributes:
+        tables: dictionary of gtfs file name to GtfsTable
+        errors: list of (gtfs file, message)
+    '''
+
+    # Fields that must have a value in every row.
+    required = {
+        'agency':           ['agency_name', 'agency_url', 'agency_timezone'],
+        'calendar':         ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday',
+                             'sunday', 'start_date', 'end_date'],
+        'calendar_dates':   ['service_id', 'date', 'exception_type'],
+        'fare_attributes':  ['fare_id', 'price', 'currency_type', 'payment_method'],
+        'feed_info':        ['feed_publisher_name', 'feed_publisher_url', 'feed_lang'],
+        'routes':           ['route_id', 'route_type'],
+        'shapes':           ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'],
+        'stop_times':       ['trip_id', 'stop_id', 'stop_sequence'],
+        'stops':            ['stop_id', 'stop_name', 'stop_lat', 'stop_lon'],
+        'trips':            ['route_id', 'service_id', 'trip_id'],
+    }
+
+    # (file, column, referenced files, optional): the column's values must be keys of one of the referenced files.
+    references = [
+        ('stop_times',  'trip_id',      ['trips'],                      False),
+        ('stop_times',  'stop_id',      ['stops'],                      False),
+        ('trips',       'route_id',     ['routes'],                     False),
+        ('trips',       'service_id',   ['calendar', 'calendar_dates'], False),
+        ('trips',       'shape_id',     ['shapes'],                     True),
+        ('routes',      'agency_id',    ['agency'],                     True),
+    ]
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.errors = []
+        self._keys = {}
+
+    def keys(self, gtfs_file, column):
+        '''
+        Hash set of the values of one column, built once per check.
+        '''
+        if (gtfs_file, column) not in self._keys:
+            table = self.tables.get(gtfs_file)
+            values = set()
+            if table is not None:
+                i = table.columns.index(column)
+                values = set(row[i] for row in table.rows.values())
+            self._keys[(gtfs_file, column)] = values
+        return self._keys[(gtfs_file, column)]
+
+    def check(self):
+        '''
+        Run every check.
+        :return: list of (gtfs file, message)
+        '''
+        self.errors = []
+        self.check_required()
+        self.check_references()
+        self.check_stop_times()
+        return self.errors
+
+    def check_required(self):
+        for gtfs_file, columns in sorted(self.required.items()):
+            table = self.tables.get(gtfs_file)
+            if table is None:
+                continue
+            for column in columns:
+                i = table.columns.index(column)
+                missing = [key for key, row in table.rows.items() if row[i] == '']
+                for key in missing:
+                    self.errors.append((gtfs_file, 'key {} missing required {}'.format(','.join(key), column)))
+            if gtfs_file == 'routes':
+                short_name = table.columns.index('route_short_name')
+                long_name = table.columns.index('route_long_name')
+                for key, row in table.rows.items():
+                    if row[short_name] == '' and row[long_name] == '':
+                        self.errors.append((gtfs_file, 'route_id {} has neither route_short_name nor route_long_name'
+                                            .format(','.join(key))))
+
+    def check_references(self):
+        for gtfs_file, column, referenced, optional in self.references:
+            table = self.tables.get(gtfs_file)
+            if table is None:
+                continue
+            known = set()
+            for parent in referenced:
+                parent_table = self.tables.get(parent)
+                if parent_table is not None:
+                    known |= self.keys(parent, column)
+            unresolved = self.keys(gtfs_file, column) - known
+            if optional:
+                unresolved.discard('')
+            for value in sorted(unresolved):
+                self.errors.append((gtfs_file, '{} {} not in {}'.format(
+                    column, value, ' or '.join('{}.txt'.format(parent) for parent in referenced))))
+
+    def check_stop_times(self):
+        '''
+        Per trip, in worksheet order: stop_sequence is a strictly increasing integer, the first and last stops
+            are timed, arrival is not after departure and times do not decrease along the trip.
+        '''
+        table = self.tables.get('stop_times')
+        if table is None:
+            return
+        trip_id = table.columns.index('trip_id')
+        columns = [table.columns.index(column) for column in ('stop_sequence', 'arrival_time', 'departure_time')]
+
+        trips = {}
+        for row in table.rows.values():
+            trips.setdefault(row[trip_id], []).append(tuple(row[i] for i in columns))
+
+        for trip, stops in trips.items():
+            sequences = [int(sequence) if sequence.isdigit() else None for sequence, arrival, departure in stops]
+            arrivals = [time_to_seconds(arrival) for sequence, arrival, departure in stops]
+            departures = [time_to_seconds(departure) for sequence, arrival, departure in stops]
+
+            for (sequence, arrival, departure), number in zip(stops, sequences):
+                if number is None:
+                    self.errors.append(('stop_times', 'trip_id {} stop_sequence {} is not a non-negative integer'
+                                        .format(trip, sequence)))
+            numbers = [number for number in sequences if number is not None]
+            for previous, number in zip(numbers, numbers[1:]):
+                if number <= previous:
+                    self.errors.append(('stop_times', 'trip_id {} stop_sequence {} after {} does not increase'
+                                        .format(trip, number, previous)))
+
+            for end in sorted(set([0, len(stops) - 1])):
+                if arrivals[end] is None or departures[end] is None:
+                    self.errors.append(('stop_times', 'trip_id {} stop_sequence {} {} stop has no arrival/departure '
+                                        'time'.format(trip, stops[end][0], 'first' if end == 0 else 'last')))
+            for i, stop in enumerate(stops):
+                if stop[1] and arrivals[i] is None or stop[2] and departures[i] is None:
+                    self.errors.append(('stop_times', 'trip_id {} stop_sequence {} malformed time {}/{}'
+                                        .format(trip, stop[0], stop[1], stop[2])))
+
+            # Times of the timed stops, arrival then departure, must not decrease.
+            last = None
+            for i, stop in enumerate(stops):
+                for seconds, text in ((arrivals[i], stop[1]), (departures[i], stop[2])):
+                    if seconds is None:
+                        continue
+                    if last is not None and seconds < last[0]:
+                        self.errors.append(('stop_times', 'trip_id {} stop_sequence {} time {} before {}'
+                                            .format(trip, stop[0], text, last[1])))
+                    last = (seconds, text)
@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import csv
+import functools
+import os
+import sqlite3
+
+from gtfsgenerator.FeedZip import FeedZip
+from gtfsgenerator.GTFS import GtfsHeader
+from gtfsgenerator.GTFS import GtfsWrite
+from gtfsgenerator.GTFS import natural_key
+
+
+@functools.lru_cache(maxsize=65536)
+def _natural(value):
+    return natural_key((value,))
+
+
+def natural_collation(a, b):
+    '''
+    SQLite collation ordering text like natural_key, so exports match the text feed order.
+        Values natural_key ties, ie., '7' and '07', compare equal.
+    '''
+    a = _natural(a)
+    b = _natural(b)
+    return (a > b) - (a < b)
+
+
+class FeedStore():
+    '''
+    The FeedStore class keeps the GTFS tables in a SQLite database, an alternative to the text feed files.
+        Every table has its GTFS primary key, indexes on its foreign key columns and a source column naming the
+        worksheet (workbook.worksheet) that contributed the row. Worksheets are upserted in bulk. The database can
+        be queried directly, e.g., sqlite3 <agency_id>.sqlite "select * from stops where stop_name like '%Mall%'".
+        Each source has a position, the order it was placed in; of the rows offered for a key, the row of the first
+        source is kept and the others are held in held_<gtfs file>. When a source is removed, patched or moves,
+        the keys it offered are settled again from the held rows, so the store kept between runs holds the same
+        rows, conflicts and duplicates as one built from every worksheet in order.
+
+     Attributes:
+        db_file: path of the SQLite database
+        connection: sqlite3 connection
+        columns: dictionary of gtfs file name to column names
+        sources: sources (workbook.worksheet) with rows in the store
+        positions: dictionary of source to its position in the store
+        placed: dictionary of the sources placed in this session to their position, in order
+    '''
+
+    # Columns stored as integers. Coordinates, distances, times and dates stay text, as written to the feed.
+    integer_columns = {'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday',
+                       'exception_type', 'payment_method', 'transfers', 'transfer_duration', 'route_type',
+                       'shape_pt_sequence', 'stop_sequence', 'pickup_type', 'drop_off_type', 'location_type',
+                       'wheelchair_boarding', 'direction_id', 'wheelchair_accessible', 'bikes_allowed'}
+
+    # Foreign key columns and the table/column they refer to. A referenced column must be the parent's key.
+    foreign_keys = {
+        'fare_rules':   [('fare_id', 'fare_attributes', 'fare_id'), ('route_id', 'routes', 'route_id')],
+        'routes':       [('agency_id', 'agency', 'agency_id')],
+        'stop_times':   [('trip_id', 'trips', 'trip_id'), ('stop_id', 'stops', 'stop_id')],
+        'trips':        [('route_id', 'routes', 'route_id')],
+    }
+
+    # Other columns joined on by the validation queries.
+    indexed_columns = {
+        'trips':        ['service_id', 'shape_id'],
+    }
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        path = os.path.dirname(db_file)
+        if path and not os.path.exists(path):
+            os.makedirs(path)
+        self.connection = self.connect()
+        self.columns = {}
+        x = GtfsHeader()
+        for gtfs_file in GtfsWrite().gtfs_filelist:
+            self.columns[gtfs_file] = x.columns(gtfs_file)
+        self.create_tables()
+        self.sources = set()
+        for gtfs_file in self.columns:
+            for table in (gtfs_file, 'held_' + gtfs_file):
+                self.sources.update(source for source, in self.connection.execute(
+                    'SELECT DISTINCT source FROM {}'.format(table)))
+        self.positions = dict(self.connection.execute('SELECT source, position FROM positions'))
+        self.placed = {}
+
+    def connect(self):
+        '''
+        Open a connection to the database with the gtfs_natural collation registered.
+        '''
+        connection = sqlite3.connect(self.db_file)
+        connection.create_collation('gtfs_natural', natural_collation)
+        return connection
+
+    def create_tables(self):
+        '''
+        Create the GTFS tables, their held and staging tables, their indexes and the positions table if they do not
+            exist.
+        '''
+        x = GtfsHeader()
+        with self.connection:
+            for gtfs_file, columns in self.columns.items():
+                definition = []
+                for column in columns:
+                    if column in self.integer_columns:
+                        definition.append('"{}" INTEGER'.format(column))
+                    else:
+                        definition.append('"{}" TEXT'.format(column))
+                definition.append('source TEXT')
+                definition.append('PRIMARY KEY ({})'.format(self.quoted(x.primary_key(gtfs_file))))
+                for column, parent, parent_column in self.foreign_keys.get(gtfs_file, []):
+                    definition.append('FOREIGN KEY ("{}") REFERENCES {} ("{}")'.format(column, parent, parent_column))
+                self.connection.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(gtfs_file, ', '.join(definition)))
+                # The held table keeps the rows not kept for their key; the staging table holds one batch of rows
+                # while they are merged, or the rows whose keys are settled again.
+                self.connection.execute('CREATE TABLE IF NOT EXISTS held_{} ({})'.format(
+                    gtfs_file, ', '.join(definition[:len(columns) + 1])))
+                self.connection.execute('CREATE INDEX IF NOT EXISTS held_{}_key ON held_{} ({})'.format(
+                    gtfs_file, gtfs_file, self.quoted(x.primary_key(gtfs_file))))
+                self.connection.execute('CREATE INDEX IF NOT EXISTS held_{0}_source ON held_{0} (source)'.format(
+                    gtfs_file))
+                self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS stage_{} ({})'.format(
+                    gtfs_file, ', '.join(definition[:len(columns) + 1])))
+
+                index_columns = [column for column, parent, parent_column in self.foreign_keys.get(gtfs_file, [])]
+                index_columns += self.indexed_columns.get(gtfs_file, [])
+                for column in index_columns:
+                    if column == x.primary_key(gtfs_file)[0]:
+                        continue
+                    self.connection.execute('CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ("{1}")'.format(gtfs_file, column))
+                self.connection.execute('CREATE INDEX IF NOT EXISTS {0}_source ON {0} (source)'.format(gtfs_file))
+
+            self.connection.execute('CREATE TABLE IF NOT EXISTS positions (source TEXT PRIMARY KEY, '
+                                    'position INTEGER)')
+
+    def quoted(self, columns):
+        return ', '.join('"{}"'.format(column) for column in columns)
+
+    def on_key(self, gtfs_file, a, b):
+        '''
+        SQL condition joining two aliases of a table's rows on its primary key.
+        '''
+        return ' AND '.join('{1}."{0}" = {2}."{0}"'.format(column, a, b) for column in GtfsHeader().primary_key(gtfs_file))
+
+    def position(self, alias):
+        '''
+        SQL expression of the position of the source of a row.
+        '''
+        return '(SELECT position FROM positions p WHERE p.source = {}.source)'.format(alias)
+
+    def place(self, source):
+        '''
+        Give a source the next position of this session: its rows are kept over those of the sources placed after
+            it. The keys of a stored source whose position changed, e.g., after a worksheet was inserted or moved,
+            are settled again.
+        :param source: label of the worksheet (workbook.worksheet).
+        :return:
+        '''
+        if source in self.placed:
+            return
+        position = len(self.placed)
+        self.placed[source] = position
+        if self.positions.get(source) == position:
+            return
+        moved = source in self.positions and source in self.sources
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO positions VALUES (?, ?)', (source, position))
+            self.positions[source] = position
+            if moved:
+                for gtfs_file in self.columns:
+                    self.resettle(gtfs_file, source)
+
+    def add_rows(self, gtfs_file, rows, source=''):
+        '''
+        Upsert a source's rows of one GTFS file in one transaction. Values are stripped as in GtfsTable.add. A
+            staged row replaces the kept row of a source placed after it, and is held when a source placed before
+            it, or its own earlier row, has the key.
+        :param gtfs_file: GTFS file name, ie., stops, stop_times, trips.
+        :param rows: sequence of rows, each in header order.
+        :param source: label of the contributing worksheet (workbook.worksheet); placed if it is not yet.
+        :return: number of rows kept.
+        '''
+        columns = self.columns[gtfs_file]
+        key_index = [columns.index(column) for column in GtfsHeader().primary_key(gtfs_file)]
+        values = []
+        repeated = []
+        keys = set()
+        for row in rows:
+            row = tuple('{}'.format(value).strip() for value in row)
+            if len(row) < len(columns):
+                row = row + ('',) * (len(columns) - len(row))
+            row = row[:len(columns)] + (source,)
+            key = tuple(row[i] for i in key_index)
+            (repeated if key in keys else values).append(row)
+            keys.add(key)
+        if not values:
+            return 0
+        self.place(source)
+
+        stage = 'stage_{}'.format(gtfs_file)
+        held = 'held_{}'.format(gtfs_file)
+        all_columns = self.quoted(columns) + ', source'
+        placeholders = ', '.join('?' * (len(columns) + 1))
+        with self.connection:
+            self.connection.executemany('INSERT INTO {} VALUES ({})'.format(stage, placeholders), values)
+            # Rows of sources placed after this one give way to the staged rows.
+            self.hold(gtfs_file, 'EXISTS (SELECT 1 FROM {} s WHERE {}) AND {} > ?'.format(
+                stage, self.on_key(gtfs_file, 's', 'm'), self.position('m')), (self.positions[source],))
+            self.connection.execute('INSERT INTO {0} ({1}) SELECT {1} FROM {2} s WHERE EXISTS (SELECT 1 FROM {3} m '
+                                    'WHERE {4}) ORDER BY rowid'.format(held, all_columns, stage, gtfs_file,
+                                                                      self.on_key(gtfs_file, 's', 'm')))
+            self.connection.executemany('INSERT INTO {} VALUES ({})'.format(held, placeholders), repeated)
+            before = self.connection.total_changes
+            self.connection.execute('INSERT INTO {0} ({1}) SELECT {1} FROM {2} WHERE true ORDER BY rowid '
+                                    'ON CONFLICT DO NOTHING'.format(gtfs_file, all_columns, stage))
+            added = self.connection.total_changes - before
+            self.connection.execute('DELETE FROM {}'.format(stage))
+
+        self.sources.add(source)
+        return added
+
+    def hold(self, gtfs_file, condition, parameters=()):
+        '''
+        Move the kept rows matching a condition on alias m to the held table.
+        :return: number of rows moved.
+        '''
+        self.connection.execute('INSERT INTO held_{0} ({1}) SELECT {1} FROM {0} m WHERE {2} ORDER BY rowid'.format(
+            gtfs_file, self.quoted(self.columns[gtfs_file]) + ', source', condition), parameters)
+        return self.connection.execute('DELETE FROM {0} WHERE rowid IN (SELECT m.rowid FROM {0} m WHERE {1})'.format(
+            gtfs_file, condition), parameters).rowcount
+
+    def promote(self, gtfs_file):
+        '''
+        Settle the keys of the staged rows that have no kept row: the held row of the first source is kept.
+        '''
+        stage = 'stage_{}'.format(gtfs_file)
+        held = 'held_{}'.format(gtfs_file)
+        columns = self.columns[gtfs_file]
+        key = GtfsHeader().primary_key(gtfs_file)
+        in_stage = 'EXISTS (SELECT 1 FROM {} s WHERE {})'.format(stage, self.on_key(gtfs_file, 's', 'h'))
+        self.connection.execute('INSERT INTO {0} ({1}) SELECT {2} FROM {3} h WHERE {4} ORDER BY {5}, h.rowid '
+                                'ON CONFLICT DO NOTHING'.format(
+                                    gtfs_file, self.quoted(columns) + ', source',
+                                    ', '.join('h."{}"'.format(column) for column in columns) + ', h.source',
+                                    held, in_stage, self.position('h')))
+        # The promoted rows leave the held table: one held row per key equal to its kept row.
+        same = ' AND '.join('h."{0}" IS m."{0}"'.format(column) for column in columns + ['source'])
+        self.connection.execute('DELETE FROM {0} WHERE rowid IN (SELECT MIN(h.rowid) FROM {0} h JOIN {1} m ON {2} '
+                                'WHERE {3} AND {4} GROUP BY {5})'.format(
+                                    held, gtfs_file, self.on_key(gtfs_file, 'h', 'm'), same, in_stage,
+                                    ', '.join('h."{}"'.format(column) for column in key)))
+
+    def withdraw(self, gtfs_file, condition, parameters=()):
+        '''
+        Delete the rows, kept or held, matching a condition on the table's columns; each key that lost its kept row
+            keeps the held row of the first remaining source.
+        :return: number of rows deleted.
+        '''
+        stage = 'stage_{}'.format(gtfs_file)
+        all_columns = self.quoted(self.columns[gtfs_file]) + ', source'
+        deleted = self.connection.execute('DELETE FROM held_{} WHERE {}'.format(gtfs_file, condition),
+                                          parameters).rowcount
+        self.connection.execute('INSERT INTO {0} ({1}) SELECT {1} FROM {2} WHERE {3}'.format(
+            stage, all_columns, gtfs_file, condition), parameters)
+        deleted += self.connection.execute('DELETE FROM {} WHERE {}'.format(gtfs_file, condition),
+                                           parameters).rowcount
+        self.promote(gtfs_file)
+        self.connection.execute('DELETE FROM {}'.format(stage))
+        return deleted
+
+    def resettle(self, gtfs_file, source):
+        '''
+        Settle again every key a source offered rows for, after its position changed.
+        '''
+        stage = 'stage_{}'.format(gtfs_file)
+        all_columns = self.quoted(self.columns[gtfs_file]) + ', source'
+        for table in (gtfs_file, 'held_' + gtfs_file):
+            self.connection.execute('INSERT INTO {0} ({1}) SELECT {1} FROM {2} WHERE source = ?'.format(
+                stage, all_columns, table), (source,))
+        self.hold(gtfs_file, 'EXISTS (SELECT 1 FROM {} s WHERE {})'.format(stage, self.on_key(gtfs_file, 's', 'm')))
+        self.promote(gtfs_file)
+        self.connection.execute('DELETE FROM {}'.format(stage))
+
+    def add_feed(self, sheet, source, names=None):
+        '''
+        Upsert the tables of a worksheet's feed.
+        :param sheet: Feed of one worksheet.
+        :param source: label of the worksheet (workbook.worksheet).
+        :param names: gtfs file names to add; all when None.
+        :return:
+        '''
+        for gtfs_file, table in sorted(sheet.tables.items()):
+            if names is None or gtfs_file in names:
+                self.add_rows(gtfs_file, table.sorted_rows(), source)
+
+    def remove_source(self, source):
+        '''
+        Delete the rows offered by one worksheet, e.g., before it is added again or when it left the workbooks.
+            Keys it kept go to the held rows of the first remaining source.
+        :param source: label of the worksheet (workbook.worksheet).
+        :return: number of rows deleted.
+        '''
+        deleted = 0
+        with self.connection:
+            for gtfs_file in self.columns:
+                deleted += self.withdraw(gtfs_file, 'source = ?', (source,))
+            if source not in self.placed:
+                self.connection.execute('DELETE FROM positions WHERE source = ?', (source,))
+                self.positions.pop(source, None)
+        self.sources.discard(source)
+        return deleted
+
+    def patch_trips(self, source, trip_ids, patch):
+        '''
+        Replace some trips of one worksheet: delete their trips and stop_times rows through the trip_id indexes
+            and upsert the regenerated rows.
+        :param source: label of the worksheet (workbook.worksheet).
+        :param trip_ids: trip_ids to delete, the changed trips as last built.
+        :param patch: Feed holding the regenerated trips and stop_times rows.
+        :return: number of rows deleted.
+        '''
+        deleted = 0
+        with self.connection:
+            for gtfs_file in ('stop_times', 'trips'):
+                for trip_id in sorted(trip_ids):
+                    deleted += self.withdraw(gtfs_file, 'trip_id = ? AND source = ?', (trip_id, source))
+        self.add_feed(patch, source, ['stop_times', 'trips'])
+        return deleted
+
+    def clear(self):
+        '''
+        Delete every row and position, e.g., at the start of a full build.
+        '''
+        with self.connection:
+            for gtfs_file in self.columns:
+                self.connection.execute('DELETE FROM {}'.format(gtfs_file))
+                self.connection.execute('DELETE FROM held_{}'.format(gtfs_file))
+            self.connection.execute('DELETE FROM positions')
+        self.sources = set()
+        self.positions = {}
+        self.placed = {}
+
+    def query(self, sql, parameters=()):
+        '''
+        Run an ad-hoc query.
+        :param sql: SQL statement, i.e., 'SELECT stop_id, stop_name FROM stops WHERE zone_id = ?'
+        :param parameters: query parameters.
+        :return: list of result rows.
+        '''
+        return self.connection.execute(sql, parameters).fetchall()
+
+    def count(self, gtfs_file):
+        return self.connection.execute('SELECT COUNT(*) FROM {}'.format(gtfs_file)).fetchone()[0]
+
+    @property
+    def duplicates(self):
+        '''
+        Dictionary of gtfs file name to held rows identical to the kept row of their key.
+        '''
+        duplicates = {}
+        for gtfs_file, columns in self.columns.items():
+            same = ' AND '.join('h."{0}" IS m."{0}"'.format(column) for column in columns)
+            duplicates[gtfs_file] = self.connection.execute('SELECT COUNT(*) FROM held_{0} h JOIN {0} m ON {1} '
+                                                            'WHERE {2}'.format(gtfs_file,
+                                                                               self.on_key(gtfs_file, 'h', 'm'),
+                                                                               same)).fetchone()[0]
+        return duplicates
+
+    def conflicts(self):
+        '''
+        Return the primary key conflicts, held rows that differ from the kept row of their key, as (gtfs file, key,
+            kept source, rejected source).
+        '''
+        conflicts = []
+        for gtfs_file, columns in sorted(self.columns.items()):
+            key = GtfsHeader().primary_key(gtfs_file)
+            differs = ' OR '.join('h."{0}" IS NOT m."{0}"'.format(column) for column in columns)
+            rows = self.connection.execute('SELECT {}, m.source, h.source FROM held_{} h JOIN {} m ON {} WHERE {} '
+                                           'ORDER BY {}, h.rowid'.format(', '.join('h."{}"'.format(column)
+                                                                                  for column in key),
+                                                                        gtfs_file, gtfs_file,
+                                                                        self.on_key(gtfs_file, 'h', 'm'), differs,
+                                                                        self.position('h')))
+            conflicts.extend((gtfs_file, tuple('{}'.format(value) for value in row[:len(key)]), row[-2], row[-1])
+                             for row in rows)
+        return conflicts
+
+    def report(self, configs):
+        '''
+        Print row, duplicate and conflict counts for every table and write the conflict report.
+        :param configs: arguments from the configuration file.
+        :return:
+        '''
+        conflicts = self.conflicts()
+        duplicates = self.duplicates
+        for gtfs_file in sorted(self.columns):
+            print('{}: rows:{} duplicates removed:{} key conflicts:{}'.format(
+                gtfs_file, self.count(gtfs_file), duplicates[gtfs_file],
+                len([conflict for conflict in conflicts if conflict[0] == gtfs_file])))
+        GtfsWrite().write_conflicts(conflicts, configs)
+
+    def validate(self):
+        '''
+        Check references between the tables with indexed queries.
+        :return: list of (gtfs file, message, source) ordered by file and message.
+        '''
+        checks = [
+            ('stop_times', "SELECT DISTINCT c.trip_id, c.source FROM stop_times c "
+                           "WHERE NOT EXISTS (SELECT 1 FROM trips p WHERE p.trip_id = c.trip_id)",
+             'trip_id {} not in trips.txt'),
+            ('stop_times', "SELECT DISTINCT c.stop_id, c.source FROM stop_times c "
+                           "WHERE NOT EXISTS (SELECT 1 FROM stops p WHERE p.stop_id = c.stop_id)",
+             'stop_id {} not in stops.txt'),
+            ('trips', "SELECT DISTINCT c.route_id, c.source FROM trips c "
+                      "WHERE NOT EXISTS (SELECT 1 FROM routes p WHERE p.route_id = c.route_id)",
+             'route_id {} not in routes.txt'),
+            ('trips', "SELECT DISTINCT c.service_id, c.source FROM trips c "
+                      "WHERE NOT EXISTS (SELECT 1 FROM calendar p WHERE p.service_id = c.service_id) "
+                      "AND NOT EXISTS (SELECT 1 FROM calendar_dates p WHERE p.service_id = c.service_id)",
+             'service_id {} not in calendar.txt or calendar_dates.txt'),
+            ('trips', "SELECT DISTINCT c.shape_id, c.source FROM trips c WHERE c.shape_id != '' "
+                      "AND NOT EXISTS (SELECT 1 FROM shapes p WHERE p.shape_id = c.shape_id)",
+             'shape_id {} not in shapes.txt'),
+            ('trips', "SELECT c.trip_id, c.source FROM trips c "
+                      "WHERE NOT EXISTS (SELECT 1 FROM stop_times p WHERE p.trip_id = c.trip_id)",
+             'trip_id {} has no stop_times'),
+            ('routes', "SELECT DISTINCT c.agency_id, c.source FROM routes c WHERE c.agency_id != '' "
+                       "AND NOT EXISTS (SELECT 1 FROM agency p WHERE p.agency_id = c.agency_id)",
+             'agency_id {} not in agency.txt'),
+            ('fare_rules', "SELECT DISTINCT c.route_id, c.source FROM fare_rules c WHERE c.route_id != '' "
+                           "AND NOT EXISTS (SELECT 1 FROM routes p WHERE p.route_id = c.route_id)",
+             'route_id {} not in routes.txt'),
+        ]
+        errors = []
+        for gtfs_file, sql, message in checks:
+            for value, source in self.connection.execute(sql):
+                errors.append((gtfs_file, message.format(value), source))
+        return sorted(errors)
+
+    def serialize(self, gtfs_file, f):
+        '''
+        Write the GTFS header and the rows of a table ordered by primary key to an open text file, streaming from a
+            cursor on its own connection so tables can be exported from several threads.
+        :param gtfs_file: GTFS file name, ie., stops, stop_times, trips.
+        :param f: writable text file object.
+        :return:
+        '''
+        x = GtfsHeader()
+        # natural_text order: the key by gtfs_natural, then keys that only differ in leading zeros by their text.
+        key = x.primary_key(gtfs_file)
+        order = ', '.join(['"{}" COLLATE gtfs_natural'.format(column) for column in key] +
+                          ['"{}"'.format(column) for column in key])
+        connection = self.connect()
+        try:
+            cursor = connection.execute('SELECT {} FROM {} ORDER BY {}'.format(self.quoted(self.columns[gtfs_file]),
+                                                                                 gtfs_file, order))
+            f.write('{}\n'.format(x.return_header(gtfs_file)))
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerows(cursor)
+        finally:
+            connection.close()
+
+    def write(self, path, names=None):
+        '''
+        Export the tables as <path>/<gtfs file>.txt.
+        :param path: output directory.
+        :param names: gtfs file names to write; all when None.
+        :return:
+        '''
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for gtfs_file in sorted(self.columns):
+            if names is None or gtfs_file in names:
+                with open(os.path.join(path, '{}.txt'.format(gtfs_file)), 'w', newline='') as f:
+                    self.serialize(gtfs_file, f)
+
+    def write_zip(self, zip_file, compresslevel=6, threads=1):
+        '''
+        Export every table straight into a zip archive.
+        :param zip_file: path of the zip archive, i.e., gtfs_path_root/<agency_id>.zip
+        :param compresslevel: zlib compression level.
+        :param threads: threads exporting and compressing members concurrently.
+        :return: True if the archive was written, False if its content was unchanged.
+        '''
+        zfile = FeedZip(zip_file, compresslevel, threads)
+        for gtfs_file in sorted(self.columns):
+            zfile.add('{}.txt'.format(gtfs_file), functools.partial(self.serialize, gtfs_file))
+        return zfile.close()
+
+    def close(self):
+        self.connection.close()
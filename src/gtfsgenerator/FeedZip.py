@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import json
+import os
+import queue
+import shutil
+import time
+import zipfile
+
+
+class _HashingWriter(io.RawIOBase):
+    '''
+    Binary writer that hashes everything written through it to another binary file object.
+    '''
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.sha256 = hashlib.sha256()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.sha256.update(b)
+        self.raw.write(b)
+        return len(b)
+
+
+class _QueueWriter(io.RawIOBase):
+    '''
+    Binary writer that hands each chunk written through it to a queue, blocking while the queue is full.
+    '''
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.put(bytes(b))
+        return len(b)
+
+
+def read_zip_state(zip_file):
+    '''
+    Read the member content hashes and compression level FeedZip records in the archive comment.
+    :param zip_file: path of a feed zip.
+    :return: {'sha256': dictionary of member name to sha256, 'compresslevel': level}, empty if the archive is
+        missing or was not written by FeedZip.
+    '''
+    if not os.path.isfile(zip_file):
+        return {}
+    try:
+        with zipfile.ZipFile(zip_file) as zfile:
+            comment = zfile.comment
+        return json.loads(comment.decode('utf-8'))
+    except (zipfile.BadZipFile, ValueError, AttributeError):
+        return {}
+
+
+class FeedZip():
+    '''
+    The FeedZip class writes GTFS tables into a feed zip.
+        Members are rendered bytes, the path of a file, or a function that writes the table text to a file object.
+        Each member is streamed through zipfile into <zip_file>.tmp and hashed as it is written. The member sha256
+        hashes and the compression level are kept in the archive comment; when they match the previous archive the
+        temporary archive is discarded and the previous one is left untouched, otherwise it replaces it.
+        With more than one thread, members are rendered on threads into bounded queues of chunks while the
+        archive is compressed, so rendering rows overlaps deflating them (zlib releases the GIL).
+
+     Attributes:
+        zip_file: path of the zip archive
+        compresslevel: zlib compression level 0-9
+        threads: number of threads rendering members
+        members: list of (member name, bytes, file path or function(f))
+    '''
+
+    # Size of the chunks members are written in, and chunks queued per member rendered on a thread.
+    chunk_size = 1024 * 1024
+    queued_chunks = 16
+
+    def __init__(self, zip_file, compresslevel=6, threads=1):
+        self.zip_file = zip_file
+        self.compresslevel = int(compresslevel)
+        self.threads = int(threads)
+        self.members = []
+
+    def add(self, name, content):
+        '''
+        Add a member to the archive.
+        :param name: member name, i.e., stops.txt
+        :param content: bytes, the path of a file, or a function called with a writable text file object.
+        :return:
+        '''
+        self.members.append((name, content))
+
+    def close(self):
+        '''
+        Write the archive unless its member hashes and compression level match the previous archive.
+        :return: True if the archive was written, False if it was unchanged.
+        '''
+        out_dir = os.path.dirname(self.zip_file)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        previous = read_zip_state(self.zip_file)
+        try:
+            hashes = self._write(previous, force_zip64=False)
+        except RuntimeError as error:
+            # zipfile raises when a streamed member passes 2 GiB without ZIP64 headers; write them all with ZIP64.
+            if 'force_zip64' not in str(error):
+                raise
+            hashes = self._write(previous, force_zip64=True)
+        return hashes is not None
+
+    def _write(self, previous, force_zip64):
+        '''
+        Stream the members into <zip_file>.tmp and replace the archive with it, or discard it when unchanged.
+        :param previous: state of the previous archive from read_zip_state.
+        :param force_zip64: write ZIP64 headers for members whose size is not known in advance.
+        :return: dictionary of member name to sha256 if the archive was written, None if it was unchanged.
+        '''
+        tmp_file = '{}.tmp'.format(self.zip_file)
+        date_time = time.localtime()[:6]
+        try:
+            with zipfile.ZipFile(tmp_file, 'w', zipfile.ZIP_DEFLATED, compresslevel=self.compresslevel) as zfile:
+                if self.threads > 1:
+                    hashes = self._write_threaded(zfile, date_time, force_zip64)
+                else:
+                    hashes = {}
+                    for name, content in self.members:
+                        zinfo = self._zinfo(name, content, date_time)
+                        with zfile.open(zinfo, 'w', force_zip64=force_zip64) as member:
+                            hashing = _HashingWriter(member)
+                            self._render(content, hashing)
+                        hashes[name] = hashing.sha256.hexdigest()
+                state = {'sha256': hashes, 'compresslevel': self.compresslevel}
+                zfile.comment = json.dumps(state, sort_keys=True).encode('utf-8')
+            if state == previous:
+                os.remove(tmp_file)
+                return None
+            os.replace(tmp_file, self.zip_file)
+            return hashes
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+
+    def _zinfo(self, name, content, date_time):
+        zinfo = zipfile.ZipInfo(name, date_time=date_time)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        # A known size lets zipfile decide on ZIP64 headers itself.
+        if isinstance(content, bytes):
+            zinfo.file_size = len(content)
+        elif isinstance(content, str):
+            zinfo.file_size = os.path.getsize(content)
+        return zinfo
+
+    def _render(self, content, raw):
+        '''
+        Write a member's content to a binary file object.
+        :param content: bytes, the path of a file, or a function called with a writable text file object.
+        :param raw: binary file object.
+        :return:
+        '''
+        if isinstance(content, bytes):
+            raw.write(content)
+        elif isinstance(content, str):
+            with open(content, 'rb') as f:
+                shutil.copyfileobj(f, raw, self.chunk_size)
+        else:
+            f = io.TextIOWrapper(io.BufferedWriter(raw, self.chunk_size), encoding='utf-8', newline='')
+            content(f)
+            f.flush()
+            f.detach()
+
+    def _produce(self, content, chunks):
+        '''
+        Render a member into a queue of chunks, ending with None, on a thread.
+        :return: sha256 of the member
+        '''
+        hashing = _HashingWriter(_QueueWriter(chunks))
+        try:
+            self._render(content, hashing)
+        finally:
+            chunks.put(None)
+        return hashing.sha256.hexdigest()
+
+    def _write_threaded(self, zfile, date_time, force_zip64):
+        '''
+        Render the members on threads, in member order, while this thread compresses them into the archive.
+        :return: dictionary of member name to sha256
+        '''
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            queues = [queue.Queue(maxsize=self.queued_chunks) for member in self.members]
+            futures = [pool.submit(self._produce, content, chunks)
+                       for (name, content), chunks in zip(self.members, queues)]
+            drained = 0
+            try:
+                for (name, content), chunks in zip(self.members, queues):
+                    zinfo = self._zinfo(name, content, date_time)
+                    with zfile.open(zinfo, 'w', force_zip64=force_zip64) as member:
+                        for chunk in iter(chunks.get, None):
+                            member.write(chunk)
+                        drained += 1
+            except BaseException:
+                # Unblock the threads still rendering so the pool can shut down.
+                for future, chunks in zip(futures[drained:], queues[drained:]):
+                    if not future.cancel():
+                        for chunk in iter(chunks.get, None):
+                            pass
+                raise
+            return dict((name, future.result()) for (name, content), future in zip(self.members, futures))
@@ -3,8 +3,188 @@ from bs4 import BeautifulSoup
 
 __author__ = 'dr.pete.dailey'
 
-import fileinput
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import hashlib
+import heapq
+import json
 import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import zlib
+
+from gtfsgenerator.FeedZip import FeedZip
+from gtfsgenerator.Trace import span
+
+_digit_runs = re.compile(r'(\d+)')
+
+
+def natural_key(values):
+    '''
+    Sort key for a tuple of text values that orders runs of digits numerically, so stop_sequence '2'
+        sorts before '10' and trip ids sort by their time headers.
+    :param values: tuple of text values, i.e., a primary key.
+    :return: tuple suitable for sorted(key=...)
+    '''
+    key = []
+    for value in values:
+        parts = []
+        for part in _digit_runs.split(value):
+            if not part:
+                continue
+            if part.isdigit():
+                parts.append((0, int(part), ''))
+            else:
+                parts.append((1, 0, part))
+        key.append(tuple(parts))
+    return tuple(key)
+
+
+def natural_text(values):
+    '''
+    Text that sorts like natural_key(values) in a plain string comparison. Digit runs are prefixed with their length
+        and sort before text, every part and value is terminated by a lower character, and the raw values are appended
+        so keys that natural_key ties, ie., '7' and '07', still have one order.
+    :param values: tuple of text values, i.e., a primary key.
+    :return: str
+    '''
+    text = []
+    for value in values:
+        for part in _digit_runs.split(value):
+            if not part:
+                continue
+            if part.isdigit():
+                digits = part.lstrip('0')
+                text.append('\x02{:03d}{}'.format(len(digits), digits))
+            else:
+                text.append('\x03' + part + '\x01')
+        text.append('\x00')
+    text.append('\x1f'.join(values))
+    return ''.join(text)
+
+
+def time_to_seconds(value):
+    '''
+    Convert a GTFS time, H:MM:SS or HH:MM:SS and possibly past 24:00:00, to seconds.
+    :param value: time text
+    :return: seconds, or None for an empty or malformed time.
+    '''
+    parts = value.split(':')
+    if len(parts) != 3 or not all(part.strip().isdigit() for part in parts):
+        return None
+    return int(parts[0]) * 3600 + int(parts[1]) * 60 + int(parts[2])
+
+
+def shard_of(value, shards):
+    '''
+    Stable shard number of a key value. zlib.crc32 is used rather than hash() so every process agrees.
+    :param value: text value, i.e., a trip_id or shape_id.
+    :param shards: number of shards.
+    :return: shard number in range(shards)
+    '''
+    return zlib.crc32(value.encode('utf-8')) % shards
+
+
+class _Lines(list):
+    '''
+    File-like list for csv.writer: each writerow() appends one formatted line.
+    '''
+    write = list.append
+
+
+def merge_table(gtfs_file, inputs, out_file):
+    '''
+    Merge one GTFS file from the worksheet files and write it ordered by key. Module level so a process pool can run it.
+    :param gtfs_file: GTFS file name, ie., stops, stop_times, trips.
+    :param inputs: list of (input file path, source label) in worksheet order.
+    :param out_file: path of the merged file.
+    :return: (gtfs_file, rows, duplicates removed, conflicts)
+    '''
+    table = GtfsTable(gtfs_file)
+    for infile, source in inputs:
+        table.read(infile, source)
+    with open(out_file, 'w', newline='') as f:
+        table.serialize(f)
+    return gtfs_file, len(table.rows), table.duplicates, table.conflicts
+
+
+def partition_table(gtfs_file, inputs, shards, part_dir, part):
+    '''
+    Read a run of worksheet files of one GTFS file once and split their rows into one file per shard, by the first
+        key column. Each row is written with its source label in front.
+    :param gtfs_file: GTFS file name, ie., stop_times, shapes.
+    :param inputs: list of (input file path, source label) in worksheet order.
+    :param shards: number of shards.
+    :param part_dir: directory of the partition files.
+    :param part: number of this run of inputs; partition files are named <gtfs_file>.<part>.<shard>.csv
+    :return: list of partition file paths, by shard.
+    '''
+    table = GtfsTable(gtfs_file)
+    first_key = table._key_index[0]
+    part_files = [os.path.join(part_dir, '{}.{}.{}.csv'.format(gtfs_file, part, shard)) for shard in range(shards)]
+    files = [open(part_file, 'w', newline='') for part_file in part_files]
+    try:
+        writers = [csv.writer(f, lineterminator='\n') for f in files]
+        for infile, source in inputs:
+            for row in table.read_rows(infile):
+                value = row[first_key].strip() if len(row) > first_key else ''
+                writers[shard_of(value, shards)].writerow([source] + row)
+    finally:
+        for f in files:
+            f.close()
+    return part_files
+
+
+def merge_shard(gtfs_file, part_files, sorted_file):
+    '''
+    Merge one shard of a GTFS file from its partition files, read in worksheet order, and write its rows ordered by
+        key. Each record is a line '<key length> <row length>' followed by the natural_text key and the CSV row, so
+        the parent merges the shards by comparing keys without parsing rows.
+    :param gtfs_file: GTFS file name, ie., stop_times, shapes.
+    :param part_files: partition files of this shard, in worksheet order.
+    :param sorted_file: path of the key-ordered shard file.
+    :return: (gtfs_file, rows, duplicates removed, conflicts)
+    '''
+    table = GtfsTable(gtfs_file)
+    for part_file in part_files:
+        with open(part_file, 'r', newline='') as f:
+            for row in csv.reader(f):
+                table.add(row[1:], row[0])
+    lines = _Lines()
+    writer = csv.writer(lines, lineterminator='\n')
+    with open(sorted_file, 'w', newline='') as f:
+        for sort_text, key in sorted((natural_text(key), key) for key in table.rows):
+            writer.writerow(table.rows[key])
+            line = lines.pop()
+            f.write('{} {}\n{}{}'.format(len(sort_text), len(line), sort_text, line))
+    return gtfs_file, len(table.rows), table.duplicates, table.conflicts
+
+
+def read_sorted_shard(f):
+    '''
+    Iterate the (natural_text key, CSV row) records of a shard file written by merge_shard.
+    :param f: shard file opened with newline=''.
+    :return: generator of (key text, row line)
+    '''
+    for header in f:
+        key_length, line_length = header.split()
+        yield f.read(int(key_length)), f.read(int(line_length))
+
+
+def write_rows(f, gtfs_file, rows):
+    '''
+    Write the GTFS header and rows to an open text file.
+    :param f: writable text file object.
+    :param gtfs_file: GTFS file name, ie., stops, stop_times, trips.
+    :param rows: iterable of rows in header order.
+    :return:
+    '''
+    x = GtfsHeader()
+    f.write('{}\n'.format(x.return_header(gtfs_file)))
+    writer = csv.writer(f, lineterminator='\n')
+    writer.writerows(rows)
 
 
 class GtfsHeader():
@@ -17,6 +197,21 @@ class GtfsHeader():
         config: arguments from a configuration file
     '''
 
+    # GTFS primary key of each file. Rows sharing a key are duplicates (identical) or conflicts (different).
+    primary_keys = {
+        'agency':           ('agency_id',),
+        'calendar':         ('service_id',),
+        'calendar_dates':   ('service_id', 'date'),
+        'fare_attributes':  ('fare_id',),
+        'fare_rules':       ('fare_id', 'route_id', 'origin_id', 'destination_id', 'contains_id'),
+        'feed_info':        ('feed_publisher_name',),
+        'routes':           ('route_id',),
+        'shapes':           ('shape_id', 'shape_pt_sequence'),
+        'stop_times':       ('trip_id', 'stop_sequence'),
+        'stops':            ('stop_id',),
+        'trips':            ('trip_id',),
+    }
+
     def __init__ (self):
         # Anything to init?
         # self.gtfs_filelist = ['agency','calendar','calendar_dates','fare_attributes','fare_rules','feed_info','routes',\
@@ -140,6 +335,22 @@ class GtfsHeader():
             header = self.trips()
         return header
 
+    def columns(self, filename):
+        '''
+        Return the column names of the specified GTFS file, stripped of stray whitespace.
+        :param filename: GTFS file name, ie., stops, stop_times, trips.
+        :return: list of column names in header order.
+        '''
+        return [column.strip() for column in self.return_header(filename).split(',')]
+
+    def primary_key(self, filename):
+        '''
+        Return the primary key column names of the specified GTFS file.
+        :param filename: GTFS file name, ie., stops, stop_times, trips.
+        :return: tuple of column names.
+        '''
+        return self.primary_keys[filename]
+
     def remove_head_line(self, gtfs_file, path):
         """
         Remove and replace GTFS header in a GTFS file.
@@ -170,6 +381,271 @@ class GtfsHeader():
         f.close()
 
 
+class GtfsTable():
+    '''
+    The Table class holds the rows of one GTFS file in a hash index on the file's primary key.
+
+     Attributes:
+        name: gtfs file name (without the 'txt' extension)
+        columns: column names from GtfsHeader
+        key: primary key column names from GtfsHeader
+        rows: dictionary of primary key to row tuple
+        sources: dictionary of primary key to the source (workbook.worksheet) that contributed the row
+        conflicts: list of (key, kept source, rejected source) for rows sharing a key with different values
+        duplicates: count of identical rows dropped
+    '''
+
+    def __init__(self, name):
+        x = GtfsHeader()
+        self.name = name
+        self.columns = x.columns(name)
+        self.key = x.primary_key(name)
+        self._key_index = [self.columns.index(column) for column in self.key]
+        self.rows = {}
+        self.sources = {}
+        self.conflicts = []
+        self.duplicates = 0
+
+    def add(self, row, source=''):
+        '''
+        Add a row to the table. Values are stripped so whitespace differences do not defeat the key.
+            The first row seen for a key is kept; a later different row is recorded as a conflict.
+        :param row: sequence of values in header order.
+        :param source: label of the contributing worksheet, used in conflict reports.
+        :return: True if the row was added.
+        '''
+        row = tuple('{}'.format(value).strip() for value in row)
+        if len(row) < len(self.columns):
+            row = row + ('',) * (len(self.columns) - len(row))
+        elif len(row) > len(self.columns):
+            row = row[:len(self.columns)]
+        key = self.row_key(row)
+
+        existing = self.rows.get(key)
+        if existing is None:
+            self.rows[key] = row
+            self.sources[key] = source
+            return True
+        if existing == row:
+            self.duplicates += 1
+        else:
+            self.conflicts.append((key, self.sources[key], source))
+        return False
+
+    def remove_values(self, column, values):
+        '''
+        Delete the rows whose value in a column is one of the given values, e.g., the stop_times of some trips.
+        :param column: column name.
+        :param values: set of values.
+        :return: number of rows deleted.
+        '''
+        i = self.columns.index(column)
+        keys = [key for key, row in self.rows.items() if row[i] in values]
+        for key in keys:
+            del self.rows[key]
+            self.sources.pop(key, None)
+        return len(keys)
+
+    def row_key(self, row):
+        '''
+        Return the primary key of a row.
+        '''
+        return tuple(row[i] for i in self._key_index)
+
+    def read_rows(self, in_file):
+        '''
+        Iterate the rows of a GTFS text file, skipping the header and blank lines.
+        :param in_file: Path to file.
+        :return: generator of rows as lists of text.
+        '''
+        with open(in_file, 'r', newline='') as f:
+            for row in csv.reader(f):
+                if not row or not ''.join(row).strip():
+                    continue
+                if [value.strip() for value in row] == self.columns:
+                    continue
+                yield row
+
+    def read(self, in_file, source=''):
+        '''
+        Add every row of a GTFS text file to the table, skipping the header and blank lines.
+        :param in_file: Path to file.
+        :param source: label of the contributing worksheet.
+        :return: number of rows read.
+        '''
+        count = 0
+        for row in self.read_rows(in_file):
+            self.add(row, source)
+            count += 1
+        return count
+
+    def sorted_rows(self):
+        '''
+        Return the rows ordered by primary key, numeric runs compared as numbers (natural_text).
+        '''
+        return [self.rows[key] for key in sorted(self.rows, key=natural_text)]
+
+    def write(self, path):
+        '''
+        Write the table to <path>/<name>.txt with its GTFS header, ordered by primary key.
+        :param path: output directory.
+        :return: path of the written file.
+        '''
+        if not os.path.exists(path):
+            os.makedirs(path)
+        gtfs_file = os.path.join(path, '{}.txt'.format(self.name))
+        with open(gtfs_file, 'w', newline='') as f:
+            self.serialize(f)
+        return gtfs_file
+
+    def serialize(self, f):
+        '''
+        Write the GTFS header and the key-ordered rows to an open text file.
+        :param f: writable text file object.
+        :return:
+        '''
+        write_rows(f, self.name, self.sorted_rows())
+
+
+class MergeIndex():
+    '''
+    The MergeIndex class keeps the state of the incremental merge in the SQLite database
+        <gtfs_path_root>/merge_index.sqlite: the manifest and order of every merged worksheet and, per GTFS file,
+        the rendered row each worksheet supplied for each key. Rows are indexed by source, so withdrawing a
+        worksheet touches only its own rows, and by the key's natural order, so a master file is rendered by
+        reading the index in order. The row of a key is the one of the first worksheet, in workbook/worksheet
+        order, that supplies it, as in the full merge; the other worksheets' different rows are conflicts.
+
+     Attributes:
+        db_file: path of the index database
+    '''
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        path = os.path.dirname(db_file)
+        if path and not os.path.exists(path):
+            os.makedirs(path)
+        with self.connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS sources (source TEXT PRIMARY KEY, position INTEGER, '
+                               'manifest TEXT)')
+            connection.execute('CREATE TABLE IF NOT EXISTS rows (gtfs_file TEXT, key TEXT, sort_key TEXT, '
+                               'position INTEGER, source TEXT, line TEXT, PRIMARY KEY (gtfs_file, key, source))')
+            connection.execute('CREATE INDEX IF NOT EXISTS rows_order ON rows (gtfs_file, sort_key, position)')
+            connection.execute('CREATE INDEX IF NOT EXISTS rows_source ON rows (gtfs_file, source)')
+            # Conflicts within a worksheet have kept = rejected = the worksheet.
+            connection.execute('CREATE TABLE IF NOT EXISTS conflicts (gtfs_file TEXT, key TEXT, kept TEXT, '
+                               'rejected TEXT)')
+            connection.execute('CREATE INDEX IF NOT EXISTS conflicts_key ON conflicts (gtfs_file, key)')
+
+    def connect(self):
+        return sqlite3.connect(self.db_file, timeout=60)
+
+    def manifests(self):
+        '''
+        Manifests of the worksheets merged last, in workbook/worksheet order.
+        :return: dictionary of source (workbook.worksheet) to manifest
+        '''
+        with self.connect() as connection:
+            return dict((source, json.loads(manifest)) for source, manifest in
+                        connection.execute('SELECT source, manifest FROM sources ORDER BY position'))
+
+    def set_manifests(self, manifests):
+        '''
+        Record the worksheets of this merge in order. Worksheets that moved get their rows' position updated.
+        :param manifests: dictionary of source to manifest, in workbook/worksheet order
+        :return: True if a worksheet merged before moved, so keys supplied by several worksheets may change rows.
+        '''
+        moved = False
+        with self.connect() as connection:
+            positions = dict(connection.execute('SELECT source, position FROM sources'))
+            connection.execute('DELETE FROM sources')
+            for position, (source, manifest) in enumerate(manifests.items()):
+                connection.execute('INSERT INTO sources (source, position, manifest) VALUES (?, ?, ?)',
+                                   (source, position, json.dumps(manifest, sort_keys=True)))
+                if source in positions and positions[source] != position:
+                    connection.execute('UPDATE rows SET position = ? WHERE source = ?', (position, source))
+                    moved = True
+        return moved
+
+    def replace(self, gtfs_file, sources, tables, positions, moved=False):
+        '''
+        Withdraw the rows of the given worksheets, add the rows they supply now and settle the conflicts of the
+            keys involved.
+        :param gtfs_file: GTFS file name
+        :param sources: set of sources whose rows are withdrawn, changed and removed worksheets
+        :param tables: dictionary of changed source to its GtfsTable of this file
+        :param positions: dictionary of source to its position in workbook/worksheet order
+        :param moved: worksheets moved; the conflicts of every key supplied more than once are settled again
+        :return: (rows withdrawn, rows added)
+        '''
+        keys = set()
+        withdrawn = 0
+        added = 0
+        with self.connect() as connection:
+            for source in sources:
+                keys.update(key for key, in connection.execute(
+                    'SELECT key FROM rows WHERE gtfs_file = ? AND source = ?', (gtfs_file, source)))
+                withdrawn += connection.execute('DELETE FROM rows WHERE gtfs_file = ? AND source = ?',
+                                                (gtfs_file, source)).rowcount
+                connection.execute('DELETE FROM conflicts WHERE gtfs_file = ? AND kept = ? AND rejected = ?',
+                                   (gtfs_file, source, source))
+            lines = _Lines()
+            writer = csv.writer(lines, lineterminator='\n')
+            for source, table in tables.items():
+                records = []
+                for key, row in table.rows.items():
+                    writer.writerow(row)
+                    records.append((gtfs_file, '\x1f'.join(key), natural_text(key), positions[source], source,
+                                    lines.pop()))
+                connection.executemany('INSERT INTO rows (gtfs_file, key, sort_key, position, source, line) '
+                                       'VALUES (?, ?, ?, ?, ?, ?)', records)
+                connection.executemany('INSERT INTO conflicts (gtfs_file, key, kept, rejected) VALUES (?, ?, ?, ?)',
+                                       [(gtfs_file, '\x1f'.join(key), kept, rejected)
+                                        for key, kept, rejected in table.conflicts])
+                keys.update(record[1] for record in records)
+                added += len(records)
+            if moved:
+                keys.update(key for key, in connection.execute(
+                    'SELECT key FROM rows WHERE gtfs_file = ? GROUP BY key HAVING COUNT(*) > 1', (gtfs_file,)))
+            for key in keys:
+                connection.execute('DELETE FROM conflicts WHERE gtfs_file = ? AND key = ? AND kept != rejected',
+                                   (gtfs_file, key))
+                rows = connection.execute('SELECT source, line FROM rows WHERE gtfs_file = ? AND key = ? '
+                                          'ORDER BY position', (gtfs_file, key)).fetchall()
+                connection.executemany('INSERT INTO conflicts (gtfs_file, key, kept, rejected) VALUES (?, ?, ?, ?)',
+                                       [(gtfs_file, key, rows[0][0], source)
+                                        for source, line in rows[1:] if line != rows[0][1]])
+        return withdrawn, added
+
+    def render(self, gtfs_file, f):
+        '''
+        Write the master file to an open text file: the header, then the row of every key in key order.
+        :param gtfs_file: GTFS file name
+        :param f: writable text file object.
+        :return: number of rows written.
+        '''
+        f.write('{}\n'.format(GtfsHeader().return_header(gtfs_file)))
+        rows = 0
+        last = None
+        with self.connect() as connection:
+            for key, line in connection.execute('SELECT key, line FROM rows WHERE gtfs_file = ? '
+                                                'ORDER BY sort_key, position', (gtfs_file,)):
+                if key != last:
+                    f.write(line)
+                    rows += 1
+                    last = key
+        return rows
+
+    def conflicts(self):
+        '''
+        Key conflicts of every file.
+        :return: list of (gtfs file, key, kept source, rejected source)
+        '''
+        with self.connect() as connection:
+            return [(gtfs_file, tuple(key.split('\x1f')), kept, rejected) for gtfs_file, key, kept, rejected in
+                    connection.execute('SELECT gtfs_file, key, kept, rejected FROM conflicts')]
+
+
 class GtfsWrite():
     '''
     The Write class manipulates GTFS files.
@@ -187,6 +663,8 @@ class GtfsWrite():
         """
         self.gtfs_filelist = ['agency','calendar','calendar_dates','fare_attributes','fare_rules','feed_info','routes',\
                  'shapes','stop_times','stops','trips']
+        # Largest files; the parallel merge partitions them by trip_id / shape_id.
+        self.sharded_filelist = ['stop_times', 'shapes']
         self.agency_format = '{},{},{},{},{},{}'
         self.calendar_format = '{},{},{},{},{},{},{},{},{},{}'
         self.calendar_dates_format = '{},{},{}'
@@ -219,7 +697,7 @@ class GtfsWrite():
             out.write(line)
         out.close()
 
-    def merge_files(self, wrkbk_dict, configs):
+    def merge_files(self, wrkbk_dict, configs, static_tables=None):
         '''
         Combine feed files from each worksheet process.
         1. Identical feed files that require no action:
@@ -237,60 +715,299 @@ class GtfsWrite():
             c. calendar_dates.txt
             c. routes.txt
             Combine individual GTFS files from wrkbk_dict.
-                module 'fileinput'
+        Each file is deduplicated on its GTFS primary key (GtfsHeader.primary_keys) and written ordered by key,
+            numeric runs sorted as numbers. Rows sharing a key with different values are reported as conflicts.
         :param wrkbk_dict: Dictionary of workbook/worksheet pairs.
+        :param static_tables: StaticTables rendered for this run. Its files are written as rendered instead of
+            being read back from every worksheet.
+        The master files are streamed into the master <agency_id>.zip.
         :return:
         '''
 
         gtfs_filelist = ['agency','calendar','calendar_dates','fare_attributes','fare_rules','feed_info','routes','shapes',
                      'stop_times','stops','trips']
 
+        out_path = os.path.expanduser(configs.gtfs_path_root)
+        if not os.path.exists(out_path):
+            os.makedirs(out_path)
+        conflicts = []
+        inputs = {}
+
         for gtfs_file in gtfs_filelist:
 
-            gtfs_tmp = '{}.tmp'.format(gtfs_file)
-            out_path = os.path.expanduser(configs.gtfs_path_root)
-            out_tmp = os.path.join(out_path, gtfs_tmp)
-            gtfs_master = '{}.txt'.format(gtfs_file)
+            if static_tables is not None and gtfs_file in static_tables.content:
+                with open(os.path.join(out_path, '{}.txt'.format(gtfs_file)), 'wb') as f:
+                    f.write(static_tables.content[gtfs_file])
+                print('{}: rows:{} (static, feed_version {})'.format(gtfs_file, len(static_tables.tables[gtfs_file].rows),
+                                                                     static_tables.feed_version))
+                continue
 
-            # Combine gtfs_files for all wrkbk_dict
-            # ref:http://stackoverflow.com/questions/13613336/python-concatenate-text-files
-            # ref os glob tool: http://www.diveintopython3.net/comprehensions.html
+            inputs[gtfs_file] = self.merge_inputs(gtfs_file, wrkbk_dict, configs)
 
-            for key, value in wrkbk_dict.items(): #iterate across workbooks
-                if configs.verbose:
-                    print('Combine workbook {} with {} worksheets:'.format(key, len(wrkbk_dict[key])))
-                # iterate across worksheets in workbook for each gtfs file
-                for i in range(len(value)):
+        # With more than one worker, each file's merge runs on a process pool and the largest files are sharded:
+        #   runs of worksheet files are read once and partitioned by trip_id / shape_id, each shard is merged and
+        #   sorted by its own task, and the sorted shards are streamed into the master file here.
+        workers = int(configs.merge_workers) if configs.merge_workers else 1
+        results = []
+
+        if workers > 1:
+            part_dir = tempfile.mkdtemp(prefix='.merge_', dir=out_path)
+            try:
+                with span(configs, 'merge_tables', files=len(inputs), workers=workers), \
+                        ProcessPoolExecutor(max_workers=workers) as pool:
+                    partitions = {}
+                    futures = []
+                    # Start the largest files first so the pool finishes near the cost of the largest one.
+                    for gtfs_file in self.sharded_filelist:
+                        if gtfs_file in inputs:
+                            partitions[gtfs_file] = [
+                                pool.submit(partition_table, gtfs_file, run, workers, part_dir, part)
+                                for part, run in enumerate(self.input_runs(inputs[gtfs_file], workers))]
+                    for gtfs_file, table_inputs in inputs.items():
+                        if gtfs_file not in partitions:
+                            futures.append(pool.submit(merge_table, gtfs_file, table_inputs,
+                                                       os.path.join(out_path, '{}.txt'.format(gtfs_file))))
+                    shard_files = {}
+                    for gtfs_file, parts in partitions.items():
+                        part_files = [part.result() for part in parts]
+                        shard_files[gtfs_file] = [os.path.join(part_dir, '{}.{}.sorted'.format(gtfs_file, shard))
+                                                  for shard in range(workers)]
+                        for shard in range(workers):
+                            futures.append(pool.submit(merge_shard, gtfs_file, [files[shard] for files in part_files],
+                                                       shard_files[gtfs_file][shard]))
                     if configs.verbose:
-                        print('Retreive Workbook:{} Worksheet:{} GTFS file:{}.txt'.format(key,value[i], gtfs_file))
+                        print('Merging {} files on {} worker processes.'.format(len(inputs), workers))
+                    results = [future.result() for future in futures]
+
+                # Shards partition the keys, so merging them in key order gives output independent of the worker count.
+                for gtfs_file, sorted_files in shard_files.items():
+                    shards = [open(sorted_file, 'r', newline='') for sorted_file in sorted_files]
+                    try:
+                        with span(configs, 'merge_render', table=gtfs_file), \
+                                open(os.path.join(out_path, '{}.txt'.format(gtfs_file)), 'w', newline='') as f:
+                            f.write('{}\n'.format(GtfsHeader().return_header(gtfs_file)))
+                            for sort_text, line in heapq.merge(*[read_sorted_shard(shard) for shard in shards]):
+                                f.write(line)
+                    finally:
+                        for shard in shards:
+                            shard.close()
+            finally:
+                shutil.rmtree(part_dir, ignore_errors=True)
+        else:
+            # merge_table renders each master file as it merges it.
+            with span(configs, 'merge_tables', files=len(inputs), workers=workers):
+                for gtfs_file, table_inputs in inputs.items():
+                    results.append(merge_table(gtfs_file, table_inputs,
+                                               os.path.join(out_path, '{}.txt'.format(gtfs_file))))
+
+        merged = {}
+        for gtfs_file, rows, duplicates, table_conflicts in results:
+            merged.setdefault(gtfs_file, []).append((rows, duplicates, table_conflicts))
+
+        for gtfs_file in gtfs_filelist:
+            if gtfs_file not in merged:
+                continue
+            parts = merged[gtfs_file]
+            table_conflicts = []
+            for part in parts:
+                table_conflicts.extend(part[2])
+            print('{}: rows:{} duplicates removed:{} key conflicts:{}'.format(
+                gtfs_file, sum(part[0] for part in parts), sum(part[1] for part in parts), len(table_conflicts)))
+            for conflict in table_conflicts:
+                conflicts.append((gtfs_file,) + conflict)
+
+        self.write_conflicts(conflicts, configs)
+        self.write_feed_zip(configs)
+
+    def input_runs(self, inputs, runs):
+        """
+        Split a file's inputs into contiguous runs of about equal size, one partition task each. Runs keep worksheet
+            order, so reading a shard's partition files in run order keeps the first row of each key.
+        :param inputs: list of (input file path, source label) in worksheet order.
+        :param runs: maximum number of runs.
+        :return: list of non-empty lists of inputs.
+        """
+        sizes = [os.path.getsize(infile) for infile, source in inputs]
+        target = float(sum(sizes)) / runs
+        split = [[]]
+        total = 0
+        for entry, size in zip(inputs, sizes):
+            if split[-1] and total >= target * len(split) and len(split) < runs:
+                split.append([])
+            split[-1].append(entry)
+            total += size
+        return [run for run in split if run]
+
+    def file_manifest(self, input_dir):
+        """
+        Content hash and row count of every GTFS file in a worksheet directory.
+        :param input_dir: worksheet directory, gtfs_path_root/workbook/worksheet.
+        :return: dictionary of gtfs file name to {'sha256', 'rows'}
+        """
+        manifest = {}
+        for gtfs_file in self.gtfs_filelist:
+            infile = os.path.join(input_dir, '{}.txt'.format(gtfs_file))
+            if not os.path.isfile(infile):
+                continue
+            with open(infile, 'rb') as f:
+                content = f.read()
+            manifest[gtfs_file] = {'sha256': hashlib.sha256(content).hexdigest(),
+                                   'rows': max(content.count(b'\n') - 1, 0)}
+        return manifest
 
-                    # Construct the input file path to trip group locations - e.g., gtfs/workbook/worksheet/gtfs.txt.
-                    input_dir = os.path.join(os.path.expanduser(configs.gtfs_path_root), key, value[i] )
-                    infile = os.path.join(input_dir, '{}.txt'.format(gtfs_file))
+    def write_manifest(self, input_dir):
+        """
+        Record the worksheet's manifest.json after a build. Read by the incremental merge.
+        :param input_dir: worksheet directory.
+        :return: the manifest
+        """
+        manifest = self.file_manifest(input_dir)
+        with open(os.path.join(input_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        return manifest
 
-                    # Combine lines in fin and fout
+    def read_manifest(self, input_dir):
+        """
+        Read a worksheet's manifest.json, computing it when the build did not record one.
+        :param input_dir: worksheet directory.
+        :return: the manifest
+        """
+        manifest_file = os.path.join(input_dir, 'manifest.json')
+        if os.path.isfile(manifest_file):
+            with open(manifest_file) as f:
+                return json.load(f)
+        return self.write_manifest(input_dir)
+
+    def merge_files_incremental(self, wrkbk_dict, configs, static_tables=None):
+        """
+        Update the master files from the worksheets whose manifest changed since the last merge.
+            merge_index.sqlite in gtfs_path_root keeps each worksheet's manifest and the rows it supplied, see
+            MergeIndex. The rows of changed or removed worksheets are withdrawn and the changed worksheets' files
+            are read again; the other worksheets are not read. A changed master file is rendered from the index, so
+            it holds the rows a full merge of the current worksheets would; files no worksheet changed are left
+            as they are. Without an index every worksheet is read.
+        :param wrkbk_dict: Dictionary of workbook/worksheet pairs.
+        :param configs: arguments from the configuration file.
+        :param static_tables: StaticTables rendered for this run, or None.
+        :return:
+        """
+        out_path = os.path.expanduser(configs.gtfs_path_root)
+        index = MergeIndex(os.path.join(out_path, 'merge_index.sqlite'))
+
+        manifests = {}
+        input_dirs = {}
+        for key, value in wrkbk_dict.items():
+            for worksheet in value:
+                input_dir = os.path.join(out_path, key, worksheet)
+                if os.path.isdir(input_dir):
+                    source = '{}.{}'.format(key, worksheet)
+                    manifests[source] = self.read_manifest(input_dir)
+                    input_dirs[source] = input_dir
+
+        previous = index.manifests()
+        if not previous:
+            print('No merge index in {}, merging all worksheets.'.format(out_path))
+        moved = index.set_manifests(manifests)
+        positions = dict((source, i) for i, source in enumerate(manifests))
+
+        for gtfs_file in self.gtfs_filelist:
+
+            if static_tables is not None and gtfs_file in static_tables.content:
+                with open(os.path.join(out_path, '{}.txt'.format(gtfs_file)), 'wb') as f:
+                    f.write(static_tables.content[gtfs_file])
+                continue
+
+            master = os.path.join(out_path, '{}.txt'.format(gtfs_file))
+
+            # Worksheets whose copy of this file changed, appeared or disappeared.
+            changed = set(source for source, manifest in manifests.items()
+                          if previous.get(source, {}).get(gtfs_file) != manifest.get(gtfs_file))
+            removed = set(source for source in previous if source not in manifests and gtfs_file in previous[source])
+            if not changed and not removed and not moved and os.path.isfile(master):
+                if configs.verbose:
+                    print('{}: unchanged.'.format(gtfs_file))
+                continue
+
+            with span(configs, 'merge_tables', table=gtfs_file):
+                tables = {}
+                for source in changed:
+                    tables[source] = GtfsTable(gtfs_file)
+                    infile = os.path.join(input_dirs[source], '{}.txt'.format(gtfs_file))
                     if os.path.isfile(infile):
-                        with open(out_tmp, 'a') as fout, fileinput.input(infile) as fin:
-                            for line in fin:
-                                fout.write(line)
-                            fout.close()
-                fout = open(out_tmp, 'a')
-
-            # Remove duplicate lines, remove headers.
-            x = GtfsHeader()
-            x.remove_head_line(gtfs_file, out_path)
+                        tables[source].read(infile, source)
+                withdrawn, added = index.replace(gtfs_file, changed | removed, tables, positions, moved)
+            with span(configs, 'merge_render', table=gtfs_file), open(master, 'w', newline='') as f:
+                rows = index.render(gtfs_file, f)
+
+            print('{}: worksheets re-read:{} removed:{} rows withdrawn:{} rows read:{} rows:{}'.format(
+                gtfs_file, len(changed), len(removed), withdrawn, added, rows))
+
+        self.write_conflicts(index.conflicts(), configs)
+        self.write_feed_zip(configs)
+
+    def write_feed_zip(self, configs):
+        """
+        Stream the master files into the master <agency_id>.zip in gtfs_path_root. The archive is left as is when
+            its content and compression level are unchanged.
+        :param configs: arguments from the configuration file.
+        :return: True if the archive was written.
+        """
+        out_path = os.path.expanduser(configs.gtfs_path_root)
+        zip_file = os.path.join(out_path, configs.agency_id + '.zip')
+        with span(configs, 'merge_zip', feed=configs.agency_id):
+            zfile = FeedZip(zip_file, configs.zip_level, configs.zip_threads)
+            for gtfs_file in self.gtfs_filelist:
+                master = os.path.join(out_path, '{}.txt'.format(gtfs_file))
+                if os.path.isfile(master):
+                    zfile.add('{}.txt'.format(gtfs_file), master)
+            written = zfile.close()
+        print('{} {}.'.format(zip_file, 'written' if written else 'unchanged, not rewritten'))
+        return written
+
+    def merge_inputs(self, gtfs_file, wrkbk_dict, configs):
+        """
+        List the worksheet files of one GTFS file in workbook/worksheet order.
+        :param gtfs_file: GTFS file name, ie., stops, stop_times, trips.
+        :param wrkbk_dict: Dictionary of workbook/worksheet pairs.
+        :param configs: arguments from the configuration file.
+        :return: list of (input file path, source label)
+        """
+        inputs = []
+        for key, value in wrkbk_dict.items(): #iterate across workbooks
             if configs.verbose:
-                print('Removing duplicate lines from {}.'.format(gtfs_tmp))
-            GtfsWrite.remove_dup_lines(self, os.path.join(out_path, gtfs_tmp))
-            fout.close()
+                print('Combine workbook {} with {} worksheets:'.format(key, len(wrkbk_dict[key])))
+            # iterate across worksheets in workbook for each gtfs file
+            for i in range(len(value)):
+                if configs.verbose:
+                    print('Retreive Workbook:{} Worksheet:{} GTFS file:{}.txt'.format(key,value[i], gtfs_file))
+
+                # Construct the input file path to trip group locations - e.g., gtfs/workbook/worksheet/gtfs.txt.
+                input_dir = os.path.join(os.path.expanduser(configs.gtfs_path_root), key, value[i] )
+                infile = os.path.join(input_dir, '{}.txt'.format(gtfs_file))
 
-            x.write_header(gtfs_file, out_path)
-            with open(os.path.join(out_path, gtfs_master), 'a') as fout, fileinput.input(os.path.join(out_path, gtfs_tmp), 'r') as fin:
-                for line in fin:
-                    fout.write(line)
-                fout.close()
+                if os.path.isfile(infile):
+                    inputs.append((infile, '{}.{}'.format(key, value[i])))
+        return inputs
 
-            os.remove(os.path.join(out_path, '{}.tmp'.format(gtfs_file)))
+    def write_conflicts(self, conflicts, configs):
+        """
+        Write the primary key conflicts found by the merge to merge_conflicts.txt in the report path.
+        :param conflicts: list of (gtfs file, key, kept source, rejected source)
+        :param configs: arguments from the configuration file.
+        :return:
+        """
+        report_path = os.path.expanduser(configs.report_path)
+        if not os.path.exists(report_path):
+            os.makedirs(report_path)
+        f = open(os.path.join(report_path, 'merge_conflicts.txt'), 'w')
+        f.write('Primary key conflicts:{}\n'.format(len(conflicts)))
+        # Report order does not depend on the order shards finished in.
+        conflicts = sorted(conflicts, key=lambda conflict: (conflict[0], natural_text(conflict[1]), conflict[2], conflict[3]))
+        for gtfs_file, key, kept, rejected in conflicts:
+            f.write('{}.txt key:{} kept:{} rejected:{}\n'.format(gtfs_file, ','.join(key), kept, rejected))
+        f.close()
+        if conflicts:
+            print('>>> {} primary key conflicts written to {}.'.format(len(conflicts), os.path.join(report_path, 'merge_conflicts.txt')))
 
     def write_agency_file(workbook, worksheet_title, configs):
         '''
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import json
+import os
+import time
+
+
+def escape_label(value):
+    '''
+    A Prometheus label value, with backslash, double quote and line feed escaped.
+    '''
+    return '{}'.format(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_atomic(path, text):
+    '''
+    Write a file through a temporary file in the same directory, so a collector never reads half of it.
+    '''
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(text)
+    os.replace(tmp_file, path)
+
+
+class RunMetrics():
+    '''
+    The RunMetrics class collects the measurements of a generate run for monitoring: stage durations, rows per
+        table, shape points and bytes written, from the spans of the run's trace, labeled by workbook; cache hit
+        rates; validation issue and exception counts; and the size of the agency zip. At the end of the run they
+        are written as a JSON summary, a Prometheus textfile for the node_exporter textfile collector, and a line
+        appended to a JSON lines history so builds can be trended without Prometheus.
+
+     Attributes:
+        agency: agency_id, the agency label of every metric
+        started: wall clock time the run started, seconds since the epoch
+        result: 0, or 1 if the feed was not merged
+        duration: seconds of the run
+        stages: dictionary of (workbook, stage) to {'spans', 'seconds', 'rows', 'bytes', 'peak_memory'}
+        tables: dictionary of (workbook, GTFS file) to rows
+        caches: dictionary of cache name to {'hits', 'misses', ...}
+        validation: dictionary of severity to count
+        exceptions: dictionary of exception code to count
+        zip_bytes: size of the agency zip, or None
+    '''
+
+    def __init__(self, agency):
+        self.agency = agency
+        self.started = time.time()
+        self.result = None
+        self.duration = None
+        self.stages = {}
+        self.tables = {}
+        self.caches = {}
+        self.validation = {}
+        self.exceptions = {}
+        self.zip_bytes = None
+
+    def add_trace(self, records):
+        '''
+        Sum the stage spans of a run's trace, and the counters of every span, by workbook. A span is labeled
+            with the workbook span it is, or is nested in, or '' for spans of the whole feed, ie., merge and validate.
+        :param records: span dictionaries, Tracer.records()
+        :return:
+        '''
+        spans = dict((record['id'], record) for record in records)
+        for record in records:
+            if record['kind'] == 'run':
+                self.duration = record['ms'] / 1000.0
+            workbook = ''
+            parent = record
+            while parent is not None:
+                if parent['kind'] == 'workbook':
+                    workbook = parent['name']
+                    break
+                parent = spans.get(parent['parent'])
+            self.add_counts(workbook, record.get('counts', {}))
+            if record['kind'] != 'stage':
+                continue
+            stage = self.stages.setdefault((workbook, record['name']), {'spans': 0, 'seconds': 0.0, 'rows': 0,
+                                                                         'bytes': 0, 'peak_memory': None})
+            stage['spans'] += 1
+            stage['seconds'] += record['ms'] / 1000.0
+            stage['rows'] += record['rows']
+            stage['bytes'] += record['bytes']
+            if record.get('memory') is not None:
+                stage['peak_memory'] = max(stage['peak_memory'] or 0, record['memory']['peak'])
+
+    def add_counts(self, workbook, counts):
+        '''
+        Add span counters: rows.<GTFS file> to the workbook's table rows, <cache>.hits and <cache>.misses to the
+            cache's counters.
+        '''
+        for name, value in counts.items():
+            if name.startswith('rows.'):
+                key = (workbook, name[len('rows.'):])
+                self.tables[key] = self.tables.get(key, 0) + value
+            elif '.' in name:
+                cache, counter = name.split('.', 1)
+                counters = self.caches.setdefault(cache, {'hits': 0, 'misses': 0})
+                counters[counter] = counters.get(counter, 0) + value
+
+    def add_cache(self, name, hits, misses, **counters):
+        counters.update({'hits': hits, 'misses': misses})
+        self.caches[name] = counters
+
+    def summary(self):
+        '''
+        The run's metrics as a JSON-serializable dictionary.
+        '''
+        caches = {}
+        for name, counters in sorted(self.caches.items()):
+            lookups = counters['hits'] + counters['misses']
+            caches[name] = dict(counters, hit_rate=round(counters['hits'] / lookups, 4) if lookups else None)
+        return {
+            'agency': self.agency,
+            'started': round(self.started, 3),
+            'result': self.result,
+            'duration_seconds': round(self.duration, 3) if self.duration is not None else None,
+            'stages': [dict(stage, workbook=workbook, stage=name, seconds=round(stage['seconds'], 6))
+                       for (workbook, name), stage in sorted(self.stages.items())],
+            'tables': [{'workbook': workbook, 'table': table, 'rows': rows}
+                       for (workbook, table), rows in sorted(self.tables.items())],
+            'shape_points': sum(rows for (workbook, table), rows in self.tables.items() if table == 'shapes'),
+            'bytes_written': sum(stage['bytes'] for stage in self.stages.values()),
+            'caches': caches,
+            'validation': dict(self.validation),
+            'exceptions': dict(self.exceptions),
+            'feed_zip_bytes': self.zip_bytes,
+        }
+
+    def prometheus(self):
+        '''
+        The run's metrics in the Prometheus text exposition format. Every metric is a gauge of the last run.
+        :return: str
+        '''
+        summary = self.summary()
+        lines = []
+
+        def metric(name, help_text, samples):
+            samples = [(labels, value) for labels, value in samples if value is not None]
+            if not samples:
+                return
+            lines.append('# HELP gtfsgenerator_{} {}'.format(name, help_text))
+            lines.append('# TYPE gtfsgenerator_{} gauge'.format(name))
+            for labels, value in samples:
+                labels = dict(labels, agency=self.agency)
+                lines.append('gtfsgenerator_{}{{{}}} {}'.format(name, ','.join(
+                    '{}="{}"'.format(key, escape_label(labels[key])) for key in sorted(labels)), value))
+
+        metric('run_timestamp_seconds', 'Time the last run started.', [({}, summary['started'])])
+        metric('run_duration_seconds', 'Duration of the last run.', [({}, summary['duration_seconds'])])
+        metric('run_result', 'Result of the last run: 0 merged, 1 not merged.', [({}, summary['result'])])
+        stages = summary['stages']
+        metric('stage_duration_seconds', 'Seconds spent in a stage, summed over its spans.',
+               [({'workbook': stage['workbook'], 'stage': stage['stage']}, stage['seconds']) for stage in stages])
+        metric('stage_spans', 'Spans of a stage, ie., worksheets it ran for.',
+               [({'workbook': stage['workbook'], 'stage': stage['stage']}, stage['spans']) for stage in stages])
+        metric('stage_peak_memory_bytes', 'Peak memory traced in a stage, with --memory.',
+               [({'workbook': stage['workbook'], 'stage': stage['stage']}, stage['peak_memory'])
+                for stage in stages])
+        metric('table_rows', 'Rows of a GTFS table built from a workbook.',
+               [({'workbook': table['workbook'], 'table': table['table']}, table['rows'])
+                for table in summary['tables']])
+        metric('shape_points', 'Points of the shapes built from a workbook.',
+               [({'workbook': table['workbook']}, table['rows'])
+                for table in summary['tables'] if table['table'] == 'shapes'])
+        workbooks = {}
+        for stage in stages:
+            workbooks[stage['workbook']] = workbooks.get(stage['workbook'], 0) + stage['bytes']
+        metric('bytes_written', 'Bytes of feed files and zips written.',
+               [({'workbook': workbook}, written) for workbook, written in sorted(workbooks.items())])
+        metric('feed_zip_bytes', 'Size of the agency zip.', [({}, summary['feed_zip_bytes'])])
+        for counter in ('hits', 'misses', 'hit_rate'):
+            metric('cache_{}'.format(counter), 'Cache {} in the last run.'.format(counter.replace('_', ' ')),
+                   [({'cache': name}, counters[counter]) for name, counters in sorted(summary['caches'].items())])
+        metric('validation_issues', 'Issues reported by the feed validator, by severity.',
+               [({'severity': severity}, count) for severity, count in sorted(summary['validation'].items())])
+        metric('exceptions', 'Exceptions of the last run, by code.',
+               [({'code': code}, count) for code, count in sorted(summary['exceptions'].items())])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_file, prom_file, history_file=None):
+        '''
+        Write the JSON summary and the Prometheus textfile, and append the summary to history_file.
+        :return:
+        '''
+        summary = self.summary()
+        write_atomic(json_file, json.dumps(summary, indent=1, sort_keys=True) + '\n')
+        write_atomic(prom_file, self.prometheus())
+        if history_file is not None:
+            with open(history_file, 'a') as f:
+                f.write(json.dumps(summary, sort_keys=True) + '\n')
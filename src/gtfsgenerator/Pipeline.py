@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import asyncio
+import time
+
+
+class Stage():
+    '''
+    The Stage class is one step of a Pipeline.
+
+     Attributes:
+        name: stage name used in the utilization report
+        func: coroutine function, or with an executor a plain function, taking and returning a work item
+        workers: items the stage works on at once
+        executor: concurrent.futures executor running func, or None when func is a coroutine function
+        queue_size: bound of the queue feeding the stage; a full queue holds back the stage before it
+        busy: seconds spent working on items, summed over workers
+        items: items completed
+    '''
+
+    def __init__(self, name, func, workers=1, executor=None, queue_size=2):
+        self.name = name
+        self.func = func
+        self.workers = max(int(workers), 1)
+        self.executor = executor
+        self.queue_size = max(int(queue_size), 1)
+        self.busy = 0.0
+        self.items = 0
+
+    async def process(self, item):
+        if self.executor is None:
+            return await self.func(item)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.func, item)
+
+
+class Pipeline():
+    '''
+    The Pipeline class passes work items through stages connected by bounded asyncio queues. Every stage runs
+        its own workers, so a network stage can fetch while CPU stages build and subprocess stages validate.
+
+     Attributes:
+        stages: list of Stage
+        elapsed: wall seconds of the last run
+    '''
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.elapsed = 0.0
+
+    def run(self, items):
+        '''
+        Run the items through every stage.
+        :param items: list of work items
+        :return: the processed items, in input order
+        '''
+        return asyncio.run(self._run(list(items)))
+
+    async def _run(self, items):
+        start = time.time()
+        queues = [asyncio.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        results = {}
+
+        async def feed():
+            for i, item in enumerate(items):
+                await queues[0].put((i, item))
+            for worker in range(self.stages[0].workers):
+                await queues[0].put(None)
+
+        async def work(n, stage):
+            while True:
+                entry = await queues[n].get()
+                if entry is None:
+                    return
+                i, item = entry
+                begin = time.time()
+                item = await stage.process(item)
+                stage.busy += time.time() - begin
+                stage.items += 1
+                if n + 1 < len(self.stages):
+                    await queues[n + 1].put((i, item))
+                else:
+                    results[i] = item
+
+        async def run_stage(n, stage):
+            await asyncio.gather(*[work(n, stage) for worker in range(stage.workers)])
+            # Every worker of this stage is done; stop the workers of the next one.
+            if n + 1 < len(self.stages):
+                for worker in range(self.stages[n + 1].workers):
+                    await queues[n + 1].put(None)
+
+        tasks = [asyncio.ensure_future(feed())]
+        tasks += [asyncio.ensure_future(run_stage(n, stage)) for n, stage in enumerate(self.stages)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        self.elapsed = time.time() - start
+        return [results[i] for i in range(len(items))]
+
+    def report(self):
+        '''
+        Utilization of every stage: busy time over the run's wall time times the stage's workers.
+            The stage nearest 100% is the bottleneck.
+        :return: list of report lines
+        '''
+        lines = []
+        for stage in self.stages:
+            utilization = stage.busy / (self.elapsed * stage.workers) if self.elapsed else 0.0
+            lines.append('{:<10} workers:{} items:{} busy:{:.2f}s per item:{:.3f}s utilization:{:.0%}'.format(
+                stage.name, stage.workers, stage.items, stage.busy,
+                stage.busy / stage.items if stage.items else 0.0, utilization))
+        return lines
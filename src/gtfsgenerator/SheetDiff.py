@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+
+# Worksheet data layout: rows 0 and 1 hold route, calendar and trip information, row 2 the trip headings, the rest
+# one stop each. Trip times are in the columns from first_trip_column on.
+first_stop_row = 3
+first_trip_column = 27
+
+
+def cell(ws_data, i, j):
+    '''
+    Value of a cell; Google drops trailing empty cells, so a missing cell is ''.
+    '''
+    if i < len(ws_data) and j < len(ws_data[i]):
+        return ws_data[i][j]
+    return ''
+
+
+def trip_range(stops_column_list):
+    '''
+    Trip columns built by write_stop_times_file.
+    '''
+    return range(first_trip_column, int(stops_column_list[-1]))
+
+
+def trip_id(workbook_title, ws_data, j):
+    '''
+    trip_id of the trip in column j, as write_stop_times_file builds it.
+    '''
+    return '{}-{}-{}'.format(workbook_title, cell(ws_data, 1, 20), cell(ws_data, 2, j))
+
+
+class SheetDiff():
+    '''
+    The SheetDiff class compares two snapshots of a worksheet's data, cell by cell, and classifies the changes:
+        the static header (route, calendar and trip information, trip headings of the stop columns), the stop rows
+        (added or removed stops, stop information) or specific trip columns (a trip's heading or times, added or
+        removed trips).
+
+     Attributes:
+        old: [row_list, stops_column_list, ws_data] of the last build
+        new: [row_list, stops_column_list, ws_data] just fetched
+        header: the static header changed
+        stops: the stop rows changed
+        trips: trip columns with a changed cell, sorted
+    '''
+
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+        self.header = False
+        self.stops = False
+        self.trips = []
+        self.compare()
+
+    def compare(self):
+        old_rows, old_columns, old_data = self.old
+        new_rows, new_columns, new_data = self.new
+
+        # Stops added or removed move every row below them.
+        if list(old_rows) != list(new_rows) or len(old_data) != len(new_data):
+            self.stops = True
+            return
+
+        width = max([len(row) for row in old_data + new_data] + [first_trip_column])
+        for i in range(min(first_stop_row, len(new_data))):
+            last = first_trip_column if i == first_stop_row - 1 else width
+            if any(cell(old_data, i, j) != cell(new_data, i, j) for j in range(last)):
+                self.header = True
+        for i in range(first_stop_row, len(new_data)):
+            if any(cell(old_data, i, j) != cell(new_data, i, j) for j in range(first_trip_column)):
+                self.stops = True
+
+        old_trips = trip_range(old_columns)
+        new_trips = trip_range(new_columns)
+        for j in sorted(set(old_trips) | set(new_trips)):
+            if j not in old_trips or j not in new_trips:
+                self.trips.append(j)
+            elif any(cell(old_data, i, j) != cell(new_data, i, j) for i in range(first_stop_row - 1, len(new_data))):
+                self.trips.append(j)
+
+    def changed(self):
+        return self.header or self.stops or bool(self.trips)
+
+    def trips_only(self):
+        '''
+        True when only trip columns changed, so the worksheet can be patched trip by trip.
+        '''
+        return bool(self.trips) and not self.header and not self.stops
+
+    def summary(self):
+        if self.header:
+            return 'static header changed'
+        if self.stops:
+            return 'stop rows changed'
+        if self.trips:
+            return '{} trip columns changed'.format(len(self.trips))
+        return 'unchanged'
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import csv
+import os
+import re
+from datetime import datetime
+
+
+# MemorySheetClients by name, for source_type = memory; sheet_source_root names the client.
+memory_clients = {}
+
+
+def column_letters(col):
+    '''
+    Column letters of a 1-based column number, 28 is AB.
+    '''
+    letters = ''
+    while col > 0:
+        col, remainder = divmod(col - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def parse_address(label):
+    '''
+    (row, col) of an A1 address, AB7 is (7, 28).
+    '''
+    match = re.match(r'^([A-Z]+)(\d+)$', label.upper())
+    if match is None:
+        raise ValueError('Invalid cell address {}'.format(label))
+    col = 0
+    for letter in match.group(1):
+        col = col * 26 + ord(letter) - ord('A') + 1
+    return int(match.group(2)), col
+
+
+class Cell():
+    '''
+    The Cell class is a worksheet cell, as gspread returns it from Worksheet.range().
+
+     Attributes:
+        row: 1-based row number
+        col: 1-based column number
+        value: cell text, '' when empty
+    '''
+
+    def __init__(self, row, col, value):
+        self.row = row
+        self.col = col
+        self.value = value
+
+
+class MemoryWorksheet():
+    '''
+    The MemoryWorksheet class is a worksheet held in memory, with the gspread Worksheet calls the generator makes.
+
+     Attributes:
+        title: worksheet name
+        updated: revision time, ISO 8601 UTC
+        rows: list of row values
+        row_count: rows in the worksheet
+        col_count: cells in the widest row
+    '''
+
+    def __init__(self, title, rows, updated):
+        self.title = title
+        self.updated = updated
+        self.rows = rows
+        self.row_count = len(self.rows)
+        self.col_count = max([len(row) for row in self.rows] + [1])
+
+    def get_addr_int(self, row, col):
+        return '{}{}'.format(column_letters(col), row)
+
+    def cell_value(self, row, col):
+        if row <= len(self.rows) and col <= len(self.rows[row - 1]):
+            return self.rows[row - 1][col - 1]
+        return ''
+
+    def range(self, address):
+        '''
+        Cells of a range, row by row, ie., range('AB7:AD12').
+        '''
+        first, last = address.split(':')
+        first_row, first_col = parse_address(first)
+        last_row, last_col = parse_address(last)
+        return [Cell(row, col, self.cell_value(row, col))
+                for row in range(first_row, last_row + 1) for col in range(first_col, last_col + 1)]
+
+    def row_values(self, row):
+        '''
+        Values of a row across the worksheet's col_count columns, as gspread reads the row's range.
+        '''
+        return [self.cell_value(row, col) for col in range(1, self.col_count + 1)]
+
+
+class LocalWorksheet(MemoryWorksheet):
+    '''
+    The LocalWorksheet class reads a worksheet from a CSV file. The file's modification time stands for the
+        revision time Google reports as updated.
+
+     Attributes:
+        path: CSV file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'r', newline='') as f:
+            rows = [row for row in csv.reader(f)]
+        super().__init__(os.path.splitext(os.path.basename(path))[0], rows,
+                         datetime.utcfromtimestamp(os.stat(path).st_mtime).strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
+
+
+class LocalWorkbook():
+    '''
+    The LocalWorkbook class is a directory of worksheet CSV files.
+
+     Attributes:
+        title: workbook name
+        path: workbook directory
+    '''
+
+    def __init__(self, path, title):
+        self.path = path
+        self.title = title
+
+    def worksheets(self):
+        return [LocalWorksheet(os.path.join(self.path, name))
+                for name in sorted(os.listdir(self.path)) if name.endswith('.csv')]
+
+    def worksheet(self, title):
+        return LocalWorksheet(os.path.join(self.path, '{}.csv'.format(title)))
+
+
+class LocalSheetClient():
+    '''
+    The LocalSheetClient class stands in for an authorized gspread client with source_type = local: workbook
+        <name> is the directory <sheet_source_root>/<name>, worksheet <title> the file <title>.csv in it. Used to
+        run and test the generator, and --watch, without Google Sheets.
+
+     Attributes:
+        root: sheet_source_root, expanded
+    '''
+
+    def __init__(self, root):
+        self.root = os.path.expanduser(root)
+
+    def open(self, title):
+        path = os.path.join(self.root, title)
+        if not os.path.isdir(path):
+            raise IOError('Local workbook {} not found in {}'.format(title, self.root))
+        return LocalWorkbook(path, title)
+
+
+class MemoryWorkbook():
+    '''
+    The MemoryWorkbook class is a list of MemoryWorksheets.
+
+     Attributes:
+        title: workbook name
+        sheets: list of MemoryWorksheet
+    '''
+
+    def __init__(self, title, sheets):
+        self.title = title
+        self.sheets = sheets
+
+    def worksheets(self):
+        return list(self.sheets)
+
+    def worksheet(self, title):
+        for sheet in self.sheets:
+            if sheet.title == title:
+                return sheet
+        raise IOError('Worksheet {} not found in workbook {}'.format(title, self.title))
+
+
+class MemorySheetClient():
+    '''
+    The MemorySheetClient class stands in for an authorized gspread client with source_type = memory, ie., for
+        the synthetic agencies of --benchmark. It is registered in memory_clients under a name, given as
+        sheet_source_root.
+
+     Attributes:
+        workbooks: dictionary of workbook name to MemoryWorkbook
+    '''
+
+    def __init__(self, workbooks):
+        self.workbooks = workbooks
+
+    def open(self, title):
+        if title not in self.workbooks:
+            raise IOError('Workbook {} not found in memory'.format(title))
+        return self.workbooks[title]
+
+
+class SheetFetchError(Exception):
+    '''
+    A worksheet could not be retrieved, ie., Google drive timed out on every retry.
+    '''
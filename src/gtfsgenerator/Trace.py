@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+
+from veryprettytable import VeryPrettyTable
+
+# resource is Unix only; without it spans have no RSS high-water marks.
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# One cProfile profiler can be active in a process at a time.
+profile_lock = threading.Lock()
+
+# tracemalloc is process wide: its peak is shared by the stage spans open in the process.
+memory_lock = threading.Lock()
+memory_spans = set()
+
+
+def rss_high_water():
+    '''
+    High-water mark of the process's resident set size.
+    :return: bytes, or None without the resource module
+    '''
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class Span():
+    '''
+    The Span class times one step of a run on the monotonic clock. Spans nest: run, workbook, worksheet, stage.
+
+     Attributes:
+        tracer: Tracer the span is emitted to
+        id: span id
+        parent: id of the enclosing span, or None for the run
+        name: span name, ie., the workbook, worksheet or stage name
+        kind: run, workbook, worksheet or stage
+        attributes: dictionary of values describing the span, ie., the worksheet of a stage
+        rows: rows produced in the span
+        bytes: bytes written in the span
+        counts: dictionary of counter name to value, ie., rows.stop_times or shape_cache.hits
+        start: wall clock time the span started, seconds since the epoch
+        duration: milliseconds on the monotonic clock
+        memory: with --memory, dictionary of the stage's traced peak and growth and RSS high-water mark, in bytes
+    '''
+
+    def __init__(self, tracer, name, kind, parent, attributes):
+        self.tracer = tracer
+        self.id = uuid.uuid4().hex[:16]
+        self.parent = parent
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+        self.rows = 0
+        self.bytes = 0
+        self.counts = {}
+        self.start = None
+        self.duration = None
+        self.memory = None
+        self.memory_peak = 0
+        self._begin = None
+        self._profile = None
+        self._memory = None
+
+    def __enter__(self):
+        self.start = time.time()
+        self._begin = time.perf_counter()
+        self.tracer.push(self)
+        if self.kind == 'stage':
+            self._profile = self.tracer.start_profile(self.name)
+            self._memory = self.tracer.start_memory(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self._memory is not None:
+            self.tracer.stop_memory(self)
+        if self._profile is not None:
+            self.tracer.stop_profile(self._profile)
+        self.duration = (time.perf_counter() - self._begin) * 1000.0
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        self.tracer.pop(self)
+        self.tracer.emit(self)
+        return False
+
+    def add(self, rows=0, written=0):
+        self.rows += rows
+        self.bytes += written
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def record(self):
+        record = {'run': self.tracer.run, 'id': self.id, 'parent': self.parent, 'kind': self.kind, 'name': self.name,
+                  'start': round(self.start, 6), 'ms': round(self.duration, 3), 'rows': self.rows,
+                  'bytes': self.bytes, 'pid': os.getpid(), 'thread': threading.current_thread().name,
+                  'attributes': self.attributes}
+        if self.counts:
+            record['counts'] = self.counts
+        if self.memory is not None:
+            record['memory'] = self.memory
+        return record
+
+
+class NoSpan():
+    '''
+    Stands in for a Span when a run is not traced.
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return False
+
+    def add(self, rows=0, written=0):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+
+class Parent(NoSpan):
+    '''
+    Makes a span of another thread the parent of the spans of this one, ie., for the stages of a pipeline running
+        on executor threads. It is not emitted.
+
+     Attributes:
+        tracer: Tracer
+        id: id of the parent span
+    '''
+
+    def __init__(self, tracer, parent):
+        self.tracer = tracer
+        self.id = parent
+
+    def __enter__(self):
+        self.tracer.push(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.tracer.pop(self)
+        return False
+
+
+class Tracer():
+    '''
+    The Tracer class records the spans of a generate run as JSON lines, one line per finished span, in trace_file.
+        It travels with the configuration to --jobs and queue workers: a copy reopens trace_file in append mode,
+        and its spans nest under the span that was current where it was copied. With --profile, every stage span
+        also runs under cProfile; profiles are accumulated per stage name and written to profile_dir.
+        With --memory, every stage span records the peak of the memory traced by tracemalloc while it ran, the
+        memory it left allocated and the RSS high-water mark at its end. tracemalloc and RSS are process wide, so
+        stages running at the same time in one process, ie., pipeline stages, share their peaks. The allocation
+        sites a stage left memory at are summed per stage name and written to memory_file.
+
+     Attributes:
+        trace_file: JSON lines file of the spans
+        run: run id, shared by the copies
+        profile_dir: directory of the per-stage profiles, or None when not profiling
+        memory_file: report of the allocation sites per stage, or None when not tracking memory
+        parent: span id spans without an enclosing span in their thread nest under
+    '''
+
+    def __init__(self, trace_file, profile_dir=None, memory_file=None):
+        self.trace_file = trace_file
+        self.run = uuid.uuid4().hex[:16]
+        self.profile_dir = profile_dir
+        self.memory_file = memory_file
+        self.parent = None
+        self._profiles = {}
+        self._sites = {}
+        self._tracing = False
+        self._open(truncate=True)
+
+    def _open(self, truncate=False):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        try:
+            path = os.path.dirname(self.trace_file)
+            if path and not os.path.exists(path):
+                os.makedirs(path)
+            if truncate:
+                open(self.trace_file, 'w').close()
+            # Append mode, so the lines of worker processes writing to the same file are not overwritten.
+            self._file = open(self.trace_file, 'a')
+        except OSError:
+            # A queue worker on a host without the coordinator's report_path; its spans are not recorded.
+            self._file = None
+
+    def __getstate__(self):
+        state = dict((key, value) for key, value in self.__dict__.items() if not key.startswith('_'))
+        state['parent'] = self.current() or self.parent
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._profiles = {}
+        self._sites = {}
+        self._tracing = False
+        self._open()
+
+    def span(self, name, kind='stage', parent=None, **attributes):
+        '''
+        A span to time a step in a with statement.
+        :param name: span name
+        :param kind: run, workbook, worksheet or stage
+        :param parent: id of the enclosing span; the thread's current span, else parent, if not given
+        :param attributes: values describing the span
+        :return: Span
+        '''
+        return Span(self, name, kind, parent or self.current() or self.parent, attributes)
+
+    def _stack(self):
+        if os.getpid() != self._pid:
+            # Forked: the file, lock and thread state belong to the parent process.
+            self._open()
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self):
+        stack = self._stack()
+        return stack[-1].id if stack else None
+
+    def current_span(self):
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def push(self, span):
+        self._stack().append(span)
+        if getattr(span, 'kind', None) == 'run' and self.parent is None:
+            self.parent = span.id
+
+    def pop(self, span):
+        # Spans of coroutines sharing a thread may end out of order.
+        stack = self._stack()
+        if span in stack:
+            stack.remove(span)
+
+    def emit(self, span):
+        if self._file is None:
+            return
+        line = json.dumps(span.record(), sort_keys=True)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def start_profile(self, name):
+        '''
+        Profile a stage span with --profile, unless another span is being profiled; a nested or concurrent stage
+            is counted in that profile.
+        :return: (name, cProfile.Profile), or None
+        '''
+        if self.profile_dir is None or not profile_lock.acquire(blocking=False):
+            return None
+        profile = self._profiles.setdefault(name, cProfile.Profile())
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiling tool is active.
+            profile_lock.release()
+            return None
+        return name, profile
+
+    def stop_profile(self, profile):
+        profile[1].disable()
+        profile_lock.release()
+
+    def start_memory(self, span):
+        '''
+        Start tracking the memory of a stage span with --memory: its traced peak, the RSS high-water mark and a
+            snapshot to find the allocation sites it leaves memory at. tracemalloc is started on first use.
+        :return: (traced bytes, RSS high-water mark, tracemalloc.Snapshot) at the start, or None when not tracking
+            memory
+        '''
+        if self.memory_file is None:
+            return None
+        with memory_lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracing = True
+            self._fold_peak()
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            span.memory_peak = current
+            memory_spans.add(span)
+            return current, rss_high_water(), tracemalloc.take_snapshot()
+
+    def stop_memory(self, span):
+        with memory_lock:
+            self._fold_peak()
+            memory_spans.discard(span)
+            current = tracemalloc.get_traced_memory()[0]
+            snapshot = tracemalloc.take_snapshot()
+        start_current, start_rss, start_snapshot = span._memory
+        rss = rss_high_water()
+        span.memory = {'peak': span.memory_peak - start_current, 'growth': current - start_current,
+                       'rss': rss, 'rss_growth': rss - start_rss if rss is not None else None}
+        ignored = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__),
+                   tracemalloc.Filter(False, '<frozen importlib*')]
+        sites = self._sites.setdefault(span.name, {})
+        for difference in snapshot.filter_traces(ignored).compare_to(start_snapshot.filter_traces(ignored), 'lineno'):
+            if difference.size_diff > 0:
+                frame = difference.traceback[0]
+                site = '{}:{}'.format(frame.filename, frame.lineno)
+                size, count = sites.get(site, (0, 0))
+                sites[site] = (size + difference.size_diff, count + max(difference.count_diff, 0))
+
+    def _fold_peak(self):
+        # The traced peak since the last reset belongs to every stage span open in the process.
+        peak = tracemalloc.get_traced_memory()[1]
+        for open_span in memory_spans:
+            open_span.memory_peak = max(open_span.memory_peak, peak)
+
+    def write_memory(self, top=10):
+        '''
+        Write the top allocation sites of every stage, by the memory the stage left allocated there, to memory_file.
+            Sites of stages built on workers are not included.
+        :return: memory_file, or None when not tracking memory
+        '''
+        if self.memory_file is None:
+            return None
+        path = os.path.dirname(self.memory_file)
+        if path and not os.path.exists(path):
+            os.makedirs(path)
+        peaks = self.memory_peaks()
+        with open(self.memory_file, 'w') as f:
+            for name in sorted(set(peaks) | set(self._sites)):
+                peak, rss = peaks.get(name, (None, None))
+                f.write('{} peak traced:{} rss high water:{}\n'.format(name, format_bytes(peak), format_bytes(rss)))
+                sites = sorted(self._sites.get(name, {}).items(), key=lambda item: -item[1][0])
+                for site, (size, count) in sites[:top]:
+                    f.write('  {:>10} {:>8} blocks {}\n'.format(format_bytes(size), count, site))
+        return self.memory_file
+
+    def memory_peaks(self):
+        '''
+        Peak traced memory and RSS high-water mark per stage name, over the stage spans of the run.
+        :return: dictionary of stage name to (peak bytes, RSS bytes)
+        '''
+        peaks = {}
+        for record in self.records():
+            memory = record.get('memory')
+            if memory is None:
+                continue
+            peak, rss = peaks.get(record['name'], (0, 0))
+            peaks[record['name']] = (max(peak, memory['peak']), max(rss, memory['rss'] or 0))
+        return peaks
+
+    def write_profiles(self, top=25):
+        '''
+        Write the profile of every stage, <profile_dir>/<stage>.prof for pstats or snakeviz and <stage>.txt with
+            the top functions by cumulative time.
+        :return: list of profile files written
+        '''
+        if self.profile_dir is None:
+            return []
+        if not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        written = []
+        for name, profile in sorted(self._profiles.items()):
+            prof_file = os.path.join(self.profile_dir, '{}.prof'.format(name))
+            profile.dump_stats(prof_file)
+            with open(os.path.join(self.profile_dir, '{}.txt'.format(name)), 'w') as f:
+                pstats.Stats(prof_file, stream=f).sort_stats('cumulative').print_stats(top)
+            written.append(prof_file)
+        return written
+
+    def records(self):
+        '''
+        Spans of this run in trace_file, including those of worker processes.
+        :return: list of span dictionaries
+        '''
+        if self._file is None:
+            return []
+        with self._lock:
+            self._file.flush()
+        records = []
+        with open(self.trace_file, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('run') == self.run:
+                    records.append(record)
+        return records
+
+    def summary(self):
+        '''
+        Spans of the run by kind and name: count, total, mean and max milliseconds, rows and bytes; with --memory
+            also the peak traced memory and RSS high-water mark of each stage.
+        :return: VeryPrettyTable
+        '''
+        totals = {}
+        for record in self.records():
+            key = (record['kind'], record['name'] if record['kind'] in ('run', 'stage') else '*')
+            total = totals.setdefault(key, [0, 0.0, 0.0, 0, 0])
+            total[0] += 1
+            total[1] += record['ms']
+            total[2] = max(total[2], record['ms'])
+            total[3] += record['rows']
+            total[4] += record['bytes']
+        peaks = self.memory_peaks() if self.memory_file is not None else {}
+        order = {'run': 0, 'workbook': 1, 'worksheet': 2, 'stage': 3}
+        columns = ['Kind', 'Name', 'Count', 'Total ms', 'Mean ms', 'Max ms', 'Rows', 'Bytes']
+        table = VeryPrettyTable(columns + (['Peak traced', 'RSS high water'] if peaks else []))
+        table.align['Name'] = 'l'
+        for (kind, name), (count, ms, longest, rows, written) in sorted(
+                totals.items(), key=lambda item: (order.get(item[0][0], 4), -item[1][1])):
+            row = [kind, name, count, '{:.1f}'.format(ms), '{:.1f}'.format(ms / count), '{:.1f}'.format(longest),
+                   rows, written]
+            if peaks:
+                peak, rss = peaks.get(name, (None, None)) if kind == 'stage' else (None, None)
+                row += [format_bytes(peak), format_bytes(rss)]
+            table.add_row(row)
+        return table
+
+    def close(self):
+        if self._file is not None:
+            with self._lock:
+                self._file.close()
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+
+def format_bytes(size):
+    '''
+    Size in KiB or MiB, or '' for None.
+    '''
+    if size is None:
+        return ''
+    if abs(size) < 1048576:
+        return '{:.1f} KiB'.format(size / 1024.0)
+    return '{:.1f} MiB'.format(size / 1048576.0)
+
+
+def span(configs, name, kind='stage', parent=None, **attributes):
+    '''
+    A span of the run's tracer, configs.tracer, or a NoSpan when the run is not traced.
+    '''
+    tracer = getattr(configs, 'tracer', None)
+    if tracer is None:
+        return NoSpan()
+    return tracer.span(name, kind, parent, **attributes)
+
+
+def under(configs, parent):
+    '''
+    Nest the spans of this thread under the span parent, in a with statement.
+    '''
+    tracer = getattr(configs, 'tracer', None)
+    if tracer is None or parent is None:
+        return NoSpan()
+    return Parent(tracer, parent)
+
+
+def current(configs):
+    '''
+    Id of the current span of the thread, to nest spans of another process or thread under it with under().
+    '''
+    tracer = getattr(configs, 'tracer', None)
+    return tracer.current() if tracer is not None else None
+
+
+def add(configs, rows=0, written=0):
+    '''
+    Count rows and bytes in the current span of the thread.
+    '''
+    tracer = getattr(configs, 'tracer', None)
+    if tracer is not None:
+        current = tracer.current_span()
+        if current is not None:
+            current.add(rows, written)
+
+
+def count(configs, name, value=1):
+    '''
+    Add value to a counter of the current span of the thread.
+    '''
+    tracer = getattr(configs, 'tracer', None)
+    if tracer is not None:
+        current = tracer.current_span()
+        if current is not None:
+            current.count(name, value)
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import hashlib
+from html.parser import HTMLParser
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+import zipfile
+
+# feedvalidator.py (transitfeed, Python 2) writes validator.html to its working directory.
+validator_command = ['feedvalidator.py', '-n', '-o', 'validator.html']
+
+
+def validator_version():
+    '''
+    Version reported by feedvalidator.py --version, part of the validation cache key.
+    :return: version text, or 'unavailable' when the validator cannot be started.
+    '''
+    try:
+        result = subprocess.run([validator_command[0], '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                timeout=60)
+    except (OSError, subprocess.TimeoutExpired):
+        return 'unavailable'
+    return result.stdout.decode('utf-8', 'replace').strip()
+
+
+def without_feed_version(content):
+    '''
+    Blank the feed_version column of feed_info.txt, which changes on every run.
+    :param content: feed_info.txt as bytes
+    :return: feed_info.txt as bytes with empty feed_version values
+    '''
+    rows = list(csv.reader(io.StringIO(content.decode('utf-8'), newline='')))
+    if not rows:
+        return content
+    columns = [column.strip() for column in rows[0]]
+    if 'feed_version' not in columns:
+        return content
+    i = columns.index('feed_version')
+    f = io.StringIO(newline='')
+    writer = csv.writer(f, lineterminator='\n')
+    writer.writerow(rows[0])
+    for row in rows[1:]:
+        if len(row) > i:
+            row[i] = ''
+        writer.writerow(row)
+    return f.getvalue().encode('utf-8')
+
+
+class ValidatorHtmlParser(HTMLParser):
+    '''
+    Collect the problems listed in a feedvalidator.py validator.html. Each list item is a problem; its severity
+        is taken from the heading above it (Errors, Warnings, Notices). The totals come from the summary text.
+    '''
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.severity = None
+        self.problems = []
+        self.text = []
+        self._heading = None
+        self._item = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('h1', 'h2', 'h3', 'h4'):
+            self._heading = []
+        elif tag == 'li' and self.severity is not None:
+            self._item = []
+
+    def handle_endtag(self, tag):
+        if tag in ('h1', 'h2', 'h3', 'h4') and self._heading is not None:
+            heading = ' '.join(self._heading).lower()
+            self._heading = None
+            for severity in ('error', 'warning', 'notice'):
+                if severity in heading:
+                    self.severity = severity
+                    break
+        elif tag == 'li' and self._item is not None:
+            message = ' '.join(' '.join(self._item).split())
+            self._item = None
+            if message:
+                self.problems.append(problem(self.severity, message))
+
+    def handle_data(self, data):
+        self.text.append(data)
+        if self._heading is not None:
+            self._heading.append(data)
+        if self._item is not None:
+            self._item.append(data)
+
+
+def problem(severity, message, gtfs_file=None, line=None):
+    '''
+    One structured validation problem. The file and line are read from the message when not given.
+    '''
+    if gtfs_file is None:
+        match = re.search(r'([a-z_]+\.txt)', message)
+        gtfs_file = match.group(1) if match else ''
+    if line is None:
+        match = re.search(r'line (\d+)', message)
+        line = int(match.group(1)) if match else None
+    return {'severity': severity, 'message': message, 'file': gtfs_file, 'line': line}
+
+
+def parse_validator_html(html_file):
+    '''
+    Read a validator.html into error and warning counts and a list of problems.
+    :param html_file: path of validator.html
+    :return: dictionary with errors, warnings and problems; empty counts when the file is missing.
+    '''
+    results = {'errors': 0, 'warnings': 0, 'problems': []}
+    if not os.path.isfile(html_file):
+        return results
+    parser = ValidatorHtmlParser()
+    with open(html_file, encoding='utf-8', errors='replace') as f:
+        parser.feed(f.read())
+    text = ' '.join(parser.text)
+    results['problems'] = parser.problems
+    for severity in ('error', 'warning'):
+        match = re.search(r'(\d+) {}s?'.format(severity), text)
+        listed = len([item for item in parser.problems if item['severity'] == severity])
+        results[severity + 's'] = max(int(match.group(1)) if match else 0, listed)
+    return results
+
+
+def write_results(path, name, results):
+    '''
+    Write structured validation results as <path>/<name>, read offline by aggregate_reports.
+    '''
+    with open(os.path.join(path, name), 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+
+def write_check_results(path, label, errors):
+    '''
+    Write the FeedCheck errors of a worksheet as <path>/feedcheck.json.
+    :param path: worksheet directory
+    :param label: workbook.worksheet
+    :param errors: list of (gtfs file, message) from FeedCheck.check
+    :return:
+    '''
+    write_results(path, 'feedcheck.json', {'label': label, 'validator': 'feedcheck', 'errors': len(errors),
+                                           'warnings': 0, 'problems': [problem('error', message, gtfs_file + '.txt')
+                                                                       for gtfs_file, message in errors]})
+
+
+def validate_feed(gtfs_zip, cwd, label='', cache=None):
+    '''
+    Run feedvalidator.py on one GTFS zip with cwd as its working directory. The console output is captured to
+        <cwd>/validator.log rather than printed, so concurrent runs do not interleave, and the results are written
+        as <cwd>/validation.json. With a cache, a zip whose tables were validated before gets the stored
+        validator.html and results instead of a validator run.
+    :param gtfs_zip: path of the zip to validate
+    :param cwd: directory receiving validator.html and validator.log
+    :param label: name reported with the result, i.e., workbook.worksheet
+    :param cache: ValidationCache, or None
+    :return: (label, return code or None if the validator could not be started, seconds, captured output)
+    '''
+    start = time.time()
+    key, cached = cached_result(gtfs_zip, cwd, label, cache)
+    if cached is not None:
+        return cached[:2] + (time.time() - start,) + cached[3:]
+    try:
+        result = subprocess.run(validator_command + [gtfs_zip], cwd=cwd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        returncode = result.returncode
+        output = result.stdout.decode('utf-8', 'replace')
+    except OSError as e:
+        returncode = None
+        output = '{} could not be started: {}\n'.format(validator_command[0], e)
+    record_result(cwd, label, returncode, output, key, cache)
+    return label, returncode, time.time() - start, output
+
+
+async def validate_feed_async(gtfs_zip, cwd, label='', cache=None):
+    '''
+    validate_feed as an asyncio subprocess, for the staged pipeline.
+    '''
+    start = time.time()
+    key, cached = cached_result(gtfs_zip, cwd, label, cache)
+    if cached is not None:
+        return cached[:2] + (time.time() - start,) + cached[3:]
+    try:
+        process = await asyncio.create_subprocess_exec(*(validator_command + [gtfs_zip]), cwd=cwd,
+                                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        stdout, stderr = await process.communicate()
+        returncode = process.returncode
+        output = stdout.decode('utf-8', 'replace')
+    except OSError as e:
+        returncode = None
+        output = '{} could not be started: {}\n'.format(validator_command[0], e)
+    record_result(cwd, label, returncode, output, key, cache)
+    return label, returncode, time.time() - start, output
+
+
+def cached_result(gtfs_zip, cwd, label, cache):
+    '''
+    Look a zip up in the validation cache, restoring validator.html, validator.log and validation.json on a hit.
+    :return: (cache key or None, (label, return code, 0, output) on a hit or None)
+    '''
+    if cache is None:
+        return None, None
+    key = cache.key(gtfs_zip)
+    summary = cache.restore(key, cwd)
+    if summary is None:
+        return key, None
+    results = summary.get('results') or parse_validator_html(os.path.join(cwd, 'validator.html'))
+    results.update({'label': label, 'validator': 'feedvalidator', 'returncode': summary['returncode']})
+    write_results(cwd, 'validation.json', results)
+    return key, (label, summary['returncode'], 0, summary['output'])
+
+
+def record_result(cwd, label, returncode, output, key, cache):
+    '''
+    Write validator.log and validation.json for a validator run and store it in the cache.
+    '''
+    with open(os.path.join(cwd, 'validator.log'), 'w') as f:
+        f.write(output)
+    results = parse_validator_html(os.path.join(cwd, 'validator.html'))
+    results.update({'label': label, 'validator': 'feedvalidator', 'returncode': returncode})
+    write_results(cwd, 'validation.json', results)
+    if key is not None and returncode is not None:
+        cache.store(key, cwd, {'returncode': returncode, 'output': output, 'label': label, 'results': results})
+
+
+class ValidationCache():
+    '''
+    The ValidationCache class keeps feedvalidator.py results by the SHA-256 of a zip's tables (feed_version
+        excluded) and the validator version, as <cache_dir>/<key>/validator.html and summary.json.
+
+     Attributes:
+        cache_dir: cache directory, i.e., report_path/validation_cache
+        version: feedvalidator.py version
+        hits: runs answered from the cache
+        misses: runs of the validator
+    '''
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.version = validator_version()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, gtfs_zip):
+        '''
+        Cache key of a zip: its member names and contents, feed_version blanked, and the validator version.
+        :param gtfs_zip: path of the zip
+        :return: hex digest, or None if the zip cannot be read.
+        '''
+        digest = hashlib.sha256(self.version.encode('utf-8'))
+        try:
+            with zipfile.ZipFile(gtfs_zip) as zfile:
+                for name in sorted(zfile.namelist()):
+                    content = zfile.read(name)
+                    if name == 'feed_info.txt':
+                        content = without_feed_version(content)
+                    digest.update('{}\0{}\0'.format(name, len(content)).encode('utf-8'))
+                    digest.update(content)
+        except (OSError, zipfile.BadZipFile):
+            return None
+        return digest.hexdigest()
+
+    def restore(self, key, cwd):
+        '''
+        Copy a cached validator.html and validator.log to cwd.
+        :param key: cache key, or None
+        :param cwd: worksheet or feed directory
+        :return: the cached summary, or None on a miss.
+        '''
+        entry = os.path.join(self.cache_dir, key) if key is not None else None
+        if entry is None or not os.path.isfile(os.path.join(entry, 'summary.json')):
+            with self._lock:
+                self.misses += 1
+            return None
+        with open(os.path.join(entry, 'summary.json')) as f:
+            summary = json.load(f)
+        if os.path.isfile(os.path.join(entry, 'validator.html')):
+            shutil.copyfile(os.path.join(entry, 'validator.html'), os.path.join(cwd, 'validator.html'))
+        with open(os.path.join(cwd, 'validator.log'), 'w') as f:
+            f.write(summary['output'])
+        with self._lock:
+            self.hits += 1
+        return summary
+
+    def store(self, key, cwd, summary):
+        '''
+        Store the validator.html in cwd and the summary under the key. The entry is renamed into place complete.
+        :param key: cache key
+        :param cwd: directory the validator ran in
+        :param summary: dictionary with returncode and output
+        :return:
+        '''
+        entry = os.path.join(self.cache_dir, key)
+        tmp_entry = '{}.{}.tmp'.format(entry, threading.get_ident())
+        os.makedirs(tmp_entry, exist_ok=True)
+        if os.path.isfile(os.path.join(cwd, 'validator.html')):
+            shutil.copyfile(os.path.join(cwd, 'validator.html'), os.path.join(tmp_entry, 'validator.html'))
+        with open(os.path.join(tmp_entry, 'summary.json'), 'w') as f:
+            json.dump(summary, f)
+        try:
+            os.replace(tmp_entry, entry)
+        except OSError:
+            # Another run stored the same key first.
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    def stats(self):
+        return 'hits:{} misses:{}'.format(self.hits, self.misses)
+
+
+class ValidationScheduler():
+    '''
+    The ValidationScheduler class runs feedvalidator.py on worksheet zips in the background, at most workers at a
+        time, while the next worksheets are built. Each run is a subprocess with its own cwd; the threads only wait.
+
+     Attributes:
+        workers: number of concurrent validator processes
+        cache: ValidationCache, or None
+        futures: submitted runs in submission order
+    '''
+
+    def __init__(self, workers=1, cache=None):
+        self.workers = max(int(workers), 1)
+        self.cache = cache
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.futures = []
+
+    def submit(self, gtfs_zip, cwd, label=''):
+        '''
+        Queue a validator run and return at once.
+        :param gtfs_zip: path of the zip to validate
+        :param cwd: directory receiving validator.html and validator.log
+        :param label: name reported with the result, i.e., workbook.worksheet
+        :return:
+        '''
+        self.futures.append(self.pool.submit(validate_feed, gtfs_zip, cwd, label, self.cache))
+
+    def wait(self, verbose=False):
+        '''
+        Wait for every queued run and print one line per run, with its captured output when verbose.
+        :param verbose: print the captured validator output
+        :return: list of (label, return code, seconds, output) in submission order
+        '''
+        start = time.time()
+        results = [future.result() for future in self.futures]
+        self.futures = []
+        for label, returncode, seconds, output in results:
+            print('Validated {}: return code {} in {:.1f}s'.format(label, returncode, seconds))
+            if verbose:
+                print(output)
+        if results:
+            print('{} validator runs on {} workers, {:.1f}s of validation, {:.1f}s waited after the build.'.format(
+                len(results), self.workers, sum(result[2] for result in results), time.time() - start))
+        return results
+
+
+def aggregate_reports(root, report_path, worksheets=None):
+    '''
+    Consolidate every validation.json and feedcheck.json under the output tree in one pass, offline.
+        Writes validation_report.txt and validation_report.json to the report path with per worksheet (route)
+        counts by severity and totals. Given the worksheets of the current build, results left in any other
+        worksheet directory belong to a withdrawn worksheet; they are deleted rather than reported.
+    :param root: gtfs_path_root
+    :param report_path: report directory
+    :param worksheets: list of workbook/worksheet paths of the current build, or None to report every result.
+    :return: dictionary of severity to total count
+    '''
+    current = None if worksheets is None else set(worksheets) | {'.'}
+    routes = {}
+    totals = {'error': 0, 'warning': 0}
+    for path, dirs, files in sorted(os.walk(root)):
+        dirs.sort()
+        route = os.path.relpath(path, root).replace(os.sep, '/')
+        for name in ('feedcheck.json', 'validation.json'):
+            if name not in files:
+                continue
+            if current is not None and route not in current:
+                os.remove(os.path.join(path, name))
+                continue
+            with open(os.path.join(path, name)) as f:
+                results = json.load(f)
+            if route == '.':
+                route = results.get('label') or 'feed'
+            counts = routes.setdefault(route, {'error': 0, 'warning': 0, 'problems': []})
+            for severity in ('error', 'warning'):
+                counts[severity] += results.get(severity + 's', 0)
+                totals[severity] += results.get(severity + 's', 0)
+            for item in results.get('problems', []):
+                counts['problems'].append(dict(item, validator=results.get('validator', name)))
+
+    if not os.path.exists(report_path):
+        os.makedirs(report_path)
+    with open(os.path.join(report_path, 'validation_report.json'), 'w') as f:
+        json.dump({'totals': totals, 'routes': routes}, f, indent=1, sort_keys=True)
+    with open(os.path.join(report_path, 'validation_report.txt'), 'w') as f:
+        f.write('Errors:{} Warnings:{} Worksheets:{}\n'.format(totals['error'], totals['warning'], len(routes)))
+        for route, counts in sorted(routes.items(), key=lambda item: (-item[1]['error'], -item[1]['warning'], item[0])):
+            f.write('{} errors:{} warnings:{}\n'.format(route, counts['error'], counts['warning']))
+            for item in counts['problems']:
+                location = item['file'] + (':{}'.format(item['line']) if item['line'] else '')
+                f.write('  {} {} {} {}\n'.format(item['severity'], item['validator'], location, item['message']))
+    return totals
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import os
+import time
+
+# inotify_simple is optional; without it the watched directories are polled like the sheets.
+try:
+    from inotify_simple import INotify
+    from inotify_simple import flags as inotify_flags
+except ImportError:
+    INotify = None
+
+
+def tree_state(root):
+    '''
+    (mtime, size) of every file under a directory.
+    :param root: directory, expanded
+    :return: dictionary of path to (mtime_ns, size)
+    '''
+    state = {}
+    for path, dirs, files in os.walk(root):
+        for name in files:
+            file_path = os.path.join(path, name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            state[file_path] = (stat.st_mtime_ns, stat.st_size)
+    return state
+
+
+class Watcher():
+    '''
+    The Watcher class waits for the inputs of a build to change. The poll function returns the state of every
+        input, ie., worksheet revision times and KML file states; it is called every interval seconds, and
+        with inotify_simple installed also as soon as a file under one of the watched directories changes.
+        Once a change is seen the state must stay the same for debounce seconds, so a burst of edits is
+        coalesced into one build. Changes made while a build runs are found by the next wait().
+
+     Attributes:
+        poll: function returning a dictionary of input to its state
+        interval: seconds between polls
+        debounce: seconds the state must stay the same after a change
+        directories: local directories to watch with inotify
+        state: input states the last build started from
+    '''
+
+    def __init__(self, poll, interval=60.0, debounce=5.0, directories=()):
+        self.poll = poll
+        self.interval = max(float(interval), 0.0)
+        self.debounce = max(float(debounce), 0.0)
+        self.directories = [directory for directory in directories if directory and os.path.isdir(directory)]
+        self.state = None
+        self._inotify = None
+        if INotify is not None and self.directories:
+            self._inotify = INotify()
+            mask = (inotify_flags.CREATE | inotify_flags.DELETE | inotify_flags.MODIFY | inotify_flags.MOVED_TO |
+                    inotify_flags.MOVED_FROM | inotify_flags.CLOSE_WRITE)
+            for directory in self.directories:
+                for path, dirs, files in os.walk(directory):
+                    self._inotify.add_watch(path, mask)
+
+    def mode(self):
+        return 'inotify and polling' if self._inotify is not None else 'polling'
+
+    def start(self):
+        '''
+        Record the inputs of the first build.
+        '''
+        self.state = self.poll()
+
+    def sleep(self, seconds):
+        '''
+        Sleep, or with inotify until a watched file changes.
+        '''
+        if self._inotify is not None:
+            self._inotify.read(timeout=int(seconds * 1000))
+        else:
+            time.sleep(seconds)
+
+    def wait(self):
+        '''
+        Wait for the inputs to change and settle.
+        :return: sorted list of the inputs that changed since the last build
+        '''
+        while True:
+            self.sleep(self.interval)
+            current = self.poll()
+            if current != self.state:
+                break
+
+        # Debounce: wait for a quiet period; every further change restarts it.
+        while True:
+            time.sleep(self.debounce)
+            if self._inotify is not None:
+                self._inotify.read(timeout=0)
+            latest = self.poll()
+            if latest == current:
+                break
+            current = latest
+
+        changed = sorted(key for key in set(self.state) | set(current) if self.state.get(key) != current.get(key))
+        self.state = current
+        return changed
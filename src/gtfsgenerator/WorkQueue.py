@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import os
+import pickle
+import socket
+import sqlite3
+import time
+import uuid
+from concurrent.futures import Future
+
+
+class JobError(Exception):
+    '''
+    A queued job failed on a worker, or its lease expired too often.
+    '''
+
+
+class WorkQueue():
+    '''
+    The WorkQueue class is a job queue in a SQLite database on a filesystem shared by the coordinator and the
+        workers, so no queue service is needed. The coordinator submits jobs, each a pickled (function name,
+        arguments); workers on any host claim a job with a lease of lease seconds, renew the lease while they
+        work and report the pickled result or the error. A job whose lease expires, ie., its worker crashed,
+        is claimed again, up to max_attempts times. Claims take SQLite's write lock, so a job is leased to one
+        worker at a time.
+
+     Attributes:
+        db_file: path of the queue database
+        lease: seconds a claimed job is leased to its worker
+        max_attempts: claims of a job before it fails
+        run: id of the coordinator's run, set by submit()
+        futures: dictionary of job id to the Future of a submitted job
+    '''
+
+    def __init__(self, db_file, lease=60.0, max_attempts=3):
+        self.db_file = db_file
+        self.lease = float(lease)
+        self.max_attempts = max(int(max_attempts), 1)
+        self.run = None
+        self.futures = {}
+        path = os.path.dirname(db_file)
+        if path and not os.path.exists(path):
+            os.makedirs(path)
+        with self.connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, run TEXT, '
+                               'name TEXT, payload BLOB, state TEXT, worker TEXT, lease_expires REAL, '
+                               'attempts INTEGER, max_attempts INTEGER, result BLOB, error TEXT, updated REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)')
+
+    def connect(self):
+        '''
+        A connection per call; workers and the coordinator are separate processes.
+        '''
+        return sqlite3.connect(self.db_file, timeout=120, isolation_level=None)
+
+    def submit(self, name, function, *args):
+        '''
+        Queue a job.
+        :param name: job name, ie., workbook.worksheet
+        :param function: name of the module-level function the worker calls
+        :param args: arguments of the function, picklable
+        :return: Future, resolved by wait()
+        '''
+        if self.run is None:
+            self.run = uuid.uuid4().hex
+        with self.connect() as connection:
+            cursor = connection.execute('INSERT INTO jobs (run, name, payload, state, attempts, max_attempts, '
+                                        "updated) VALUES (?, ?, ?, 'queued', 0, ?, ?)",
+                                        (self.run, name, pickle.dumps((function, args), pickle.HIGHEST_PROTOCOL),
+                                         self.max_attempts, time.time()))
+            future = Future()
+            self.futures[cursor.lastrowid] = future
+        return future
+
+    def claim(self, worker):
+        '''
+        Lease the oldest queued job, or a leased one whose lease expired.
+        :param worker: worker name, ie., host:pid
+        :return: (job id, name, function name, arguments), or None when there is nothing to do.
+        '''
+        connection = self.connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            record = connection.execute("SELECT id, name, payload FROM jobs WHERE (state = 'queued' OR "
+                                        "(state = 'leased' AND lease_expires < ?)) AND attempts < max_attempts "
+                                        'ORDER BY id LIMIT 1', (now,)).fetchone()
+            if record is None:
+                connection.execute('COMMIT')
+                return None
+            connection.execute("UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ?, "
+                               'attempts = attempts + 1, updated = ? WHERE id = ?',
+                               (worker, now + self.lease, now, record[0]))
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+        function, args = pickle.loads(record[2])
+        return record[0], record[1], function, args
+
+    def renew(self, job_id, worker):
+        '''
+        Extend the lease of a job the worker still holds.
+        :return: True if the worker still holds the job.
+        '''
+        with self.connect() as connection:
+            cursor = connection.execute("UPDATE jobs SET lease_expires = ? WHERE id = ? AND state = 'leased' AND "
+                                        'worker = ?', (time.time() + self.lease, job_id, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, result):
+        '''
+        Report the result of a job. A worker whose lease expired and whose job was claimed again is ignored.
+        '''
+        with self.connect() as connection:
+            connection.execute("UPDATE jobs SET state = 'done', result = ?, updated = ? WHERE id = ? AND "
+                               "state = 'leased' AND worker = ?",
+                               (pickle.dumps(result, pickle.HIGHEST_PROTOCOL), time.time(), job_id, worker))
+
+    def fail(self, job_id, worker, error):
+        with self.connect() as connection:
+            connection.execute("UPDATE jobs SET state = 'failed', error = ?, updated = ? WHERE id = ? AND "
+                               "state = 'leased' AND worker = ?", (error, time.time(), job_id, worker))
+
+    def counts(self):
+        '''
+        Jobs of the run, by state.
+        :return: dictionary of state to count
+        '''
+        with self.connect() as connection:
+            return dict(connection.execute('SELECT state, COUNT(*) FROM jobs WHERE run = ? GROUP BY state',
+                                           (self.run,)).fetchall())
+
+    def wait(self, poll=0.5, report=30.0):
+        '''
+        Wait for every submitted job and resolve its Future with the result, or a JobError. Jobs whose last
+            lease expired fail here.
+        :param poll: seconds between checks of the queue
+        :param report: seconds between progress lines
+        :return:
+        '''
+        last_report = time.time()
+        while any(not future.done() for future in self.futures.values()):
+            with self.connect() as connection:
+                connection.execute("UPDATE jobs SET state = 'failed', error = 'lease expired ' || attempts || "
+                                   "' times', updated = ? WHERE run = ? AND state = 'leased' AND lease_expires < ? "
+                                   'AND attempts >= max_attempts', (time.time(), self.run, time.time()))
+                records = connection.execute("SELECT id, state, result, error, worker FROM jobs WHERE run = ? AND "
+                                             "state IN ('done', 'failed')", (self.run,)).fetchall()
+            for job_id, state, result, error, worker in records:
+                future = self.futures.get(job_id)
+                if future is None or future.done():
+                    continue
+                if state == 'done':
+                    future.set_result(pickle.loads(result))
+                else:
+                    future.set_exception(JobError('job failed on {}: {}'.format(worker, error)))
+            if any(not future.done() for future in self.futures.values()):
+                if time.time() - last_report > report:
+                    print('Work queue {}: {}'.format(self.db_file, ', '.join(
+                        '{} {}'.format(state, count) for state, count in sorted(self.counts().items()))))
+                    last_report = time.time()
+                time.sleep(poll)
+
+    def close(self):
+        '''
+        Remove the jobs of the run.
+        '''
+        if self.run is not None:
+            with self.connect() as connection:
+                connection.execute('DELETE FROM jobs WHERE run = ?', (self.run,))
+        self.run = None
+        self.futures = {}
+
+
+def worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
@@ -26,13 +26,19 @@ Python script to:
 """
 
 import argparse
-from bs4 import BeautifulSoup
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+import copy
 import csv
 from datetime import datetime
 import gspread          # read Google sheets
 from geopy.distance import vincenty
+import functools
 import glob
 import json
+import multiprocessing
 import os
 from os.path import expanduser
 from oauth2client import tools
@@ -41,6 +47,9 @@ from oauth2client.file import Storage
 import pandas as pd
 import subprocess
 import sys
+import threading
+import time
+import traceback
 from shutil import copyfile
 from termcolor import colored
 from veryprettytable import VeryPrettyTable
@@ -53,17 +62,73 @@ from gtfsgenerator import GTFS
 
 from pandas import read_excel
 
+from gtfsgenerator.Benchmark import run_benchmark
+from gtfsgenerator.BuildGraph import BuildGraph
+from gtfsgenerator.BuildGraph import sheet_hash
+from gtfsgenerator.Checkpoint import Checkpoint
 from gtfsgenerator.Configuration import Configuration
+from gtfsgenerator.ExceptionLog import ExceptionLog
+from gtfsgenerator.ExceptionLog import ExceptionRecord
+from gtfsgenerator.ExceptionLog import exception_record
+from gtfsgenerator.Feed import Feed
+from gtfsgenerator.Feed import StaticTables
+from gtfsgenerator.FeedArrow import get_columnar_dir
+from gtfsgenerator.FeedArrow import write_columnar
+from gtfsgenerator.FeedCheck import FeedCheck
+from gtfsgenerator.FeedStore import FeedStore
 from gtfsgenerator.GTFS import GtfsHeader
 from gtfsgenerator.GTFS import GtfsWrite
 from gtfsgenerator.GtfsCalendar import ServiceExceptions
 from gtfsgenerator.GtfsCalendar import check_calendar_length
+from gtfsgenerator.Metrics import RunMetrics
+from gtfsgenerator.Pipeline import Pipeline
+from gtfsgenerator.Pipeline import Stage
+from gtfsgenerator.SheetDiff import SheetDiff
+from gtfsgenerator.SheetDiff import trip_id as get_trip_id
+from gtfsgenerator.SheetDiff import trip_range
+from gtfsgenerator.SheetSource import column_letters
+from gtfsgenerator.SheetSource import LocalSheetClient
+from gtfsgenerator.SheetSource import memory_clients
+from gtfsgenerator.SheetSource import SheetFetchError
+from gtfsgenerator.Trace import Tracer
+from gtfsgenerator.Trace import format_bytes
+from gtfsgenerator.Trace import add as trace_add
+from gtfsgenerator.Trace import count as trace_count
+from gtfsgenerator.Trace import current as trace_current
+from gtfsgenerator.Trace import span
+from gtfsgenerator.Trace import under
+from gtfsgenerator.Validation import ValidationCache
+from gtfsgenerator.Validation import aggregate_reports
+from gtfsgenerator.Validation import validate_feed_async
+from gtfsgenerator.Validation import write_check_results
+from gtfsgenerator.Validation import ValidationScheduler
+from gtfsgenerator.Validation import validate_feed
+from gtfsgenerator.Watch import Watcher
+from gtfsgenerator.Watch import tree_state
+from gtfsgenerator.WorkQueue import JobError
+from gtfsgenerator.WorkQueue import WorkQueue
+from gtfsgenerator.WorkQueue import worker_name
 
 
 import httplib2
 
 from oauth2client import client
 
+# Codes of the exceptions raised for a trip; they carry its trip_id.
+trip_exception_codes = ('time_format', 'trip_missing_value')
+
+
+# Shared by the agencies of a batch run: authorized Sheets clients by credentials, and shape rows built from KML
+# files by shape, with the state of the files they were built from. The shapes least recently used leave the cache
+# once it holds more than shape_cache_limit points.
+sheets_clients = {}
+shape_cache = OrderedDict()
+shape_cache_limit = 2000000
+cache_lock = threading.Lock()
+
+# Errors of a worksheet fetch that are retried: Google drive timeouts and connection errors.
+fetch_errors = (etree.ElementTree.ParseError, OSError, httplib2.HttpLib2Error, gspread.exceptions.GSpreadException)
+
 
 def pretty_print_args(configs):
     """
@@ -94,6 +159,9 @@ def get_config_parser_for_passed_in_config_file():
     )
 
     config_parser.add_argument("-c", "--config_file", help="Specify a config file", metavar="FILE")
+    config_parser.add_argument("-b", "--batch", nargs='+', metavar="CONFIG",
+                               help="Generate the feeds of several agencies in one process; config files, or "
+                                    "directories of .ini files")
 
     return config_parser
 
@@ -119,6 +187,32 @@ def get_config_parser_for_passed_in_config_file():
 
 
 
+def get_sheets_client(configs):
+    """
+    Authorized gspread client, created once per credentials and shared by the agencies of a batch run. With
+        source_type = local, a LocalSheetClient reading the CSV worksheets under sheet_source_root; with
+        source_type = memory, the MemorySheetClient registered as sheet_source_root.
+    :param configs: client_id, client_secret, client_scope, redirect_uri, oauth_cred_file_name
+    :return: gspread client
+    """
+    if configs.source_type == 'local':
+        return LocalSheetClient(configs.sheet_source_root)
+    if configs.source_type == 'memory':
+        return memory_clients[configs.sheet_source_root]
+    key = (configs.client_id, os.path.expanduser(configs.oauth_cred_file_name))
+    with cache_lock:
+        if key not in sheets_clients:
+            credentials = get_credentials(client_id=configs.client_id,
+                                          client_secret=configs.client_secret,
+                                          client_scope=configs.client_scope,
+                                          redirect_uri=configs.redirect_uri,
+                                          oauth_cred_file_name=configs.oauth_cred_file_name)
+
+            # Ref: http://www.lovholm.net/2013/11/25/work-programmatically-with-google-spreadsheets-part-2/
+            sheets_clients[key] = gspread.authorize(credentials)
+        return sheets_clients[key]
+
+
 def open_google_workbook(google_workbook_name, configs):
     """
     Open Google Sheets workbook with oauth2 credentials.
@@ -128,16 +222,7 @@ def open_google_workbook(google_workbook_name, configs):
     :return:
     """
 
-    credentials = get_credentials(client_id=configs.client_id,
-                                  client_secret=configs.client_secret,
-                                  client_scope=configs.client_scope,
-                                  redirect_uri=configs.redirect_uri,
-                                  oauth_cred_file_name=configs.oauth_cred_file_name)
-
-
-    # Ref: http://www.lovholm.net/2013/11/25/work-programmatically-with-google-spreadsheets-part-2/
-
-    gc = gspread.authorize(credentials)
+    gc = get_sheets_client(configs)
     route_workbook = gc.open(google_workbook_name)
 
     return route_workbook
@@ -253,7 +338,38 @@ def create_wrkbk_wrksht_output_dir(workbook, worksheet_title, configs):
         print(colored('Directory {} exists.'.format(output_dir), 'green'))
 
 
-def write_stop_times_file(workbook, worksheet_title, rows, columns, stops, worksheet_data, configs):
+def write_gtfs_rows(gtfs_file, gtfs_rows, workbook, worksheet_title, configs, feed=None):
+    """
+    Hand a worksheet's rows of one GTFS file to the worksheet's Feed, or without a feed write them with a header
+        to the worksheet directory.
+    :param gtfs_file: GTFS file name, ie., stops, stop_times, trips.
+    :param gtfs_rows: list of rows, each a tuple of values in header order.
+    :param workbook: workbook name
+    :param worksheet_title: worksheet name, the folder name of the worksheet feed files.
+    :param configs: Configuration object
+    :param feed: Feed object collecting the worksheet's tables, or None.
+    :return:
+    """
+    trace_add(configs, rows=len(gtfs_rows))
+    if feed is not None:
+        feed.add_rows(gtfs_file, gtfs_rows, source='{}.{}'.format(workbook, worksheet_title))
+        return
+
+    worksheet_name_output_dir = get_worksheet_name_output_dir(workbook, worksheet_title, configs)
+
+    # Overwrite with file header, then append the rows.
+    x = GtfsHeader()
+    x.write_header(gtfs_file, worksheet_name_output_dir)
+    gtfs_out = os.path.join(worksheet_name_output_dir, '{}.txt'.format(gtfs_file))
+    f = open(gtfs_out, "a")
+    for row in gtfs_rows:
+        f.write('{}\n'.format(','.join('{}'.format(value) for value in row)))
+    f.close()
+    trace_add(configs, written=os.path.getsize(gtfs_out))
+
+
+def write_stop_times_file(workbook, worksheet_title, rows, columns, stops, worksheet_data, configs, feed=None,
+                          trip_columns=None):
     """
 
     0 Tram / Light Rail
@@ -271,11 +387,10 @@ def write_stop_times_file(workbook, worksheet_title, rows, columns, stops, works
     :param stops: List of stops from previous operation.
     :param worksheet_data:
     :param configs: Configuration object
+    :param feed: Feed object for assembly mode, or None.
+    :param trip_columns: worksheet_data columns of the trips to write; all trip columns when None.
     :return:
     """
-    worksheet_name_output_dir = get_worksheet_name_output_dir(workbook, worksheet_title, configs)
-
-
 
     # If the route_type is a bus (route_type 3) then departure and arrival times are identical.
     # If not in spreadsheet, use default from config file.
@@ -285,18 +400,21 @@ def write_stop_times_file(workbook, worksheet_title, rows, columns, stops, works
         route_type = configs.default_route_type
 
     stop_time_data = []
+    trip_data = []
     trip_count = 0
     before_mid = ['1', '2', '3', '4', '5', '6', '7', '8', '9', '01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12', '13', '14', '15', '16', '17', '18', '19', '20', '21', '22', '23']
     after_mid  = ['0', '00', '24', '25', '26', '27', '28', '29', '30', '31', '32', '33', '34', '35', '36']
 
     # Outer loop (by columns) through trips. Trip column start in 27 in worksheet_data, ends with column: columns[-1]
-    for j in range(27, int(columns[-1])):
+    if trip_columns is None:
+        trip_columns = range(27, int(columns[-1]))
+    for j in trip_columns:
 
         # Build trip_id from workbook plus trip_id (worksheet_name) plus time header.
         trip_id = '{}-{}-{}'.format(workbook, worksheet_data[1][20], worksheet_data[2][j])
         # Create a trip.txt entry
 
-        write_trips_file(trip_id, worksheet_name_output_dir, workbook, worksheet_data, configs)
+        trip_data.append(get_trip_row(trip_id, workbook, worksheet_title, worksheet_data, configs))
         trip_count += 1
         # Begining of trip loop, set check to False.
         trip_start_check = False
@@ -314,8 +432,9 @@ def write_stop_times_file(workbook, worksheet_title, rows, columns, stops, works
             if worksheet_data[i][j]:
                 hour = worksheet_data[i][j].split(':') # properly formated time should split into 3
                 if len(hour) != 2: # Write excetion
-                    exception = 'Incorrect time format from spreadsheet:{}.'.format(hour)
-                    write_exception_file(exception, workbook, worksheet_title, configs)
+                    exception = 'Incorrect time format from spreadsheet:{} trip_id:{}.'.format(hour, trip_id)
+                    write_exception_file(exception, workbook, worksheet_title, configs, row=i + 1,
+                                         column=column_letters(j + 1), code='time_format', trip_id=trip_id)
                 trip_start_check = True
                 if hour[0] in before_mid:
                     if prev_depart_time[:2] in after_mid:
@@ -347,51 +466,28 @@ def write_stop_times_file(workbook, worksheet_title, rows, columns, stops, works
             distance_traveled   =  worksheet_data[i][25]
             # If trip start is False, then a time point has not been processed. Skip to next row.
             if trip_start_check is True:
-                stop_time_line = '{},{},{},{},{},{},{},{},{}'.format(trip_id, arrival_time, departure_time, stop_id, stop_sequence, stop_headsign, pickup_type, drop_off_type,
-                                                                     distance_traveled)
-                stop_time_data.append('{}\n'.format(stop_time_line))
+                stop_time_data.append((trip_id, arrival_time, departure_time, stop_id, stop_sequence, stop_headsign,
+                                       pickup_type, drop_off_type, distance_traveled))
             if configs.verbose:
                 print(colored(' previous dep:{}, this dep:{}'.format(prev_depart_time, departure_time),'green'))
             if departure_time:
                 prev_depart_time = departure_time
         # >>>>>>>>>> End of rows, check to see that last stop has time before writing <<<<<<<<<<
-    x = GtfsHeader()
-    x.write_header('stop_times', worksheet_name_output_dir)
-    gtfs_file = os.path.join(worksheet_name_output_dir, 'stop_times.txt')
-    f = open(gtfs_file, "a")
-    for stop_time in stop_time_data:
-        f.write(stop_time)
-    f.close()
+    write_gtfs_rows('trips', trip_data, workbook, worksheet_title, configs, feed)
+    write_gtfs_rows('stop_times', stop_time_data, workbook, worksheet_title, configs, feed)
     return
 
 
-def write_trips_header(workbook, worksheet_title, configs):
-    """
-    Open and write the header for all the GTFS files.
-    Args:
-        worksheet_title:
-        configs:
-
-    Returns:
-
-    """
-
-    worksheet_name_output_dir = get_worksheet_name_output_dir(workbook, worksheet_title, configs)
-
-    # File header
-    x = GtfsHeader()
-    x.write_header('trips', worksheet_name_output_dir)
-
-
-def write_trips_file(trip_id, worksheet_title, workbook, worksheet, configs):
+def get_trip_row(trip_id, workbook, worksheet_title, worksheet, configs):
     '''
-    Write trips values.
+    Collect trips values.
 
     route_id(r), service_id(r), trip_id(r), trip_headsign, trip_short_name, direction_id, block_id, shape_id,  wheelchair_acesible, bikes_allowed
     :param trip_id:
-    :param
-    :param
-    :return:
+    :param workbook:
+    :param worksheet_title:
+    :param worksheet: worksheet data
+    :return: trips.txt row
     '''
 
     # Collect all trips.txt values
@@ -415,32 +511,21 @@ def write_trips_file(trip_id, worksheet_title, workbook, worksheet, configs):
     wheelchair_acesible = '{}'.format(value[8])
     bikes_allowed = '{}'.format(value[9])
 
-    trip_line = '{},{},{},{},{},{},{},{},{},{}'.format(route_id, service_id, trip_id, trip_headsign,
-                                                       trip_short_name, direction_id, block_id, shape_id,
-                                                       wheelchair_acesible, bikes_allowed)
+    trip_row = (route_id, service_id, trip_id, trip_headsign, trip_short_name, direction_id, block_id, shape_id,
+                wheelchair_acesible, bikes_allowed)
     if configs.verbose:
-        print(colored(trip_line, color='green', on_color='on_white'))
+        print(colored(','.join(trip_row), color='green', on_color='on_white'))
 
     if not route_id and not service_id and not trip_id:
     # If any required value is empty write exception and continue loop
         exception = 'Required value missing. trip line i:{} route_id:{} service_id:{} trip_id:{}'.format(i, route_id, service_id, trip_id)
-        write_exception_file(exception, workbook, worksheet, configs)
+        write_exception_file(exception, workbook, worksheet_title, configs, row=2, code='trip_missing_value',
+                             trip_id=trip_id)
 
-    # Can't write trips header for each trip.
-    # worksheet_name_output_dir = get_worksheet_name_output_dir(worksheet_title, configs)
-    worksheet_name_output_dir = worksheet_title
+    return trip_row
 
-    # Open and append to  existing file
-    gtfs_file = os.path.join(worksheet_name_output_dir, 'trips.txt')
-    f = open(gtfs_file, "a+")
-    f.write('{}\n'.format(trip_line))
-    f.close()
 
-    if configs.verbose:
-        print('Writing trip {}... to {}'.format(trip_id, gtfs_file))
-
-
-def write_stops_file(all_stops, workbook, worksheet_title, rows, worksheet_data, configs):
+def write_stops_file(all_stops, workbook, worksheet_title, rows, worksheet_data, configs, feed=None):
     """
     GTFS stops.txt file from worksheet_data output in csv format with key values:
     stop_id,stop_code,stop_name,stop_desc,stop_lat,stop_lon,zone_id,stop_url,location_type,parent_station,
@@ -449,11 +534,11 @@ def write_stops_file(all_stops, workbook, worksheet_title, rows, worksheet_data,
     :param worksheet_title: Google Sheets worksheet_data name
     :param configs: configuration file values
     :param worksheet_data:
+    :param feed: Feed object for assembly mode, or None.
     :return None
     """
     # Keep a stops list of all stops in memory for stop_times stop_id check.
 
-    worksheet_name_output_dir = get_worksheet_name_output_dir(workbook, worksheet_title, configs)
     stops = []
     # Iterate across the valid rows. The worksheet_data data has 4 [rows] of static data.
     for i in range(3, len(rows)):
@@ -480,32 +565,27 @@ def write_stops_file(all_stops, workbook, worksheet_title, rows, worksheet_data,
         except IndexError:
             # Catch Out of Range error and write exception
             exception = 'IndexError. stop row i:{}'.format(i)
-            write_exception_file(exception, workbook, worksheet_title, configs)
+            write_exception_file(exception, workbook, worksheet_title, configs, row=i + 1, code='stop_row_short')
             print(colored(exception, color='red'))
             continue
 
         if stop_id and stop_name and stop_lat and stop_lon: # all required fields in worksheet?
-            stop = ('{},{},{},{},{:+.6f},{:+.6f},{},{},{},{},{},{}'.format(stop_id, stop_code, stop_name, stop_desc, float(stop_lat), float(stop_lon), zone_id, stop_url, loc_type, parent, timezone, wheel_board))
+            stop = (stop_id, stop_code, stop_name, stop_desc, '{:+.6f}'.format(float(stop_lat)), '{:+.6f}'.format(float(stop_lon)),
+                    zone_id, stop_url, loc_type, parent, timezone, wheel_board)
             stops.append(stop)
-            all_stops.append(stop)
+            all_stops.append(','.join('{}'.format(value) for value in stop))
             if configs.verbose:
                 print(colored('writing_stop --> stop_line:{}'.format(stop), color='blue', on_color='on_white'))
         else:
             # If any required value is empty write exception and continue loop
             exception = 'Required value missing. stop line i:{} stop_id:{} stop_name:{} stop_lat:{} stop_lon{}'.format(i, stop_id, stop_name, stop_lat, stop_lon)
-            write_exception_file(exception, workbook, worksheet_title, configs)
+            write_exception_file(exception, workbook, worksheet_title, configs, row=i + 1, code='stop_missing_value')
 
     # Remove duplicates
     lines_set = sorted(set(stops))
     stops = list(lines_set)
     # Write stops list to stops.txt with header.
-    x = GtfsHeader()
-    x.write_header('stops', worksheet_name_output_dir)
-    gtfs_file = os.path.join(worksheet_name_output_dir, 'stops.txt')
-    f = open(gtfs_file, "a+")
-    for stop in stops:
-        f.write('{}\n'.format(stop))
-    f.close()
+    write_gtfs_rows('stops', stops, workbook, worksheet_title, configs, feed)
 
     return all_stops
 
@@ -515,7 +595,7 @@ def mk_int(s):
     return int(s) if s else 0
 
 
-def write_calendar_file(workbook_title, worksheet_title, worksheet_data, configs):
+def write_calendar_file(workbook_title, worksheet_title, worksheet_data, configs, feed=None):
     '''
     Write a service calendar derived from the worksheet_data entries.
         Creates a service exception for the calendar service_id for each Holiday specified in the Config file.
@@ -523,10 +603,10 @@ def write_calendar_file(workbook_title, worksheet_title, worksheet_data, configs
     :param worksheet_title: Used to generate complete path to worksheet_data feed file.
     :param worksheet_data: Read the service_id and service DOW. Service dates are ignored as they are read from the Config.
     :param configs:
+    :param feed: Feed object for assembly mode, or None.
     :return:
     '''
 
-    wrkbk_wrksht_output_dir = get_worksheet_name_output_dir(workbook_title, worksheet_title, configs)
     calendar_list = []
 
     # REMEMBER Python counts begin at zero!
@@ -550,7 +630,7 @@ def write_calendar_file(workbook_title, worksheet_title, worksheet_data, configs
         sunday      = mk_int(sunday)
     except IndexError: # Out of bounds if there is no worksheet_data to process
         exception = 'Is there a worksheet_data referenced in calendar?.'
-        write_exception_file(exception, workbook_title, worksheet_data, configs)
+        write_exception_file(exception, workbook_title, worksheet_title, configs, row=2, code='calendar_row_short')
 
     end_date    = configs.feed_end_date     # Placeholders for feed dates in spreadsheet are ignored.
 
@@ -562,31 +642,23 @@ def write_calendar_file(workbook_title, worksheet_title, worksheet_data, configs
         start, end = check_calendar_length(date_now, configs.feed_end_date, configs)
 
 
-    calendar_info = '{},{},{},{},{},{},{},{},{},{}\n'.format(service_id, monday, tuesday,
-                                                             wednesday, thursday, friday, saturday, sunday,
-                                                             start, end)
+    calendar_info = (service_id, monday, tuesday, wednesday, thursday, friday, saturday, sunday, start, end)
 
     if not service_id and not monday and not tuesday and not wednesday and not thursday and not friday and not saturday and not sunday:
         # If any required value is empty write exception and continue loop
         exception = 'Required value missing in calendar.'
-        write_exception_file(exception, workbook_title, worksheet_data, configs)
+        write_exception_file(exception, workbook_title, worksheet_title, configs, row=2,
+                             code='calendar_missing_value')
 
     calendar_list.append(calendar_info)
 
-    # Open and append to existing file
-    # File header
-    x = GtfsHeader()
-    x.write_header('calendar', wrkbk_wrksht_output_dir)
-    gtfs_file = os.path.join(wrkbk_wrksht_output_dir, 'calendar.txt')
-    f = open(gtfs_file, "a+")
-    f.write('{}'.format(calendar_info))
-    f.close()
+    write_gtfs_rows('calendar', calendar_list, workbook_title, worksheet_title, configs, feed)
 
     if configs.verbose:
-        print('Writing calendar.txt to {}'.format(gtfs_file))
+        print('Writing calendar.txt for {}'.format(worksheet_title))
 
 
-def write_calendar_dates_file(service_id, workbook, worksheet_title, configs):
+def write_calendar_dates_file(service_id, workbook, worksheet_title, configs, feed=None):
     '''
     This function is called at the end of the write_calendar function, as the service_id required for
         the calendar_dates output is generated from the worksheet entries.
@@ -594,11 +666,10 @@ def write_calendar_dates_file(service_id, workbook, worksheet_title, configs):
     :param service_id: Service ID is the name of the servcie (e.g., weekday, saturday) from the worksheet
     :param worksheet_title: The worksheet title is also the folder name of the feed file location for the trip.
     :param configs: The configs object containing a holiday list and output locations
+    :param feed: Feed object for assembly mode, or None.
     :return:
     '''
 
-    worksheet_name_output_dir = get_worksheet_name_output_dir(workbook, worksheet_title, configs)
-
     # Display expected and received holidays to aid troubleshooting
     if configs.verbose:
         print('There are {} holidays in configs.'.format(len(configs.holidays.split(','))))
@@ -614,34 +685,23 @@ def write_calendar_dates_file(service_id, workbook, worksheet_title, configs):
             print('Returned formatted dates:{}'.format(dates))
 
     # Setup a line entry for each holiday
-    # File header
-    x = GtfsHeader()
-    x.write_header('calendar_dates', worksheet_name_output_dir)
     exception_type = '2'
-    # Open and append date to existing file
-    gtfs_file = os.path.join(worksheet_name_output_dir, 'calendar_dates.txt')
-    f = open(gtfs_file, "a+")
+    calendar_dates_rows = []
     for ex_day in dates:
-        calendar_dates_info = '{},{},{}\n'.format(service_id, ex_day, exception_type)
-        f.write('{}'.format(calendar_dates_info))
-    f.close()
+        calendar_dates_rows.append((service_id, ex_day, exception_type))
+    write_gtfs_rows('calendar_dates', calendar_dates_rows, workbook, worksheet_title, configs, feed)
     if configs.verbose:
-        print('Writing calendar_dates.txt to:{}...'.format(gtfs_file))
+        print('Writing calendar_dates.txt for:{}...'.format(worksheet_title))
 
 
-def write_routes_file(workbook, worksheet_title, worksheet_data, configs):
+def write_routes_file(workbook, worksheet_title, worksheet_data, configs, feed=None):
     """
 
     :param worksheet_data:
+    :param feed: Feed object for assembly mode, or None.
     :return:
     """
 
-    worksheet_name_output_dir = get_worksheet_name_output_dir(workbook, worksheet_title, configs)
-
-    x = GtfsHeader()
-    # File header
-    x.write_header('routes', worksheet_name_output_dir)
-
     # Worksheet data is in the third row; retrieved as the second list of row data, first when count from zero.
     # Address the nested list-static data as list[1] (second list)
 
@@ -658,25 +718,33 @@ def write_routes_file(workbook, worksheet_title, worksheet_data, configs):
     route_color         = worksheet_data[1][16]
     route_text_color    = worksheet_data[1][17]
 
-    route_info = '{},{},{},{},{},{},{},{},{}\n'.format(route_id, agency_id, route_short_name,
-                                                       route_long_name, route_desc, route_type, route_url, route_color,
-                                                       route_text_color)
+    route_info = (route_id, agency_id, route_short_name, route_long_name, route_desc, route_type, route_url, route_color,
+                  route_text_color)
 
-    # Open and append to existing file
-    gtfs_file = os.path.join(worksheet_name_output_dir, 'routes.txt')
-    f = open(gtfs_file, "a+")
-    f.write('{}'.format(route_info))
-    print('Writing routes.txt to {}'.format(gtfs_file))
-    f.close()
+    print('Writing routes.txt for {}'.format(worksheet_title))
+    write_gtfs_rows('routes', [route_info], workbook, worksheet_title, configs, feed)
 
 
-def write_feed_info_file(workbook, worksheet_title, configs):
+def get_feed_version(configs):
+    """
+    Feed version is the date and hour of run. Stamped once per run by render_static_tables.
+    :param configs: arguments from the configuration file.
+    :return: feed_version string
+    """
+    # Pandas is timezone unaware.
+    ts = pd.to_datetime('now').tz_localize('utc')
+    local_time = ts.tz_convert(configs.local_tz)
+    feed_version= local_time.strftime("%Y%m%d.%-H")
+    return feed_version
 
-    worksheet_name_output_dir = get_worksheet_name_output_dir(workbook, worksheet_title, configs)
 
-    # File header
-    x = GtfsHeader()
-    x.write_header('feed_info', worksheet_name_output_dir)
+def get_feed_info_rows(feed_version, configs):
+    """
+    Collect feed_info.txt values from the configuration file.
+    :param feed_version: feed_version of this run.
+    :param configs: arguments from the configuration file.
+    :return: list of feed_info.txt rows
+    """
 
     if not configs.feed_start_date:
         start_date = pd.to_datetime('today')
@@ -689,66 +757,35 @@ def write_feed_info_file(workbook, worksheet_title, configs):
     start_date  = start_date.strftime('%Y%m%d')
     end_date    = end_date.strftime('%Y%m%d')
 
-    # Feed version is the date and hour of run. Pandas is timezone unaware.
-    ts = pd.to_datetime('now').tz_localize('utc')
-    local_time = ts.tz_convert(configs.local_tz)
-    feed_version= local_time.strftime("%Y%m%d.%-H")
+    feed_info = (configs.feed_publisher_name, configs.feed_publisher_url, configs.feed_lang, start_date, end_date,
+                 feed_version)
 
-    feed_info = '{},{},{},{},{},{}\n'.format(configs.feed_publisher_name, configs.feed_publisher_url, configs.feed_lang,
-                                             start_date, end_date, feed_version)
+    return [feed_info]
 
-    print('Writting feed_info.txt to {}'.format(worksheet_name_output_dir))
 
-    # Open and overwrite existing file
-    gtfs_file = os.path.join(worksheet_name_output_dir, 'feed_info.txt')
-    f = open(gtfs_file, "a+")
-    f.write('{}'.format(feed_info))
-    f.close()
-
-
-def write_agency_file(workbook, worksheet_title, configs):
+def get_agency_rows(configs):
     '''
-    Write agency.txt from values in configuration file.
+    Collect agency.txt values from the configuration file.
 
-    :param worksheet_title: present worksheet name. If none then the 'master' GTFS feed.
     :param configs: arguments from the configuration file.
-    :return:
+    :return: list of agency.txt rows
     '''
 
-    wrkbk_wrksht_output_dir = get_worksheet_name_output_dir(workbook, worksheet_title, configs)
+    agency_info = (str(configs.agency_id), str(configs.agency_name), str(configs.agency_url),
+                   str(configs.agency_timezone), str(configs.agency_lang), str(configs.agency_phone))
 
-    # Overwrite with file header
-    x = GtfsHeader()
-    x.write_header('agency', wrkbk_wrksht_output_dir)
-
-    # Agency.txt information
-    print('Writing agency.txt to {}'.format(wrkbk_wrksht_output_dir))
-    agency_info = '{},{},{},{},{},{}'.format(str(configs.agency_id), str(configs.agency_name), str(configs.agency_url),
-                                             str(configs.agency_timezone), str(configs.agency_lang), str(configs.agency_phone))
+    return [agency_info]
 
 
-    # Write info line to file
-    f = open(os.path.join(wrkbk_wrksht_output_dir,'agency.txt'), "a+")
-    f.write('{}\n'.format(agency_info))
-    f.close()
-
-
-def write_fare_rules_file(workbook, worksheet_title, configs):
+def get_fare_rules_rows(configs):
     '''
-    Incomplete; writes the required fare_id.
+    Incomplete; collects the required fare_id.
     fare_id(r),route_id(o),origin_id(o),destination_id(o),contains_id(o)
 
-    :param worksheet_title:
     :param configs:
-    :return:
+    :return: list of fare_rules.txt rows
     '''
 
-    worksheet_name_output_dir = get_worksheet_name_output_dir(workbook, worksheet_title, configs)
-
-    # File header
-    x = GtfsHeader()
-    x.write_header('fare_rules', worksheet_name_output_dir)
-
     # Fare_rules are in the configuration file. Make config string into list.
     fare_ids        = configs.fare_ids.split(',')
     route_ids       = ''
@@ -756,72 +793,107 @@ def write_fare_rules_file(workbook, worksheet_title, configs):
     destination_ids = ''
     contains_ids    = ''
     # Construct line info
+    fare_rules = []
     for i in range(len(fare_ids)):
-        line = '{},{},{},{},{}\n'.format(fare_ids[i], route_ids, origin_ids, destination_ids, contains_ids)
+        fare_rules.append((fare_ids[i], route_ids, origin_ids, destination_ids, contains_ids))
 
-        # Append info existing file
-        gtfs_file = os.path.join(worksheet_name_output_dir, 'fare_rules.txt')
-        f = open(gtfs_file, "a+")
-        f.write('{}'.format(line))
-    f.close()
+    return fare_rules
 
 
-def write_fare_attributes_file(workbook, worksheet_title, configs):
+def get_fare_attributes_rows(configs):
     '''
-    Write fare_attributes.txt from values in configuration file.
+    Collect fare_attributes.txt values from the configuration file.
 
     fare_id(r),price(r),currency_type(r),payment_method(r),transfers(r),transfer_duration(O)
 
-    :param worksheet_title: present worksheet name. If none then the 'master' GTFS feed.
     :param configs: arguments from the configuration file.
-    :return:
+    :return: list of fare_attributes.txt rows
     '''
 
-    # Setup output file location
-    worksheet_name_output_dir = get_worksheet_name_output_dir(workbook, worksheet_title, configs)
-
-    # Overwrite with file header
-    x = GtfsHeader()
-    x.write_header('fare_attributes', worksheet_name_output_dir)
-
     # Fare_rules are in the configuration file. Make config string into list.
     fare_ids = configs.fare_ids.split(',')
     prices  = configs.prices.split(',')
     transfers = configs.transfers.split(',')
     durations = configs.durations.split(',')
     # Construct line info
+    fare_attributes = []
     for i in range(len(fare_ids)):
-        line = '{},{},{},{},{},{}\n'.format(fare_ids[i], prices[i], configs.currency, configs.payment_method, transfers[i], durations[i])
-        # Write info line to file
-        gtfs_file = os.path.join(worksheet_name_output_dir, 'fare_attributes.txt')
-        f = open(gtfs_file, "a+")
-        f.write('{}'.format(line))
-    f.close()
+        fare_attributes.append((fare_ids[i], prices[i], configs.currency, configs.payment_method, transfers[i], durations[i]))
 
+    return fare_attributes
 
-def create_exceptions_file(configs):
 
-    if not os.path.exists(os.path.expanduser(configs.report_path)):
-        os.makedirs(os.path.expanduser(configs.report_path))
-    exception_file = os.path.join(os.path.expanduser(configs.report_path), 'exceptions.txt')
-    # Overwrite existing file
-    f = open(exception_file, "w")
-    f.write('GTFS Generator Process start:{}\n'.format(pd.to_datetime('now').strftime("%c")))
-    f.close()
+def render_static_tables(configs):
+    """
+    Render the feed-level tables derived only from the configuration file (agency, fare_attributes, fare_rules,
+        feed_info) once per run. Every worksheet directory and the master feed receive the same bytes and feed_version.
+    :param configs: arguments from the configuration file.
+    :return: StaticTables object
+    """
+    feed_version = get_feed_version(configs)
+    rows = {'agency':           get_agency_rows(configs),
+            'fare_attributes':  get_fare_attributes_rows(configs),
+            'fare_rules':       get_fare_rules_rows(configs),
+            'feed_info':        get_feed_info_rows(feed_version, configs)}
+    if configs.verbose:
+        print('Rendered static tables {} with feed_version {}.'.format(sorted(rows), feed_version))
+    return StaticTables(rows, feed_version)
 
 
-def write_exception_file(exception, workbook, worksheet, configs):
+def write_static_tables(static_tables, workbook, worksheet_title, configs):
+    """
+    Write the rendered static tables to the worksheet directory.
+    :param static_tables: StaticTables object from render_static_tables
+    :param workbook: workbook name
+    :param worksheet_title: worksheet name
+    :param configs: arguments from the configuration file.
+    :return:
+    """
+    worksheet_name_output_dir = get_worksheet_name_output_dir(workbook, worksheet_title, configs)
+    static_tables.write(worksheet_name_output_dir)
+    if configs.verbose:
+        print('Writing {} to {}'.format(', '.join(sorted(static_tables.content)), worksheet_name_output_dir))
+
 
-    # TODO Delete this
-    # worksheet_name_output_dir = get_worksheet_name_output_dir(worksheet_title, configs)
+def write_exception_file(exception, workbook, worksheet, configs, now=None, row=None, column=None, code=None,
+                         trip_id=None):
+    """
+    Record an exception of the run; the run's ExceptionLog writes them all to exceptions.jsonl and exceptions.txt
+        when it ends.
+    :param exception: message
+    :param workbook: workbook name
+    :param worksheet: worksheet name
+    :param configs: Configuration object
+    :param now: seconds since the epoch, the current time if None
+    :param row: 1-based worksheet row, or None
+    :param column: worksheet column letters, or None
+    :param code: kind of exception, ie., time_format, to group and count exceptions by
+    :param trip_id: trip the exception belongs to, or None
+    :return:
+    """
+    if now is None:
+        now = time.time()
+    add_exceptions([ExceptionRecord(exception, workbook, worksheet, now, row, column, code, trip_id)], configs)
 
-    exception_file = os.path.join(os.path.expanduser(configs.report_path), 'exceptions.txt')
 
-    # Open and append existing file (clear the file before opening the worksheet)
-    f = open(exception_file, "a")
-    now = pd.to_datetime('now').strftime("%c")
-    f.write('Workbook: {} Worksheet:{}\n   exception:{}  {} '.format(workbook, worksheet, exception, now))
-    f.close()
+def add_exceptions(records, configs):
+    """
+    Add exceptions to the buffer of a worker, pipeline item or worksheet build, which returns them to the
+        coordinator to add in worksheet order, or else to the run's ExceptionLog. Outside a run they are printed.
+    :param records: ExceptionRecords, or the (exception, workbook, worksheet, time) and (exception, workbook,
+        worksheet, time, code, trip_id) tuples of an older build graph
+    :param configs: Configuration object
+    :return:
+    """
+    exception_buffer = getattr(configs, 'exception_buffer', None)
+    if exception_buffer is not None:
+        exception_buffer.extend(exception_record(record) for record in records)
+    elif getattr(configs, 'exception_log', None) is not None:
+        configs.exception_log.add(records)
+    else:
+        for record in map(exception_record, records):
+            print(colored('Workbook: {} Worksheet:{} exception:{}'.format(record.workbook, record.worksheet,
+                                                                          record.message), 'red'))
 
 
 def get_root_from_kml(kmlFile):
@@ -866,16 +938,7 @@ def get_coords_elements_from_root(root):
         return allCoordsElements
 
 
-def write_shapes_header(workbook, worksheet_title, configs):
-
-    worksheet_name_output_dir = get_worksheet_name_output_dir(workbook, worksheet_title, configs)
-
-    # File header
-    x = GtfsHeader()
-    x.write_header('shapes', worksheet_name_output_dir)
-
-
-def write_shape_from_kml(shapeID, workbook, title, configs):
+def write_shape_from_kml(shapeID, workbook, title, configs, feed=None):
     """
     Function constructs a .kml and .txt filename from the worksheet entry.
     If the kml_txt exists, then the text file contains two or more kml entries to be concatenated together into
@@ -884,6 +947,7 @@ def write_shape_from_kml(shapeID, workbook, title, configs):
     :param shapeID: The shapeID from worksheet. No extension!
     :param title: The spreadsheet title.
     :param configs: The configuration file object.
+    :param feed: Feed object for assembly mode, or None.
     :return:
     """
 
@@ -894,10 +958,17 @@ def write_shape_from_kml(shapeID, workbook, title, configs):
 
     # print('  Looking for KML file or list: {} from worksheet:{} in path\n   KML {}\n   TXT {}'.format(shapeID, title, tripKML_loc, tripKML_txt_loc))
 
-    worksheet_name = title
+    shape_rows = []
 
-    shapetxt_out = os.path.join(os.path.expanduser(configs.gtfs_path_root), workbook, worksheet_name, 'shapes.txt')
-    # print('   shapes.txt output to:{}'.format(shapetxt_out))
+    # Shapes shared by several worksheets or agencies are built once per KML file state.
+    cache_key, states = get_shape_cache_key(shapeID, tripKML_loc, tripKML_txt_loc, configs)
+    cached = get_cached_shape(cache_key, states)
+    if cached is not None:
+        trace_count(configs, 'shape_cache.hits')
+        print(colored('  Shape:{} unchanged KML, rows cached'.format(shapeID), color='blue'))
+        write_gtfs_rows('shapes', list(cached), workbook, title, configs, feed)
+        return
+    trace_count(configs, 'shape_cache.misses')
 
     # Single KML file processing.
     if os.path.isfile(tripKML_loc):
@@ -907,7 +978,7 @@ def write_shape_from_kml(shapeID, workbook, title, configs):
         last_sequence_number = 0
         accumulated_distance = 0.0
         allNameElements, allCoordsElements = get_kml_elements(tripKML_loc)
-        write_coords_to_file(shapetxt_out, allNameElements, allCoordsElements, shapeID, last_sequence_number,
+        write_coords_to_file(shape_rows, allNameElements, allCoordsElements, shapeID, last_sequence_number,
                              accumulated_distance, configs)
 
     # Multiple KML file processing. Read KML filenames from a text file with the name of the shapeID.
@@ -927,13 +998,70 @@ def write_shape_from_kml(shapeID, workbook, title, configs):
                 print('    processing KML file:{}'.format(item))
                 tripKML_loc = os.path.join(os.path.expanduser(configs.kml_files_root), item)
                 allNameElements, allCoordsElements = get_kml_elements(tripKML_loc)
-                last_sequence_number, accumulated_distance = write_coords_to_file(shapetxt_out, allNameElements, allCoordsElements, shapeID, last_sequence_number, accumulated_distance, configs)
+                last_sequence_number, accumulated_distance = write_coords_to_file(shape_rows, allNameElements, allCoordsElements, shapeID, last_sequence_number, accumulated_distance, configs)
     # No KML or TXT files found
     else:
         print(colored('  KML nor TXT: {} found in directory: {}'.format(tripKML, configs.kml_files_root), 'red'))
         exception = 'KML or TXT not found in\n   {}.'.format(configs.kml_files_root)
         worksheet = title
-        write_exception_file(exception, workbook, worksheet, configs)
+        write_exception_file(exception, workbook, worksheet, configs, code='kml_not_found')
+
+    if shape_rows:
+        cache_shape(cache_key, states, list(shape_rows))
+    write_gtfs_rows('shapes', shape_rows, workbook, title, configs, feed)
+
+
+def get_shape_cache_key(shapeID, kml_file, txt_file, configs):
+    """
+    Key of a shape in shape_cache, the shape and distance units, and the (path, mtime, size) of the KML files it is
+        built from, so an edited file is parsed again.
+    :return: key, states
+    """
+    paths = [kml_file, txt_file]
+    if not os.path.isfile(kml_file) and os.path.isfile(txt_file):
+        with open(txt_file, 'r') as kml_list:
+            paths += [os.path.join(os.path.expanduser(configs.kml_files_root), item)
+                      for item in kml_list.readline().split(',')]
+    states = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            states.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            states.append((path, None, None))
+    return (shapeID, configs.dist_units), tuple(states)
+
+
+def get_cached_shape(cache_key, states):
+    """
+    Shape rows cached for the current state of the shape's KML files.
+    :param cache_key: shape and distance units
+    :param states: (path, mtime, size) of the KML files
+    :return: list of shape rows, or None.
+    """
+    with cache_lock:
+        cached = shape_cache.get(cache_key)
+        if cached is None or cached[0] != states:
+            return None
+        shape_cache.move_to_end(cache_key)
+        return cached[1]
+
+
+def cache_shape(cache_key, states, shape_rows):
+    """
+    Cache the rows of a shape, replacing those built from an earlier state of its KML files, and drop the least
+        recently used shapes past shape_cache_limit points.
+    :param cache_key: shape and distance units
+    :param states: (path, mtime, size) of the KML files
+    :param shape_rows: list of shape rows
+    :return:
+    """
+    with cache_lock:
+        shape_cache.pop(cache_key, None)
+        shape_cache[cache_key] = (states, shape_rows)
+        points = sum(len(rows) for states, rows in shape_cache.values())
+        while points > shape_cache_limit and len(shape_cache) > 1:
+            points -= len(shape_cache.popitem(last=False)[1][1])
 
 
 def get_vincenty_distance(point1, point2, configs):
@@ -958,10 +1086,10 @@ def get_vincenty_distance(point1, point2, configs):
     return d
 
 
-def write_shape_line(shape_txt_out, shapeID, lat2, lng2, last_sequence_number, accumulated_distance):
+def write_shape_line(shape_rows, shapeID, lat2, lng2, last_sequence_number, accumulated_distance):
     """
 
-    :param shape_txt_out:
+    :param shape_rows: list collecting the shapes.txt rows of the worksheet
     :param shapeID:
     :param lat2:
     :param lng2:
@@ -969,17 +1097,13 @@ def write_shape_line(shape_txt_out, shapeID, lat2, lng2, last_sequence_number, a
     :param accumulated_distance:
     :return:
     """
-    # Write each output line in shapes.txt
-    f = open(shape_txt_out, 'a')
+    # Collect each output line in shapes.txt
     # Removed distance to previous point.
-    line_out = "{}, {:.6f}, {:.6f}, {}, {:.2f}\n".format \
-        (shapeID, lat2, lng2, last_sequence_number, accumulated_distance)
-    # print(' shape_txt_out:{}'.format(shape_txt_out))
-    # print('  write_shape_line:{}'.format(line_out))
-    f.write(line_out)
+    shape_rows.append((shapeID, '{:.6f}'.format(lat2), '{:.6f}'.format(lng2), last_sequence_number,
+                       '{:.2f}'.format(accumulated_distance)))
 
 
-def write_coords_to_file(shape_txt_out, allNameElements, allCoordsElements, shapeID, last_sequence_number, accumulated_distance, configs):
+def write_coords_to_file(shape_rows, allNameElements, allCoordsElements, shapeID, last_sequence_number, accumulated_distance, configs):
     # Write the KML line coordinate pairs, sequence number, distance, accumulated distance
     lat1 = 0.0
     lng1 = 0.0
@@ -1011,8 +1135,7 @@ def write_coords_to_file(shape_txt_out, allNameElements, allCoordsElements, shap
                 accumulated_distance = distance + accumulated_distance
 
                 # Write the line to the shapes.txt file
-                write_shape_line(shape_txt_out, shapeID, lat2, lng2, last_sequence_number, accumulated_distance)
-                # write_shape_line(shape_txt_out, shapeID, lat2, lng2, last_sequence_number, accumulated_distance, distance)
+                write_shape_line(shape_rows, shapeID, lat2, lng2, last_sequence_number, accumulated_distance)
 
                 # Assign coordinates to previous
                 lat1 = lat2
@@ -1023,7 +1146,24 @@ def write_coords_to_file(shape_txt_out, allNameElements, allCoordsElements, shap
     return last_sequence_number, accumulated_distance
 
 
-def create_gtfs_zip(output_path, out_filename):
+def create_gtfs_zip(output_path, out_filename, configs=None, sheet=None, static_tables=None):
+    """
+    Zip the worksheet GTFS files as <output_path>/<out_filename>.zip.
+    :param output_path: worksheet directory
+    :param out_filename: zip name, the worksheet title
+    :param configs: Configuration object; zip_level and zip_threads set the compression.
+    :param sheet: the worksheet's tables as a Feed. When given, rows are streamed straight into the zip members
+        and an archive with unchanged content is not rewritten.
+    :param static_tables: StaticTables of the run, zipped from their rendered bytes.
+    :return:
+    """
+
+    if sheet is not None:
+        zip_file = os.path.join(output_path, '{}.zip'.format(out_filename))
+        written = sheet.write_zip(zip_file, configs.zip_level, configs.zip_threads, static_tables)
+        if configs.verbose and not written:
+            print('{} unchanged, not rewritten.'.format(zip_file))
+        return
 
     # http://effbot.org/librarybook/zipfile.htm
     zfile = zipfile.ZipFile("{}/{}.zip".format(output_path, out_filename), "w")
@@ -1040,21 +1180,23 @@ def create_gtfs_zip(output_path, out_filename):
     #     print('   {}'.format(out_filename))
 
 
-def run_validator(start_time, folder_path, filename, configs):
+def run_validator(start_time, folder_path, filename, configs, cache=None):
     '''
-    Run feedvalidator.py (Python 2.5) against each worksheet's GTFS feed.
+    Run feedvalidator.py (Python 2.5) against a GTFS feed and wait for it. Worksheet feeds are validated in the
+        background by a ValidationScheduler instead.
 
     :param folder_path: subfolder with worksheet gtfs files
     :param filename: name of the worksheet zip file = worksheet title or combined feed filename
     :param configs: arguments from the configuration file
+    :param cache: ValidationCache, or None
     :return:
     '''
 
     gtfs_zip    = os.path.join(os.path.expanduser(configs.gtfs_path_root), folder_path, filename + '.zip')
     # print('folder path:{}\n filename:{}\n  gtfs_zip:{}'.format(folder_path, filename, gtfs_zip))
-    os.chdir(os.path.join(expanduser(configs.gtfs_path_root), folder_path))
-    # TODO Redirect stdout and stderr to variable
-    subprocess.run(['feedvalidator.py','-n','-o','validator.html', '{}'.format(gtfs_zip)])
+    label, returncode, seconds, output = validate_feed(gtfs_zip, os.path.join(expanduser(configs.gtfs_path_root),
+                                                                               folder_path), filename, cache)
+    print(output)
     # note = '\nValidation{}'.format( 40 * '=')
     # print_et(text_color='green', start_time=start_time, title='Validation results.', note=note, configs=configs)
     # print(colored('{} FeedValidator complete {}'.format(15 * '^', 15 * '^'), 'cyan', 'on_grey'))
@@ -1123,14 +1265,9 @@ def get_excel_worksheet_row_col_list(column_list, worksheet, configs):
 def get_google_worksheet_data(row_list, worksheet, workbook_title, configs):
 
     worksheet_data = []
-    try:
-        for row in row_list:
-            worksheet_data.append(worksheet.row_values(row))
-        return worksheet_data
-    except etree.ElementTree.ParseError:
-        exception = 'Google drive may have timed out on workbook:worksheet {}:{}.'.format(workbook_title, worksheet)
-        write_exception_file(exception, workbook_title, worksheet, configs)
-        return "Googe Drive ElementTree.ParseError"
+    for row in row_list:
+        worksheet_data.append(worksheet.row_values(row))
+    return worksheet_data
 
 
 def get_excel_worksheet_data(row_list, worksheet):
@@ -1201,8 +1338,7 @@ def write_run_info_to_file(elapsed_time, title, note, configs):
     :return:
     """
     # Open and append to  existing file
-    ts = pd.to_datetime('now').tz_localize('utc')
-    local_time = ts.tz_convert(configs.local_tz)
+    local_time = pd.Timestamp.now(tz=configs.local_tz)
     # print('from write_run_info_to_file\n filename:{}\n et:{} seconds'.format\
     #          (os.path.join(configs.report_path, configs.stats_filename), elapsed_time))
     if  not os.path.exists(os.path.expanduser(configs.report_path)):
@@ -1229,7 +1365,7 @@ def print_et (text_color, start_time, title, note, configs):
 
     stop_time = datetime.now()
     tdelta = stop_time - start_time
-    tdelta = tdelta.seconds
+    tdelta = round(tdelta.total_seconds(), 3)
     tdelta_colored = colored(tdelta, text_color, 'on_grey')
     c_note = colored(note, text_color)
     print('Elapsed Time: {} seconds. {} time stamp {}'.format(tdelta_colored, c_note, stop_time.strftime('%c')))
@@ -1270,10 +1406,19 @@ def run_schedule_viewer(configs):
     subprocess.run(['schedule_viewer.py','{}'.format(gtfs_zip)])
 
 
+def get_ignore_list(configs):
+    """
+    Worksheet titles never built, ie., Master and Template, from the comma separated ignore_sheets.
+    :param configs: Configuration object
+    :return: list of worksheet titles
+    """
+    return configs.ignore_sheets.split(',')
+
+
 def google_worksheets_by_workbook_to_dict(configs):
     workbooks = configs.google_workbook_names.split(',')
     wkbk_dict = {}
-    ignore = configs.ignore_sheets
+    ignore = get_ignore_list(configs)
     for workbook in workbooks:
         route_workbook = open_google_workbook(workbook, configs)
         worksheets = route_workbook.worksheets()
@@ -1327,6 +1472,65 @@ def copy_file(start_time, configs):
              note=note, configs=configs)
 
 
+def export_columnar(configs):
+    '''
+    Export the agency zip as typed columnar tables in gtfs_path_root (--columnar arrow or parquet).
+    :param configs: arguments from the configuration file.
+    :return:
+    '''
+    gtfs_zip = os.path.join(os.path.expanduser(configs.gtfs_path_root), configs.agency_id + '.zip')
+    written = write_columnar(gtfs_zip, get_columnar_dir(configs), configs.columnar)
+    if written:
+        print('{} tables exported to {}'.format(len(written), get_columnar_dir(configs)))
+
+
+def get_store_file(configs):
+    '''
+    Path of the SQLite feed store, <gtfs_path_root>/<agency_id>.sqlite.
+    :param configs: arguments from the configuration file.
+    :return:
+    '''
+    return os.path.join(os.path.expanduser(configs.gtfs_path_root), configs.agency_id + '.sqlite')
+
+
+def get_build_graph_file(configs):
+    '''
+    Path of the build database, <report_path>/build_graph.sqlite.
+    :param configs: arguments from the configuration file.
+    :return:
+    '''
+    return os.path.join(os.path.expanduser(configs.report_path), 'build_graph.sqlite')
+
+
+def get_checkpoint_file(configs):
+    '''
+    Path of the run checkpoint, <report_path>/checkpoint.sqlite.
+    :param configs: report_path
+    :return:
+    '''
+    return os.path.join(os.path.expanduser(configs.report_path), 'checkpoint.sqlite')
+
+
+def get_queue_file(configs):
+    '''
+    Path of the work queue of --distribute and --worker: --queue, or <gtfs_path_root>/work_queue.sqlite on the
+        filesystem the coordinator and the workers share.
+    :param configs: queue, gtfs_path_root
+    :return:
+    '''
+    if configs.queue:
+        return os.path.expanduser(configs.queue)
+    return os.path.join(os.path.expanduser(configs.gtfs_path_root), 'work_queue.sqlite')
+
+
+def get_worksheet_zip(workbook_title, worksheet_title, configs):
+    '''
+    Path of a worksheet zip, <gtfs_path_root>/<workbook>/<worksheet>/<worksheet>.zip.
+    '''
+    return os.path.join(os.path.expanduser(configs.gtfs_path_root), workbook_title, worksheet_title,
+                        worksheet_title + '.zip')
+
+
 def read_stops(configs):
     """
     Read a GTFS stops.txt to a list.
@@ -1335,11 +1539,13 @@ def read_stops(configs):
     """
     stops_file = os.path.join(os.path.expanduser(configs.gtfs_path_root),'stops.txt')
     stops = []
-    with open(stops_file, 'r') as f:
-        for line in f.readlines():
-            stop_id,stop_code,stop_name,stop_desc,stop_lat,stop_lon,zone_id,stop_url,location_type, parent_station,stop_timezone,wheelchair_boarding = line.strip().split(',')
-            stops.append((stop_id,stop_code,stop_name,stop_desc,stop_lat,stop_lon,zone_id,stop_url,location_type, parent_station,stop_timezone,wheelchair_boarding))
-        stops.pop(0)
+    # csv handles quoted commas, i.e., a stop_name of "Main St, North".
+    with open(stops_file, 'r', newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            if row:
+                stops.append(tuple(value.strip() for value in row))
     return stops
 
 
@@ -1356,31 +1562,1374 @@ def write_proc_sheet_list(p_list, configs):
     f.close()
 
 
-def report_errors(configs):
+def report_errors(configs, wrkbk_dict=None):
+    '''
+    Consolidate the structured validation results of the output tree into validation_report.txt/.json, offline.
+    :param configs: arguments from the configuration file.
+    :param wrkbk_dict: Dictionary of the workbook/worksheet pairs built; results of other worksheets are deleted.
+        None reports every result found.
+    :return: dictionary of severity to total count
+    '''
+    worksheets = None
+    if wrkbk_dict is not None:
+        worksheets = ['{}/{}'.format(workbook, worksheet) for workbook, worksheet_titles in wrkbk_dict.items()
+                      for worksheet in worksheet_titles]
+    totals = aggregate_reports(os.path.expanduser(configs.gtfs_path_root), os.path.expanduser(configs.report_path),
+                               worksheets)
+    print('Validation report: errors:{} warnings:{} written to {}'.format(
+        totals['error'], totals['warning'], os.path.join(os.path.expanduser(configs.report_path), 'validation_report.txt')))
+    return totals
+
+
+def fetch_worksheet_data(worksheet, workbook_title, configs):
+    '''
+    Retrieve the rows of a worksheet that hold route, trip and stop data. A fetch that times out is retried
+        --fetch_retries times, waiting --fetch_backoff seconds, doubled after every attempt.
+    :param worksheet: gspread worksheet
+    :param workbook_title: workbook name
+    :param configs: Configuration object
+    :return: (row numbers, column numbers with trip times, worksheet data as a list of row values)
+    :raises SheetFetchError: the worksheet could not be retrieved.
+    '''
+    wait = configs.fetch_backoff
+    for attempt in range(configs.fetch_retries + 1):
+        try:
+            with span(configs, 'fetch', worksheet='{}.{}'.format(workbook_title, worksheet.title),
+                      attempt=attempt + 1) as fetch_span:
+                data = fetch_worksheet_rows(worksheet, workbook_title, configs)
+                fetch_span.add(rows=len(data[0]))
+            return data
+        except fetch_errors as e:
+            if attempt == configs.fetch_retries:
+                exception = 'Google drive may have timed out on workbook:worksheet {}:{} after {} attempts: {!r}.'\
+                    .format(workbook_title, worksheet.title, attempt + 1, e)
+                write_exception_file(exception, workbook_title, worksheet.title, configs, code='fetch_failed')
+                raise SheetFetchError(exception)
+            print(colored('  Fetch of {}.{} failed: {!r}; retrying in {:.1f}s'.format(
+                workbook_title, worksheet.title, e, wait), 'yellow'))
+            time.sleep(wait)
+            wait *= 2
+
+
+def fetch_worksheet_rows(worksheet, workbook_title, configs):
+    '''
+    One attempt of fetch_worksheet_data.
+    '''
+    # Required rows: r2=headings(optional) r3=data r6=trip headings from configuration
+    head_data_rows = [int(s) for s in configs.head_data_rows.split(",")]
+
+    # Required columns: 2=stop seq 3=stopID 10-21=stop info 22-25=trip info from configuration file.
+    stops_column_list = [int(s) for s in configs.stop_data_columns.split(",")]
+
+    row_list = []
+    ws_data = []
+    if configs.source_type in ('google', 'local', 'memory'):
+
+        # Return a list of row numbers that contain stop data; append columns with time data
+        stop_rows, stops_column_list = get_google_worksheet_row_col_list(stops_column_list, worksheet, configs)
+        # Combine static (non-stop info) and dynamic (stop info) row numbers
+        row_list = head_data_rows + stop_rows
+        row_list.sort()
+
+        # Get the cell values for all rows with information from the G_worksheet.
+        ws_data = get_google_worksheet_data(row_list, worksheet, workbook_title, configs)
+    return row_list, stops_column_list, ws_data
+
+
+def write_worksheet_zip(workbook_title, worksheet_title, sheet, static_tables, configs):
+    '''
+    Zip the worksheet's GTFS files and record their manifest for the incremental merge.
+    :param workbook_title: workbook name
+    :param worksheet_title: worksheet name, also the zip name
+    :param sheet: the worksheet's tables as a Feed
+    :param static_tables: StaticTables of the run
+    :param configs: arguments from the configuration file.
+    :return: worksheet directory
+    '''
+    if configs.verbose:
+        print('Zipping GTFS.txt files...')
+    output_path = os.path.join(os.path.expanduser(configs.gtfs_path_root), workbook_title, worksheet_title)
+    with span(configs, 'zip', worksheet='{}.{}'.format(workbook_title, worksheet_title)) as zip_span:
+        create_gtfs_zip(output_path, worksheet_title, configs, sheet, static_tables)
+        zip_span.add(written=os.path.getsize(os.path.join(output_path, worksheet_title + '.zip')))
+
+        # Record content hashes and row counts for the incremental merge.
+        GtfsWrite().write_manifest(output_path)
+    return output_path
+
+
+def build_worksheet_job(workbook_title, worksheet_title, row_list, stops_column_list, ws_data, configs, static_tables,
+                        trace_parent=None):
+    '''
+    Build one worksheet in a --jobs worker process, or in process on a copy of configs: tables, worksheet files and
+        zip. Nothing is shared with the coordinator; the worksheet's stops, tables and exceptions are returned for it
+        to merge in worksheet order.
+    :param workbook_title: workbook name
+    :param worksheet_title: worksheet name
+    :param row_list: row numbers with stop data
+    :param stops_column_list: column numbers with trip times
+    :param ws_data: worksheet data fetched by the coordinator
+    :param configs: Configuration object
+    :param static_tables: StaticTables of the run
+    :param trace_parent: id of the coordinator's worksheet span, to nest the stage spans under
+    :return: (stops as in all_stops, the worksheet's tables as a Feed, list of ExceptionRecord)
+    '''
+    configs.exception_buffer = []
+    worksheet_files = not configs.assemble or configs.worksheet_files
+    sheet = Feed()
+    with under(configs, trace_parent):
+        stops = build_worksheet_tables([], workbook_title, worksheet_title, row_list, stops_column_list, ws_data,
+                                       configs, sheet)
+        build_worksheet_shapes(workbook_title, worksheet_title, ws_data, configs, sheet)
+        check_worksheet(sheet, workbook_title, worksheet_title, static_tables, configs, worksheet_files)
+        if worksheet_files:
+            write_worksheet_zip(workbook_title, worksheet_title, sheet, static_tables, configs)
+    return stops, sheet, configs.exception_buffer
+
+
+def run_worker(configs):
+    '''
+    Worker of a --distribute run (--worker): claim worksheet build jobs from the shared work queue, build them
+        into the shared gtfs_path_root and report the outputs to the coordinator. The lease of a job is renewed
+        while it builds; if the worker dies the job is claimed again once the lease expires.
+    :param configs: Configuration object; jobs carry the coordinator's configuration.
+    :return: 0 when idle for --worker_idle seconds
+    '''
+    functions = {'build_worksheet_job': build_worksheet_job}
+    work_queue = WorkQueue(get_queue_file(configs), configs.lease)
+    worker = worker_name()
+    print(colored('Worker {} on {}'.format(worker, work_queue.db_file), 'magenta'))
+    idle_since = time.time()
+    while True:
+        job = work_queue.claim(worker)
+        if job is None:
+            if configs.worker_idle and time.time() - idle_since > configs.worker_idle:
+                return 0
+            time.sleep(0.5)
+            continue
+        job_id, name, function, args = job
+        print('  Worker {} building {}'.format(worker, name))
+
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(work_queue.lease / 3) and work_queue.renew(job_id, worker):
+                pass
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            if function not in functions:
+                raise ValueError('Unknown job function {}.'.format(function))
+            work_queue.complete(job_id, worker, functions[function](*args))
+        except Exception:
+            work_queue.fail(job_id, worker, traceback.format_exc())
+        finally:
+            stop.set()
+            thread.join()
+        idle_since = time.time()
+
+
+def start_local_workers(configs):
+    '''
+    Worker processes of a --distribute run on the coordinator's host (--queue_workers N).
+    :return: list of multiprocessing.Process, stopped with the coordinator
+    '''
+    workers = []
+    for n in range(configs.queue_workers):
+        worker = multiprocessing.Process(target=run_worker, args=(configs,), daemon=True)
+        worker.start()
+        workers.append(worker)
+    return workers
+
+
+def pipeline_configs(item, configs):
+    '''
+    Copy of configs whose exceptions go to the work item, so stages on threads or processes do not share a buffer.
+    '''
+    configs = copy.copy(configs)
+    configs.exception_buffer = item['exceptions']
+    return configs
+
+
+def pipeline_stage(item, stage, configs, **kwargs):
+    '''
+    Run a pipeline stage function; stages run on executor threads and processes, so their spans are nested under
+        the workbook span explicitly.
+    '''
+    with under(configs, item['span']):
+        return stage(item, configs=configs, **kwargs)
+
+
+def pipeline_fetch(item, configs, graph=None, static_tables=None, checkpoint=None):
+    '''
+    Pipeline stage: retrieve the worksheet data. Runs on the fetch threads. A worksheet the build graph finds up
+        to date, or patches, carries its outputs through the other stages; one that cannot be retrieved carries
+        its error.
+    '''
+    worksheet = item.pop('worksheet')
+    try:
+        if graph is None:
+            data = fetch_worksheet_data(worksheet, item['workbook'], configs)
+        else:
+            data, item['inputs'], item['outputs'], item['patch'] = lookup_worksheet(
+                graph, item['workbook'], worksheet, item['zip_file'], static_tables, configs, checkpoint)
+            if item['patch'] is not None and item['zip_file']:
+                item['folder'] = os.path.dirname(item['zip_file'])
+            if item['outputs'] is not None:
+                return item
+    except SheetFetchError as e:
+        item['error'] = '{}'.format(e)
+        return item
+    item['row_list'], item['stops_column_list'], item['ws_data'] = data
+    return item
+
+
+def pipeline_skip(item):
+    '''
+    The worksheet has its outputs, or could not be retrieved: the build stages pass it on.
+    '''
+    return item['outputs'] is not None or item['error'] is not None
+
+
+def pipeline_build_tables(item, configs):
+    '''
+    Pipeline stage: build routes, calendar, stops, trips and stop_times. Runs on the CPU executor.
+    '''
+    if pipeline_skip(item):
+        return item
+    configs = pipeline_configs(item, configs)
+    item['sheet'] = Feed()
+    item['stops'] = build_worksheet_tables([], item['workbook'], item['worksheet_title'], item['row_list'],
+                                           item['stops_column_list'], item['ws_data'], configs, item['sheet'])
+    return item
+
+
+def pipeline_build_shapes(item, configs, static_tables):
+    '''
+    Pipeline stage: build shapes from the KML, then check the worksheet and write its files. Runs on the CPU executor.
+    '''
+    if pipeline_skip(item):
+        return item
+    configs = pipeline_configs(item, configs)
+    build_worksheet_shapes(item['workbook'], item['worksheet_title'], item['ws_data'], configs, item['sheet'])
+    check_worksheet(item['sheet'], item['workbook'], item['worksheet_title'], static_tables, configs,
+                    not configs.assemble or configs.worksheet_files)
+    item['ws_data'] = None
+    return item
+
+
+def pipeline_zip(item, configs, static_tables):
+    '''
+    Pipeline stage: zip the worksheet files. Runs on the CPU executor.
+    '''
+    if not pipeline_skip(item) and (not configs.assemble or configs.worksheet_files):
+        item['folder'] = write_worksheet_zip(item['workbook'], item['worksheet_title'], item['sheet'], static_tables,
+                                             pipeline_configs(item, configs))
+    return item
+
+
+def get_pipeline_workers(configs):
+    '''
+    Workers per pipeline stage from --pipeline_workers, i.e., 'fetch=2,tables=2,shapes=2,zip=1,validate=2'.
+    :return: dictionary of stage name to workers; 1 for stages not given.
+    '''
+    workers = dict((stage, 1) for stage in ('fetch', 'tables', 'shapes', 'zip', 'validate'))
+    for setting in (configs.pipeline_workers or '').split(','):
+        if '=' in setting:
+            stage, value = setting.split('=', 1)
+            if stage.strip() not in workers:
+                raise ValueError('Unknown pipeline stage {} in --pipeline_workers.'.format(stage.strip()))
+            workers[stage.strip()] = int(value)
+    return workers
+
+
+def run_worksheet_pipeline(workbook_title, worksheets, configs, static_tables, validation_cache=None, graph=None,
+                           pool=None, checkpoint=None):
+    '''
+    Build a workbook's worksheets in an asyncio pipeline (--pipeline): fetch, build tables, build shapes, zip and
+        validate run as stages joined by bounded queues, so fetching overlaps building and validation. Fetches run
+        on threads, CPU stages on worker processes with --jobs N (threads otherwise), validators as asyncio
+        subprocesses. Per-stage utilization is printed and written to the run statistics.
+    :param workbook_title: workbook name
+    :param worksheets: gspread worksheets to build, in order
+    :param configs: Configuration object
+    :param static_tables: StaticTables of the run
+    :param validation_cache: ValidationCache, or None
+    :param graph: BuildGraph, or None to build every worksheet
+    :param pool: ProcessPoolExecutor shared by a batch run, used with --jobs N, or None
+    :param checkpoint: Checkpoint of the run, or None
+    :return: list of (worksheet title, (stops, the worksheet's tables as a Feed, exceptions) or the SheetFetchError
+        of a worksheet that could not be retrieved, build inputs, reused, patch) in worksheet order
+    '''
+    workers = get_pipeline_workers(configs)
+    fetch_executor = ThreadPoolExecutor(max_workers=workers['fetch'])
+    cpu_workers = max(workers['tables'], workers['shapes'], workers['zip'])
+    if configs.jobs > 1:
+        cpu_executor = pool or ProcessPoolExecutor(max_workers=configs.jobs)
+    else:
+        cpu_executor = ThreadPoolExecutor(max_workers=cpu_workers)
+
+    async def validate(item):
+        if item.get('folder') and configs.worksheet_validator:
+            with span(configs, 'validate', parent=item['span'],
+                      worksheet='{}.{}'.format(item['workbook'], item['worksheet_title'])):
+                await validate_feed_async(os.path.join(item['folder'], item['worksheet_title'] + '.zip'),
+                                          item['folder'], '{}.{}'.format(item['workbook'], item['worksheet_title']),
+                                          validation_cache)
+        return item
+
+    queue_size = configs.pipeline_queue
+    pipeline = Pipeline([
+        Stage('fetch', functools.partial(pipeline_stage, stage=pipeline_fetch, configs=configs, graph=graph,
+                                         static_tables=static_tables, checkpoint=checkpoint),
+              workers['fetch'], fetch_executor, queue_size),
+        Stage('tables', functools.partial(pipeline_stage, stage=pipeline_build_tables, configs=configs),
+              workers['tables'], cpu_executor, queue_size),
+        Stage('shapes', functools.partial(pipeline_stage, stage=pipeline_build_shapes, configs=configs,
+                                          static_tables=static_tables), workers['shapes'], cpu_executor, queue_size),
+        Stage('zip', functools.partial(pipeline_stage, stage=pipeline_zip, configs=configs,
+                                       static_tables=static_tables), workers['zip'], cpu_executor, queue_size),
+        Stage('validate', validate, workers['validate'], None, queue_size),
+    ])
+    files = not configs.assemble or configs.worksheet_files
+    items = [{'workbook': workbook_title, 'worksheet_title': worksheet.title, 'worksheet': worksheet,
+              'exceptions': [], 'outputs': None, 'inputs': None, 'patch': None, 'error': None,
+              'span': trace_current(configs),
+              'zip_file': get_worksheet_zip(workbook_title, worksheet.title, configs) if files else None}
+             for worksheet in worksheets]
+    try:
+        items = pipeline.run(items)
+    finally:
+        fetch_executor.shutdown()
+        if cpu_executor is not pool:
+            cpu_executor.shutdown()
+
+    print('Pipeline {} worksheets in {:.2f}s'.format(len(items), pipeline.elapsed))
+    for line in pipeline.report():
+        print('  {}'.format(line))
+        write_run_info_to_file(pipeline.elapsed, 'Pipeline {}'.format(workbook_title), line, configs)
+    return [(item['worksheet_title'], SheetFetchError(item['error']), None, False, None)
+            if item['error'] is not None else
+            (item['worksheet_title'], item['outputs'], item['inputs'], item['patch'] is None, item['patch'])
+            if item['outputs'] is not None else
+            (item['worksheet_title'], (item['stops'], item['sheet'], item['exceptions']), item['inputs'], False, None)
+            for item in items]
+
+
+def build_workbook(workbook_title, run, configs):
+    '''
+    Build the worksheets of a workbook and add their outputs to the run in worksheet order. Sequentially, each
+        worksheet is finished as soon as it is built. With --jobs N or --distribute, builds are submitted while the
+        next worksheets are fetched, and finished in worksheet order once the workbook's worksheets are submitted;
+        with --pipeline, the workbook's worksheets go through run_worksheet_pipeline. Worksheets that cannot be
+        retrieved or built are added to run['failed'].
+    :param workbook_title: workbook name
+    :param run: dictionary of the run's state: start_time, static_tables, feed, store, graph, checkpoint,
+        validators, validation_cache, files (worksheet files are written), pool (the --jobs pool or None),
+        shared_pool (a batch run's pool or None), work_queue (the --distribute WorkQueue or None), all_stops and
+        failed (sources that could not be retrieved or built)
+    :param configs: Configuration object
+    :return: sources (workbook.worksheet) of the worksheets completed, in worksheet order
+    '''
+    worksheets = open_google_workbook(workbook_title, configs).worksheets()
+    if configs.verbose:
+        print('worksheets:{}'.format(worksheets))
+        note = '{}\nStart processing {} workbook {} with {} worksheets.'.format(
+            run['start_time'], configs.agency_id, workbook_title, len(worksheets))
+        print_et(text_color='green', start_time=run['start_time'], title='Workbook start.', note=note,
+                 configs=configs)
+        print('Workbook:{}'.format(workbook_title))
+
+    # Exclude worksheet list, i.e. Master and Template
+    ignore_list = get_ignore_list(configs)
+    if configs.verbose:
+        print('ignore list:{}'.format(ignore_list))
+    pipeline = configs.pipeline and run['work_queue'] is None
+    sequential = run['pool'] is None and run['work_queue'] is None
+
+    completed = []
+    # Results of worksheets submitted to the pool or work queue, or found up to date, in worksheet order.
+    pending = []
+    # Worksheets left to the --pipeline.
+    queued = []
+    for worksheet in worksheets:
+        if worksheet.title in ignore_list:
+            continue
+        with span(configs, '{}.{}'.format(workbook_title, worksheet.title), 'worksheet'):
+            if configs.verbose:
+                print(colored('{}.'.format(worksheet.title), color='yellow', on_color='on_grey'))
+                print_et(text_color='green', start_time=run['start_time'], title='Begin processing.', note='',
+                         configs=configs)
+            if run['files']:
+                create_wrkbk_wrksht_output_dir(workbook_title, worksheet.title, configs=configs)
+            if pipeline:
+                queued.append(worksheet)
+                continue
+            result = dispatch_worksheet(workbook_title, worksheet, run, configs)
+            if result is None:
+                continue
+            if sequential:
+                completed.append(finish_worksheet(workbook_title, *result, run=run, configs=configs))
+            else:
+                pending.append(result)
+
+    if queued:
+        results = run_worksheet_pipeline(workbook_title, queued, configs, run['static_tables'],
+                                         run['validation_cache'], run['graph'], run['shared_pool'],
+                                         run['checkpoint'])
+    else:
+        results = resolve_worksheet_results(pending, run['work_queue'])
+    for result in results:
+        completed.append(finish_worksheet(workbook_title, *result, run=run, configs=configs))
+    return [source for source in completed if source is not None]
+
+
+def dispatch_worksheet(workbook_title, worksheet, run, configs):
+    '''
+    Fetch a worksheet unless the build graph finds it up to date, patch it when only trip columns changed, or build
+        it: in this process, on the --jobs pool or through the --distribute work queue.
+    :param workbook_title: workbook name
+    :param worksheet: gspread worksheet
+    :param run: the run's state, see build_workbook
+    :param configs: Configuration object
+    :return: (worksheet title, (stops, the worksheet's tables as a Feed, exceptions) or the Future of its build,
+        build inputs, reused, patch), or None if the worksheet could not be retrieved.
+    '''
+    if configs.verbose:
+        print(colored(worksheet.title, 'green', 'on_grey'))
+        print_et(text_color='green', start_time=run['start_time'], title='>>> Begin worksheet data retrieval. <<<',
+                 note='', configs=configs)
+    zip_file = get_worksheet_zip(workbook_title, worksheet.title, configs) if run['files'] else None
+    try:
+        data, inputs, outputs, patch = lookup_worksheet(run['graph'], workbook_title, worksheet, zip_file,
+                                                        run['static_tables'], configs, run['checkpoint'])
+    except SheetFetchError as e:
+        fail_worksheet('{}.{}'.format(workbook_title, worksheet.title), e, run)
+        return None
+    # Up to date or patched: nothing to build.
+    if outputs is not None:
+        return worksheet.title, outputs, inputs, patch is None, patch
+    if configs.verbose:
+        print_et(text_color='green', start_time=run['start_time'], title='Getting worksheet row data.', note='',
+                 configs=configs)
+
+    args = (workbook_title, worksheet.title) + data
+    if run['pool'] is not None:
+        outputs = run['pool'].submit(build_worksheet_job, *args, configs, run['static_tables'],
+                                     trace_current(configs))
+    elif run['work_queue'] is not None:
+        outputs = run['work_queue'].submit('{}.{}'.format(workbook_title, worksheet.title), 'build_worksheet_job',
+                                           *args, configs, run['static_tables'], trace_current(configs))
+    else:
+        # The job's exceptions are buffered on a copy of configs, to be recorded with the worksheet's outputs.
+        outputs = build_worksheet_job(*args, copy.copy(configs), run['static_tables'], trace_current(configs))
+    return worksheet.title, outputs, inputs, False, None
+
+
+def resolve_worksheet_results(pending, work_queue=None):
+    '''
+    Wait for the builds submitted to the --jobs pool or the work queue.
+    :param pending: results of dispatch_worksheet, in worksheet order
+    :param work_queue: WorkQueue of a --distribute run, or None
+    :return: the results in the same order, with each Future replaced by its outputs, or the JobError of a job
+        that failed on a worker
+    '''
+    if work_queue is not None:
+        work_queue.wait()
+    results = []
+    for worksheet_title, outputs, inputs, reused, patch in pending:
+        if isinstance(outputs, Future):
+            try:
+                outputs = outputs.result()
+            except JobError as e:
+                outputs = e
+        results.append((worksheet_title, outputs, inputs, reused, patch))
+    return results
+
+
+def finish_worksheet(workbook_title, worksheet_title, outputs, inputs, reused, patch, run, configs):
+    '''
+    Add a worksheet's outputs to the run: its stops, exceptions and tables for the assembled feed or store. Record
+        a built or patched worksheet in the build graph, mark it done in the checkpoint and submit its zip for
+        validation, unless the pipeline validated it. Called in worksheet order, so the output does not depend on
+        which build finished first.
+    :param workbook_title: workbook name
+    :param worksheet_title: worksheet name
+    :param outputs: (stops, the worksheet's tables as a Feed, exceptions), or the SheetFetchError or JobError of a
+        worksheet that could not be retrieved or built
+    :param inputs: build inputs for the build graph
+    :param reused: the worksheet is up to date; its zip and validation results are left in place.
+    :param patch: (replaced trip_ids, Feed of the regenerated trips and stop_times) of a patched worksheet, or None
+    :param run: the run's state, see build_workbook
+    :param configs: Configuration object
+    :return: the worksheet's source (workbook.worksheet), or None if it failed
+    '''
+    source = '{}.{}'.format(workbook_title, worksheet_title)
+    if isinstance(outputs, (SheetFetchError, JobError)):
+        print(colored('  {} failed: {}'.format(source, outputs), 'red'))
+        fail_worksheet(source, outputs, run)
+        return None
+    graph = run['graph']
+    store = run['store']
+    stored = store is not None and graph.stored(source)
+    run['all_stops'] = add_worksheet_outputs(run['all_stops'], workbook_title, worksheet_title, outputs, configs,
+                                             run['feed'], store, run['static_tables'], reused, patch, stored)
+    if reused:
+        print(colored('  {} is up to date.'.format(source), 'blue'))
+        if store is not None and not stored:
+            graph.set_stored(source)
+    else:
+        if patch is not None:
+            print(colored('  {} patched.'.format(source), 'blue'))
+        graph.record(source, inputs, outputs, run['files'], patch is not None, store is not None)
+    run['checkpoint'].complete(source, *graph.hashes(source))
+    # The pipeline validates the zips it writes.
+    validated = configs.pipeline and run['work_queue'] is None
+    if run['files'] and configs.worksheet_validator and not reused and not validated:
+        folder_path = os.path.join(os.path.expanduser(configs.gtfs_path_root), workbook_title, worksheet_title)
+        run['validators'].submit(os.path.join(folder_path, worksheet_title + '.zip'), folder_path, source)
+    if configs.verbose:
+        print_et(text_color='green', start_time=run['start_time'],
+                 title='Worksheet >> |{}-{}| <<complete.\n'.format(workbook_title, worksheet_title), note='',
+                 configs=configs)
+    return source
+
+
+def fail_worksheet(source, error, run):
+    '''
+    Record a worksheet that could not be retrieved or built; the feed is not merged and --resume retries it.
+    '''
+    run['failed'].append(source)
+    run['checkpoint'].fail(source, '{}'.format(error))
+
+
+def store_worksheet(store, source, sheet, static_tables, reused=False, patch=None, current=False):
+    '''
+    Bring a worksheet's rows in the SQLite store up to date. The store is kept between runs: the worksheet takes
+        its place in worksheet order, the rows of an up to date worksheet stay, a patched worksheet has only its
+        changed trips replaced and a built one is replaced.
+    :param store: FeedStore
+    :param source: workbook.worksheet
+    :param sheet: the worksheet's tables as a Feed
+    :param static_tables: StaticTables of the run
+    :param reused: the worksheet is up to date
+    :param patch: (replaced trip_ids, Feed of the regenerated trips and stop_times) of a patched worksheet, or None
+    :param current: the store holds the worksheet's last recorded build, from BuildGraph.stored
+    :return:
+    '''
+    store.place(source)
+    if current and source in store.sources:
+        if reused:
+            return
+        if patch is not None:
+            store.patch_trips(source, *patch)
+            return
+    if source in store.sources:
+        store.remove_source(source)
+    store.add_feed(sheet, source, [gtfs_file for gtfs_file in sheet.tables if gtfs_file not in static_tables.content])
+
+
+def add_worksheet_outputs(all_stops, workbook_title, worksheet_title, outputs, configs, feed=None, store=None,
+                          static_tables=None, reused=False, patch=None, stored=False):
+    '''
+    Add the outputs of a worksheet built by a worker, the pipeline or a previous run, in worksheet order: its
+        stops, its exceptions and its tables for the assembled feed or SQLite store.
+    :param all_stops: accumulated list of stops from previous worksheets.
+    :param workbook_title: workbook name
+    :param worksheet_title: worksheet name
+    :param outputs: (stops, the worksheet's tables as a Feed, exceptions)
+    :param configs: Configuration object
+    :param feed: assembled Feed, or None
+    :param store: FeedStore, or None
+    :param static_tables: StaticTables of the run
+    :param reused: the worksheet is up to date
+    :param patch: (replaced trip_ids, Feed of the regenerated trips and stop_times) of a patched worksheet, or None
+    :param stored: the store holds the worksheet's last recorded build
+    :return: all_stops
+    '''
+    stops, sheet, exceptions = outputs
+    all_stops.extend(stops)
+    add_exceptions(exceptions, configs)
+    count_worksheet_rows(sheet, static_tables, configs)
+    source = '{}.{}'.format(workbook_title, worksheet_title)
+    if feed is not None:
+        feed.add_feed(sheet, source, [gtfs_file for gtfs_file in sheet.tables if gtfs_file not in static_tables.content])
+    if store is not None:
+        store_worksheet(store, source, sheet, static_tables, reused, patch, stored)
+    return all_stops
+
+
+def count_worksheet_rows(sheet, static_tables, configs):
+    '''
+    Count the rows of a worksheet's tables in the current span, for the run's metrics. Worksheets reused from
+        the build graph are counted like built ones.
+    :param sheet: the worksheet's tables as a Feed
+    :param static_tables: StaticTables of the run; config-derived tables are not counted.
+    :param configs: Configuration object
+    :return:
+    '''
+    for gtfs_file, table in sheet.tables.items():
+        if table.rows and (static_tables is None or gtfs_file not in static_tables.content):
+            trace_count(configs, 'rows.{}'.format(gtfs_file), len(table.rows))
+
+
+def lookup_worksheet(graph, workbook_title, worksheet, zip_file, static_tables, configs, checkpoint=None):
+    '''
+    Fetch a worksheet unless the build graph finds it up to date, and patch it when only trip columns changed.
+    :param graph: BuildGraph
+    :param workbook_title: workbook name
+    :param worksheet: gspread worksheet
+    :param zip_file: the worksheet zip when worksheet files are wanted, or None
+    :param static_tables: StaticTables of the run
+    :param configs: Configuration object
+    :param checkpoint: Checkpoint of the run, or None
+    :return: (fetched (row_list, stops_column_list, ws_data) or None, build inputs or None,
+        (stops, the worksheet's tables as a Feed, exceptions) of an up to date or patched worksheet or None to build
+        it, patch or None)
+    :raises SheetFetchError: the worksheet could not be retrieved.
+    '''
+    source = '{}.{}'.format(workbook_title, worksheet.title)
+    updated = getattr(worksheet, 'updated', None)
+
+    # --resume: a worksheet done in the interrupted run is not fetched again.
+    output_hash = checkpoint.done(source) if checkpoint is not None else None
+    if output_hash is not None:
+        outputs = graph.resumed(source, output_hash, zip_file)
+        if outputs is not None:
+            return None, None, outputs, None
+
+    # A worksheet updated no later than its last build is not fetched.
+    outputs = graph.unchanged(source, updated, zip_file)
+    if outputs is not None:
+        return None, None, outputs, None
+
+    data = fetch_worksheet_data(worksheet, workbook_title, configs)
+    inputs = graph.inputs(*data, updated=updated)
+    outputs = graph.up_to_date(source, inputs, zip_file)
+    if outputs is not None:
+        return data, inputs, outputs, None
+
+    previous = graph.previous(source, zip_file)
+    if previous is not None:
+        patched = patch_worksheet(previous, workbook_title, worksheet.title, *data, static_tables=static_tables,
+                                  configs=configs, zip_file=zip_file)
+        if patched is not None:
+            return data, inputs, patched[0], patched[1]
+    return data, inputs, None, None
+
+
+def patch_worksheet(previous, workbook_title, worksheet_title, row_list, stops_column_list, ws_data, static_tables,
+                    configs, zip_file=None):
+    '''
+    Patch the tables of a worksheet whose only changes since its last build are in trip columns. The trips and
+        stop_times of the changed columns are regenerated and replace theirs in the previous tables; the worksheet is
+        checked again and, with worksheet files, its files and zip are rewritten.
+    :param previous: (outputs, [row_list, stops_column_list, ws_data]) of the last build, from BuildGraph.previous
+    :param workbook_title: workbook name
+    :param worksheet_title: worksheet name
+    :param row_list: row numbers with stop data
+    :param stops_column_list: column numbers with trip times
+    :param ws_data: worksheet data just fetched
+    :param static_tables: StaticTables of the run
+    :param configs: Configuration object
+    :param zip_file: the worksheet zip when worksheet files are wanted, or None
+    :return: ((stops, the worksheet's tables as a Feed, exceptions), (replaced trip_ids, Feed of the regenerated
+        trips and stop_times)), or None when the worksheet must be built.
+    '''
+    (stops, sheet, exceptions), snapshot = previous
+    diff = SheetDiff(snapshot, [row_list, stops_column_list, ws_data])
+    if not diff.trips_only():
+        return None
+
+    old_trips = trip_range(snapshot[1])
+    new_trips = trip_range(stops_column_list)
+    replaced = set(get_trip_id(workbook_title, snapshot[2], j) for j in diff.trips if j in old_trips)
+    regenerated = [j for j in diff.trips if j in new_trips]
+    trip_ids = set(get_trip_id(workbook_title, ws_data, j) for j in regenerated)
+    kept = set(get_trip_id(workbook_title, ws_data, j) for j in new_trips if j not in diff.trips)
+    # Keys in conflict or a trip_id shared between columns cannot be patched trip by trip.
+    if sheet.conflicts() or len(trip_ids) < len(regenerated) or (replaced | trip_ids) & kept:
+        return None
+
+    patch = Feed()
+    patch_configs = copy.copy(configs)
+    patch_configs.exception_buffer = []
+    write_stop_times_file(workbook_title, worksheet_title, row_list, stops_column_list, stops, ws_data, patch_configs,
+                          patch, regenerated)
+    if patch.conflicts():
+        return None
+
+    # The worksheet is checked again and its replaced trips' exceptions are regenerated; exceptions recorded by an
+    # older build, without a code or trip_id to tell them apart, are left to a full build.
+    if any(len(exception) < 6 for exception in exceptions):
+        return None
+    exceptions = [exception_record(exception) for exception in exceptions]
+    others = [exception for exception in exceptions
+              if exception.code != 'feed_check' and exception.code not in trip_exception_codes]
+    # The trips' exceptions keep trip column order, where stop_times are written: after the stops' and before
+    # the shape's.
+    columns = dict((get_trip_id(workbook_title, ws_data, j), n) for n, j in enumerate(new_trips))
+    trips = sorted([exception for exception in exceptions
+                    if exception.code in trip_exception_codes and exception.trip_id not in replaced] +
+                   patch_configs.exception_buffer, key=lambda exception: columns.get(exception.trip_id, len(columns)))
+    shape = next((n for n, exception in enumerate(others) if exception.code == 'kml_not_found'), len(others))
+    exceptions = others[:shape] + trips + others[shape:]
+
+    for gtfs_file in ('trips', 'stop_times'):
+        table = sheet.tables[gtfs_file]
+        table.remove_values('trip_id', replaced)
+        sheet.add_rows(gtfs_file, patch.tables[gtfs_file].sorted_rows(), '{}.{}'.format(workbook_title, worksheet_title))
+        # Rows in trip column order, as a build adds them, so the check reports in the same order.
+        i = table.columns.index('trip_id')
+        table.rows = dict(sorted(table.rows.items(), key=lambda item: columns.get(item[1][i], len(columns))))
+
+    patch_configs.exception_buffer = exceptions
+    check_worksheet(sheet, workbook_title, worksheet_title, static_tables, patch_configs, zip_file is not None)
+    if zip_file is not None:
+        write_worksheet_zip(workbook_title, worksheet_title, sheet, static_tables, configs)
+    if configs.verbose:
+        print('Worksheet {} patched: {}.'.format(worksheet_title, diff.summary()))
+    return (stops, sheet, exceptions), (replaced, patch)
+
+
+def build_worksheet_tables(all_stops, workbook_title, worksheet_title, row_list, stops_column_list, ws_data, configs,
+                           sheet):
+    """
+    Build routes, calendar, calendar_dates, stops, trips and stop_times of one worksheet into its Feed.
+    :param all_stops: accumulated list of stops from previous worksheets.
+    :param workbook_title: workbook name
+    :param worksheet_title: worksheet name
+    :param row_list: row numbers with stop data
+    :param stops_column_list: column numbers with trip times
+    :param ws_data: worksheet data, a list of row values
+    :param configs: Configuration object
+    :param sheet: Feed receiving the worksheet's tables
+    :return: all_stops
+    """
+
+    source = '{}.{}'.format(workbook_title, worksheet_title)
+    with span(configs, 'routes', worksheet=source):
+        # ==========> Routes.txt processing.
+        write_routes_file(workbook_title, worksheet_title, ws_data, configs, sheet)
+
+    with span(configs, 'calendar', worksheet=source):
+        # ==========> Calendar.txt processing
+        write_calendar_file(workbook_title, worksheet_title, ws_data, configs, sheet)
+
+        # ==========> Calendar_dates.txt processing
+        service_id = ws_data[1][28]
+        write_calendar_dates_file(service_id, workbook_title, worksheet_title, configs, sheet)
+
+    with span(configs, 'stops', worksheet=source):
+        # ==========> Stops.txt processing
+        # Merge stops to stops-list.
+        all_stops = write_stops_file(all_stops, workbook_title, worksheet_title, row_list, ws_data, configs, sheet)
+
+    with span(configs, 'stop_times', worksheet=source):
+        # ==========> Stop times and trips processing. Trips are written from stop_times.txt processing
+        write_stop_times_file(workbook_title, worksheet_title, rows=row_list, columns=stops_column_list,
+                              stops=all_stops, worksheet_data=ws_data, configs=configs, feed=sheet)
+    return all_stops
+
+
+def build_worksheet_shapes(workbook_title, worksheet_title, ws_data, configs, sheet):
+    """
+    Build shapes.txt of one worksheet from its KML into its Feed.
+    :param workbook_title: workbook name
+    :param worksheet_title: worksheet name
+    :param ws_data: worksheet data, a list of row values
+    :param configs: Configuration object
+    :param sheet: Feed receiving the worksheet's tables
+    :return:
+    """
+
+    # ==========> Write_shapes.txt processing
+    shapeID     = ws_data[1][25]
+    if configs.verbose:
+        print('shapeID:{}'.format(shapeID))
+    with span(configs, 'shapes', worksheet='{}.{}'.format(workbook_title, worksheet_title), shape=shapeID):
+        write_shape_from_kml(shapeID=shapeID, workbook=workbook_title, title=worksheet_title, configs=configs,
+                             feed=sheet)
+    if configs.verbose:
+        print('Worksheet {} processing complete.'.format(worksheet_title))
+
+
+def check_worksheet(sheet, workbook_title, worksheet_title, static_tables, configs, worksheet_files=True):
+    """
+    Report the worksheet's key conflicts and FeedCheck errors as exceptions, and write its feed files.
+    :param sheet: the worksheet's tables as a Feed
+    :param workbook_title: workbook name
+    :param worksheet_title: worksheet name
+    :param static_tables: StaticTables of the run
+    :param configs: Configuration object
+    :param worksheet_files: write the worksheet's GTFS files and feedcheck.json to its directory.
+    :return: names of the worksheet's own (not static) GTFS files
+    """
+
+    # Keys repeated within the worksheet with different values, e.g., a stop_sequence used twice in a trip.
+    for gtfs_file, key, kept, rejected in sheet.conflicts():
+        exception = 'Duplicate {}.txt key {} within the worksheet.'.format(gtfs_file, ','.join(key))
+        write_exception_file(exception, workbook_title, worksheet_title, configs, code='duplicate_key')
+
+    # Check the worksheet's tables in memory; feedvalidator.py is kept for the final feed.
+    check_start = datetime.now()
+    tables = dict(sheet.tables)
+    tables.update(static_tables.tables)
+    with span(configs, 'check', worksheet='{}.{}'.format(workbook_title, worksheet_title)):
+        errors = FeedCheck(tables).check()
+    for gtfs_file, message in errors:
+        write_exception_file('{}.txt {}.'.format(gtfs_file, message), workbook_title, worksheet_title, configs,
+                             code='feed_check')
+    if configs.verbose:
+        print('Worksheet {} checked in {:.1f} ms, {} errors.'.format(
+            worksheet_title, (datetime.now() - check_start).total_seconds() * 1000, len(errors)))
+
+    sheet_files = [gtfs_file for gtfs_file in sheet.tables if gtfs_file not in static_tables.content]
+    if worksheet_files:
+        write_static_tables(static_tables, workbook_title, worksheet_title, configs)
+        sheet.write(get_worksheet_name_output_dir(workbook_title, worksheet_title, configs), sheet_files)
+        write_check_results(get_worksheet_name_output_dir(workbook_title, worksheet_title, configs),
+                            '{}.{}'.format(workbook_title, worksheet_title), errors)
+    return sheet_files
+
+
+def get_argument_parser(config_parser, defaults):
+    '''
+    Command line parser with the defaults of a configuration file.
+    :param config_parser: parser of the config file option, inherited
+    :param defaults: dictionary of configuration file values
+    :return: argparse.ArgumentParser
+    '''
+    parser = argparse.ArgumentParser(
+        # Inherit options from config_parser
+        parents=[config_parser]
+    )
+    parser.set_defaults(**defaults)
+    parser.add_argument('--distribute', action='store_true',
+                        help='With --generate, queue worksheet builds in the work queue for --worker processes on '
+                             'hosts sharing gtfs_path_root, then merge.')
+    parser.add_argument('-e', '--error', action='store_true',
+                        help='Generate GTFS worksheet feed_validator error report.')
+    parser.add_argument('-a', '--assemble', action='store_true',
+                        help='With --generate, assemble the feed in memory and write the agency zip once, '
+                             'without per-worksheet feed files.')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Time generate and its stages on synthetic agencies, offline, with the options given, '
+                             'ie., --jobs. Results in <report_path>/benchmark.json.')
+    parser.add_argument('--benchmark_scales', default=defaults.get('benchmark_scales', 'small,medium'),
+                        metavar='SCALES', help='With --benchmark, comma separated scales: small, medium, large or '
+                                               'workbooks:worksheets:stops:trips:shape points, ie., 2:5:25:24:1000.')
+    parser.add_argument('--benchmark_repeat', type=int, default=defaults.get('benchmark_repeat', 3), metavar='N',
+                        help='With --benchmark, run every scale N times and report the fastest.')
+    parser.add_argument('--benchmark_baseline', default=defaults.get('benchmark_baseline'), metavar='FILE',
+                        help='With --benchmark, compare to the results in FILE, or store them there if it does not '
+                             'exist; exit 1 on a regression.')
+    parser.add_argument('--benchmark_threshold', type=float, default=defaults.get('benchmark_threshold', 0.25),
+                        metavar='FRACTION', help='With --benchmark_baseline, a stage more than FRACTION slower than '
+                                                 'the baseline is a regression.')
+    parser.add_argument('--batch_workers', type=int, default=defaults.get('batch_workers', 2), metavar='N',
+                        help='With --batch, generate up to N agencies at once.')
+    parser.add_argument('--columnar', choices=['arrow', 'parquet'], default=defaults.get('columnar'),
+                        help='Also export the agency feed as typed Arrow IPC or Parquet tables (requires pyarrow).')
+    parser.add_argument('--fetch_retries', type=int, default=defaults.get('fetch_retries', 3), metavar='N',
+                        help='Retry a worksheet fetch that times out N times.')
+    parser.add_argument('--fetch_backoff', type=float, default=defaults.get('fetch_backoff', 2), metavar='SECONDS',
+                        help='Seconds before the first fetch retry, doubled for every further retry.')
+    parser.add_argument('-g', '--generate', action='store_true',
+                        help='Generate GTFS feed from a Google spreadsheet containing '
+                             'turn-by-turn instructions, and KML files.')
+    parser.add_argument('-j', '--jobs', type=int, default=defaults.get('jobs', 1), metavar='N',
+                        help='With --generate, build worksheets on N worker processes.')
+    parser.add_argument('-m', '--merge', action='store_true', help=
+        'Merge existing feedfiles from a dictionary of Workbooks:worksheets[] specified in a configuration file.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Merge only the worksheets whose manifest changed since the last merge.')
+    parser.add_argument('--lease', type=float, default=defaults.get('lease', 60), metavar='SECONDS',
+                        help='Seconds a worker holds a queued job without renewing it before it is claimed again.')
+    parser.add_argument('--max_attempts', type=int, default=defaults.get('max_attempts', 3), metavar='N',
+                        help='Claims of a queued job, ie., by workers that died, before it fails.')
+    parser.add_argument('--merge_workers', type=int, default=defaults.get('merge_workers', 1), metavar='N',
+                        help='Merge GTFS files on N worker processes; stop_times and shapes are sharded by key.')
+    parser.add_argument('-p', '--pipeline', action='store_true',
+                        help='With --generate, overlap fetch, build, zip and validate of worksheets in an asyncio '
+                             'pipeline.')
+    parser.add_argument('--pipeline_workers', default=defaults.get('pipeline_workers', ''),
+                        metavar='fetch=N,tables=N,shapes=N,zip=N,validate=N',
+                        help='Workers per pipeline stage; 1 for stages not given.')
+    parser.add_argument('--pipeline_queue', type=int, default=defaults.get('pipeline_queue', 2), metavar='N',
+                        help='Worksheets waiting in front of each pipeline stage before the previous one waits.')
+    parser.add_argument('--queue', default=defaults.get('queue'), metavar='FILE',
+                        help='Work queue of --distribute and --worker; <gtfs_path_root>/work_queue.sqlite if not '
+                             'given.')
+    parser.add_argument('--queue_workers', type=int, default=defaults.get('queue_workers', 0), metavar='N',
+                        help='With --distribute, also run N workers on this host.')
+    parser.add_argument('--profile', action='store_true',
+                        help='With --generate, run every stage under cProfile and write the profiles per stage to '
+                             '<report_path>/profile. Stages on --jobs or queue workers are not profiled.')
+    parser.add_argument('--memory', action='store_true',
+                        help='With --generate, track the memory of every stage with tracemalloc and the RSS '
+                             'high-water mark: per-stage peaks go to the trace and run statistics, the top '
+                             'allocation sites per stage to <report_path>/memory.txt. Slows the run down.')
+    parser.add_argument('--metrics_dir', default=defaults.get('metrics_dir'), metavar='DIR',
+                        help='Write the Prometheus textfile of a run as gtfsgenerator_<agency_id>.prom in DIR, ie., '
+                             "node_exporter's textfile collector directory, instead of <report_path>/metrics.prom.")
+    parser.add_argument('-r', '--revision', action='version', version='%(prog)s')
+    parser.add_argument('--resume', action='store_true',
+                        help='With --generate, continue the last run if it did not finish: worksheets it completed '
+                             'are not fetched again.')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='With --generate, rebuild every worksheet, even those the build graph finds up to '
+                             'date.')
+    parser.add_argument('--store', action='store_true',
+                        help='With --generate, keep the feed in SQLite <gtfs_path_root>/<agency_id>.sqlite and '
+                             'export the agency zip from it.')
+    parser.add_argument('-t', '--test', action='store_true', help='Run a function test.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Increase verbosity of output.')
+    parser.add_argument('--zip_level', type=int, default=defaults.get('zip_level', 6), metavar='0-9',
+                        help='zlib compression level of the feed zips.')
+    parser.add_argument('--zip_threads', type=int, default=defaults.get('zip_threads', 1), metavar='N',
+                        help='Render feed zip members on N threads while they are compressed; 1 streams rows into the zip.')
+    parser.add_argument('--worksheet_validator', action='store_true',
+                        help='Also run feedvalidator.py on every worksheet zip. Worksheets are always checked '
+                             'in memory; the final feed is always validated.')
+    parser.add_argument('--validate_workers', type=int, default=defaults.get('validate_workers', 1), metavar='N',
+                        help='Run up to N worksheet feedvalidator.py processes alongside the build.')
+    parser.add_argument('--no_validation_cache', action='store_true',
+                        help='Run feedvalidator.py even for feeds whose tables were validated before.')
+    parser.add_argument('--worker', action='store_true',
+                        help='Build worksheets queued by a --distribute run in the work queue.')
+    parser.add_argument('--worker_idle', type=float, default=defaults.get('worker_idle', 0), metavar='SECONDS',
+                        help='With --worker, exit after SECONDS without a job; 0 runs until interrupted.')
+    parser.add_argument('--worksheet_files', action='store_true',
+                        help='With --assemble, also write, zip and validate the per-worksheet feed files (debug).')
+    parser.add_argument('--sheet_source_root', default=defaults.get('sheet_source_root'), metavar='DIR',
+                        help='With source_type = local, directory of workbook directories of worksheet CSV files.')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='Generate, then keep watching the worksheet revisions and kml_files_root and '
+                             'regenerate the changed worksheets and the feed.')
+    parser.add_argument('--watch_interval', type=float, default=defaults.get('watch_interval', 60), metavar='SECONDS',
+                        help='With --watch, seconds between polls of the workbooks and KML files.')
+    parser.add_argument('--watch_debounce', type=float, default=defaults.get('watch_debounce', 5),
+                        metavar='SECONDS', help='With --watch, seconds without further changes before a rebuild.')
+    parser.add_argument('--watch_builds', type=int, default=defaults.get('watch_builds', 0), metavar='N',
+                        help='With --watch, stop after N rebuilds; 0 watches until interrupted.')
+    return parser
+
+def generate(configs, pool=None):
+    """
+    Generate the GTFS feed of one agency, traced: every span of the run, workbooks, worksheets and their stages,
+        is written to <report_path>/trace.jsonl and summed up in a table at the end. With --profile, stages also
+        run under cProfile, profiles in <report_path>/profile. With --memory, the peak memory of every stage is
+        written to the run statistics and its top allocation sites to <report_path>/memory.txt.
+        The run's metrics are written to <report_path>/metrics.json and a Prometheus textfile, see write_metrics.
+        The exceptions of every workbook are written once, when the run ends, to <report_path>/exceptions.jsonl
+        and exceptions.txt, even if it failed.
+    :param configs: Configuration object
+    :param pool: ProcessPoolExecutor shared by a batch run, or None to create one with --jobs N
+    :return: 0, or 1 if the feed was not merged
+    """
+    report_path = os.path.expanduser(configs.report_path)
+    configs.tracer = Tracer(os.path.join(report_path, 'trace.jsonl'),
+                            os.path.join(report_path, 'profile') if configs.profile else None,
+                            os.path.join(report_path, 'memory.txt') if configs.memory else None)
+    configs.metrics = RunMetrics(configs.agency_id)
+    configs.exception_log = ExceptionLog(report_path)
+    try:
+        with span(configs, configs.agency_id, 'run'):
+            result = generate_feed(configs, pool)
+        write_metrics(result, configs)
+        print(colored('Trace {}'.format(configs.tracer.trace_file), 'magenta'))
+        print(configs.tracer.summary())
+        for prof_file in configs.tracer.write_profiles():
+            print('Profile {}'.format(prof_file))
+        if configs.memory:
+            for name, (peak, rss) in sorted(configs.tracer.memory_peaks().items()):
+                write_run_info_to_file(0, 'Memory {}'.format(name), 'peak traced:{} rss high water:{}'.format(
+                    format_bytes(peak), format_bytes(rss)), configs)
+            print('Memory {}'.format(configs.tracer.write_memory()))
+        return result
+    finally:
+        exceptions_file = configs.exception_log.write()
+        print('Exceptions {}: {}'.format(exceptions_file, len(configs.exception_log.records)))
+        configs.tracer.close()
+        configs.tracer = None
+        configs.metrics = None
+        configs.exception_log = None
+
+
+def write_metrics(result, configs):
+    '''
+    Write the metrics of a generate run: <report_path>/metrics.json, the Prometheus textfile
+        gtfsgenerator_<agency_id>.prom in --metrics_dir, or <report_path>/metrics.prom, and a line appended to
+        <report_path>/metrics_history.jsonl.
+    :param result: result of generate_feed
+    :param configs: Configuration object with the run's tracer and metrics
+    :return:
+    '''
+    report_path = os.path.expanduser(configs.report_path)
+    configs.metrics.result = result
+    configs.metrics.add_trace(configs.tracer.records())
+    configs.metrics.exceptions = configs.exception_log.counts()
+    agency_zip = os.path.join(os.path.expanduser(configs.gtfs_path_root), configs.agency_id + '.zip')
+    if result == 0 and os.path.isfile(agency_zip):
+        configs.metrics.zip_bytes = os.path.getsize(agency_zip)
+    if configs.metrics_dir:
+        prom_file = os.path.join(os.path.expanduser(configs.metrics_dir), 'gtfsgenerator_{}.prom'.format(
+            configs.agency_id))
+    else:
+        prom_file = os.path.join(report_path, 'metrics.prom')
+    configs.metrics.write(os.path.join(report_path, 'metrics.json'), prom_file,
+                          os.path.join(report_path, 'metrics_history.jsonl'))
+    print('Metrics {} {}'.format(os.path.join(report_path, 'metrics.json'), prom_file))
+
+
+def generate_feed(configs, pool=None):
+    """
+    Generate the GTFS feed of one agency from its workbooks and KML files.
+    :param configs: Configuration object
+    :param pool: ProcessPoolExecutor shared by a batch run, or None to create one with --jobs N
+    :return: 0, or 1 if worksheets could not be retrieved or built and the feed was not merged, --resume
+        continues the run, or if no worksheet was processed.
+    """
+    # <<<<<<<<<< Generate Generate Generate Generate Generate >>>>>>>>>>
+
+    start_time = datetime.now()
+    print("generating...\n")
+    wrkbk_dict = google_worksheets_by_workbook_to_dict(configs)
+    write_workbook_dictionary(wrkbk_dict, configs)
+
+    workbooks = configs.google_workbook_names.split(',')
 
-    workbook_dict = google_worksheets_by_workbook_to_dict(configs)
-    notes = []
-    val_report = os.path.join(os.path.expanduser(configs.report_path),'validation_report.txt')
-    val = open(val_report, 'w')
-    for key, values in workbook_dict.items():
-        for i in range(len(values)):
+    # Clear existing info report, write header.
+    note = ('{} Workbooks: {}.'.format(configs.agency_id.upper(), workbooks))
+    clear_run_info_file(note, configs)
+    all_stops = []
+
+    # Config-derived tables and feed_version, rendered once for the run.
+    static_tables = render_static_tables(configs)
+
+    # Assembly mode: worksheets contribute rows to one in-memory feed.
+    feed = None
+    if configs.assemble:
+        feed = Feed()
+        static_tables.add_to(feed)
+
+    # feedvalidator.py runs on worksheet zips in the background while the next worksheets are built.
+    validation_cache = None
+    if not configs.no_validation_cache:
+        validation_cache = ValidationCache(os.path.join(os.path.expanduser(configs.report_path),
+                                                        'validation_cache'))
+    validators = ValidationScheduler(configs.validate_workers, validation_cache)
+
+    # --jobs: worksheets are built on worker processes while the next ones are fetched. A batch run shares its pool.
+    shared_pool = pool
+    pool = None
+    if configs.jobs > 1 and not configs.pipeline and not configs.distribute:
+        pool = shared_pool or ProcessPoolExecutor(max_workers=configs.jobs)
+
+    # --distribute: worksheet builds are queued for --worker processes on any host sharing gtfs_path_root.
+    work_queue = None
+    local_workers = []
+    if configs.distribute:
+        work_queue = WorkQueue(get_queue_file(configs), configs.lease, configs.max_attempts)
+        local_workers = start_local_workers(configs)
+        print(colored('Distributing worksheet builds on {} with {} local workers'.format(
+            work_queue.db_file, len(local_workers)), 'magenta'))
+
+    # Build graph: worksheets whose sheet content, KML files and config are unchanged since their last build
+    # reuse its tables, zip and validation results.
+    graph = BuildGraph(get_build_graph_file(configs), configs, configs.rebuild)
+
+    # Checkpoint: worksheets are recorded as they complete, so --resume continues a failed or interrupted run.
+    checkpoint = Checkpoint(get_checkpoint_file(configs), graph.config)
+    if checkpoint.begin(configs.resume):
+        print(colored('Resuming the last run: {} worksheets done.'.format(checkpoint.counts().get('done', 0)),
+                      'magenta'))
+    elif configs.resume:
+        print(colored('No unfinished run with this configuration to resume.', 'magenta'))
+    failed = []
+
+    # SQLite store: worksheets are upserted into indexed tables and the agency zip is exported from it.
+    store = None
+    if configs.store:
+        store = FeedStore(get_store_file(configs))
+        # The store is kept between runs: the rows of worksheets found up to date stay.
+        if configs.rebuild:
+            store.clear()
+        store.remove_source('config')
+        static_tables.add_to(store)
+
+    # Worksheets processed in every workbook.
+    processed = []
+    # State shared by the worksheet helpers, see build_workbook.
+    run = {'start_time': start_time, 'static_tables': static_tables, 'feed': feed, 'store': store,
+           'graph': graph, 'checkpoint': checkpoint, 'validators': validators, 'validation_cache': validation_cache,
+           'files': feed is None or configs.worksheet_files, 'pool': pool, 'shared_pool': shared_pool,
+           'work_queue': work_queue, 'all_stops': all_stops, 'failed': failed}
+    for workbook_title in workbooks:
+        with span(configs, workbook_title, 'workbook'):
+            p_sheets = build_workbook(workbook_title, run, configs)
+            write_proc_sheet_list(p_sheets, configs)
+            processed.extend(p_sheets)
+
+    if pool is not None and pool is not shared_pool:
+        pool.shutdown()
+    if work_queue is not None:
+        work_queue.close()
+        for worker in local_workers:
+            worker.terminate()
+            worker.join()
+
+    # Without every worksheet the feed is not merged; the completed worksheets are checkpointed.
+    if failed:
+        validators.wait(configs.verbose)
+        if store is not None:
+            store.close()
+        note = '{} worksheets failed: {}. Rerun with --resume.'.format(len(failed), ', '.join(failed))
+        print(colored(note, 'red'))
+        write_run_info_to_file(0, 'Checkpoint', note, configs)
+        print('Build graph {}'.format(graph.stats()))
+        write_run_info_to_file(0, 'Build graph', graph.stats(), configs)
+        configs.metrics.add_cache('build_graph', graph.reused, graph.rebuilt, patched=graph.patched)
+        print_et(text_color='red', start_time=start_time, title='Stopped before the merge.\n', note='INCOMPLETE',
+                 configs=configs)
+        return 1
+
+    # Worksheet files are merged or copied; without a worksheet there is no feed to write.
+    if not processed and store is None and feed is None:
+        validators.wait(configs.verbose)
+        note = 'No worksheets processed in workbooks {}; no feed written.'.format(configs.google_workbook_names)
+        print(colored(note, 'red'))
+        write_run_info_to_file(0, 'Generate', note, configs)
+        print_et(text_color='red', start_time=start_time, title='Stopped before the merge.\n',
+                 note='NO WORKSHEETS', configs=configs)
+        return 1
+
+    with span(configs, 'merge'):
+        if store is not None:
+            # Worksheets no longer in the workbooks.
+            for source in sorted(store.sources - set(store.placed)):
+                store.remove_source(source)
+            # Export the agency zip from the store, checking references between its tables first.
+            store.report(configs)
+            for gtfs_file, message, source in store.validate():
+                workbook, worksheet = source.split('.', 1) if '.' in source else ('', source)
+                write_exception_file('{}.txt {}.'.format(gtfs_file, message), workbook, worksheet, configs,
+                                     code='store_reference')
+            gtfs_destination = os.path.join(os.path.expanduser(configs.gtfs_path_root), configs.agency_id + '.zip')
+            store.write_zip(gtfs_destination, configs.zip_level, configs.zip_threads)
+            store.close()
             if configs.verbose:
-                print('Workbook:{} worksheet:{}'.format(key, values[i]))
-            ext_path = os.path.join(os.path.expanduser(configs.gtfs_path_root),key, values[i])
-            html_file = os.path.join(ext_path,'validator.html')
-            if os.path.isfile(html_file):
-                f = open(html_file)
-                soup = BeautifulSoup(f ,'html.parser')
-                errors = soup.findAll("span", class_='fail')
-                for i in range (len(errors)):
-                    if i == 1:
-                        print('Errors >>>:{}'.format(errors[i].string))
-                        notes.append('{}:{}'.format(ext_path, errors[i].string))
-                f.close
-        for note in notes:
-            val.write('{}\n'.format(note))
-            print('Note:{}'.format(note))
-    val.close()
+                print('Feed exported from {} to {}'.format(get_store_file(configs), gtfs_destination))
+        elif feed is not None:
+            # Serialize the assembled tables once, straight into the agency zip.
+            feed.report(configs)
+            gtfs_destination = os.path.join(os.path.expanduser(configs.gtfs_path_root), configs.agency_id + '.zip')
+            feed.write_zip(gtfs_destination, configs.zip_level, configs.zip_threads, static_tables)
+            if configs.verbose:
+                print('Assembled feed written to {}'.format(gtfs_destination))
+        elif len(processed) > 1:
+            # Worksheets of every workbook, not only the last one, decide whether there is anything to combine.
+            if configs.verbose:
+                print('\nCombining {} gtfs feeds from {}'.format(len(processed), processed))
+                note = '{}'.format('')
+                print_et(text_color='green', start_time=start_time, title='Combining worksheets {}.'.format(processed), note=note, configs=configs)
+            x = GtfsWrite()
+            if configs.incremental:
+                x.merge_files_incremental(wrkbk_dict, configs, static_tables)
+            else:
+                x.merge_files(wrkbk_dict, configs, static_tables)
+        else:
+            # The one worksheet processed, wherever it came in the workbooks.
+            workbook, worksheet = processed[0].split('.', 1)
+            folder_path = os.path.join(os.path.expanduser(configs.gtfs_path_root), workbook, worksheet)
+            gtfs_source = os.path.join(folder_path, worksheet + '.zip')
+            gtfs_destination = os.path.join(os.path.expanduser(configs.gtfs_path_root), configs.agency_id + '.zip')
+            if configs.verbose:
+                print('Source:{}\n  Destination:{}'.format(gtfs_source, gtfs_destination))
+            copyfile(gtfs_source, gtfs_destination)
+        agency_zip = os.path.join(os.path.expanduser(configs.gtfs_path_root), configs.agency_id + '.zip')
+        if os.path.isfile(agency_zip):
+            trace_add(configs, written=os.path.getsize(agency_zip))
+
+    if configs.columnar:
+        export_columnar(configs)
+
+    validators.wait(configs.verbose)
+
+    # Run validator on final feed
+    folder_path = ''
+    filename    = configs.agency_id
+    with span(configs, 'validate', feed=filename):
+        run_validator(start_time, folder_path, filename, configs, validation_cache)
+    if validation_cache is not None:
+        print('Validation cache {}'.format(validation_cache.stats()))
+        write_run_info_to_file(0, 'Validation cache', validation_cache.stats(), configs)
+        configs.metrics.add_cache('validation', validation_cache.hits, validation_cache.misses)
+    print('Build graph {}'.format(graph.stats()))
+    write_run_info_to_file(0, 'Build graph', graph.stats(), configs)
+    configs.metrics.add_cache('build_graph', graph.reused, graph.rebuilt, patched=graph.patched)
+    # Report on the validation results of this build's worksheets
+    configs.metrics.validation = report_errors(configs, wrkbk_dict)
+
+    # Startup the schedule_viewer with the master GTFS.zip
+    # run_schedule_viewer(configs)
+
+    # Copy finished zipped gtfs to Google Drive for pickup.
+    #copy_file(start_time, configs)
+    checkpoint.finish()
+    print_et(text_color='red', start_time=start_time, title='Finished processing.\n', note='END',
+             configs=configs)
+    return 0
+
+
+def get_watch_state(configs):
+    """
+    State of the inputs of a build: the revision time of every worksheet, Google's updated or the local file's
+        modification time, and (mtime, size) of every file under kml_files_root. A worksheet without a revision
+        time is fetched and hashed.
+    :param configs: Configuration object
+    :return: dictionary of workbook.worksheet or KML path to its state
+    """
+    state = {}
+    ignore_list = get_ignore_list(configs)
+    for workbook in configs.google_workbook_names.split(','):
+        for worksheet in open_google_workbook(workbook, configs).worksheets():
+            if worksheet.title in ignore_list:
+                continue
+            revision = getattr(worksheet, 'updated', None)
+            if not revision:
+                revision = sheet_hash(*fetch_worksheet_data(worksheet, workbook, configs))
+            state['{}.{}'.format(workbook, worksheet.title)] = revision
+    state.update(tree_state(os.path.expanduser(configs.kml_files_root)))
+    return state
+
+
+def watch(configs):
+    """
+    Generate the feed, then regenerate it whenever a worksheet or KML file changes. The process, its Sheets
+        client, shape cache and build graph stay warm; the build graph rebuilds or patches only the changed
+        worksheets before the feed is merged again.
+    :param configs: Configuration object
+    :return:
+    """
+    def poll():
+        # A failed poll, ie., Google timing out, counts as no change; the next interval polls again.
+        try:
+            return get_watch_state(configs)
+        except Exception as e:
+            print(colored('Watch poll failed: {!r}'.format(e), 'red'))
+            return watcher.state
+
+    directories = [os.path.expanduser(configs.kml_files_root)]
+    if configs.source_type == 'local':
+        directories.append(os.path.expanduser(configs.sheet_source_root))
+    watcher = Watcher(poll, configs.watch_interval, configs.watch_debounce, directories)
+    watcher.start()
+    print(colored('Watching {} worksheets and KML files by {} every {}s'.format(
+        configs.google_workbook_names, watcher.mode(), configs.watch_interval), 'magenta'))
+    generate(configs)
+
+    builds = 0
+    try:
+        while not configs.watch_builds or builds < configs.watch_builds:
+            changed = watcher.wait()
+            print(colored('{} Changed: {}'.format(datetime.now().strftime('%c'), ', '.join(changed)), 'magenta'))
+            try:
+                generate(configs)
+            except Exception as e:
+                print(colored('Watch build failed: {!r}'.format(e), 'red'))
+            builds += 1
+    except KeyboardInterrupt:
+        print(colored('Watch stopped after {} rebuilds.'.format(builds), 'magenta'))
+
+
+def get_batch_config_files(paths):
+    """
+    Config files of a batch run; a directory stands for the .ini files in it.
+    :param paths: config files and directories
+    :return: list of config files
+    """
+    config_files = []
+    for path in paths:
+        path = os.path.expanduser(path)
+        if os.path.isdir(path):
+            config_files += sorted(glob.glob(os.path.join(path, '*.ini')))
+        else:
+            config_files.append(path)
+    return config_files
+
+
+def get_batch_configs(config_files, config_parser, remaining_argv):
+    """
+    Parse the command line once per agency, with the defaults of its config file. Agencies write to their own
+        gtfs_path_root and report_path, so no two may share a report_path, or a gtfs_path_root and agency_id.
+    :param config_files: list of config files
+    :param config_parser: parser of the config file options
+    :param remaining_argv: command line arguments other than the config file options
+    :return: list of Configuration objects, or None if a config file is invalid or outputs collide.
+    """
+    batch = []
+    report_paths = {}
+    feed_paths = {}
+    for config_file in config_files:
+        defaults = Configuration(config_file).get_defaults()
+        if defaults is None:
+            print(colored('Batch config {} is not a valid configuration file.'.format(config_file), 'red'))
+            return None
+        configs = get_argument_parser(config_parser, defaults).parse_args(remaining_argv)
+        configs.config_file = config_file
+
+        report_path = os.path.abspath(os.path.expanduser(configs.report_path))
+        feed_path = (os.path.abspath(os.path.expanduser(configs.gtfs_path_root)), configs.agency_id)
+        for path, used in ((report_path, report_paths), (feed_path, feed_paths)):
+            if path in used:
+                print(colored('Batch configs {} and {} share the output path {}.'.format(
+                    used[path], config_file, path), 'red'))
+                return None
+            used[path] = config_file
+        batch.append(configs)
+    return batch
+
+
+def run_batch(batch):
+    """
+    Generate the feeds of several agencies in one process. Agencies run concurrently on --batch_workers threads
+        and share the Sheets clients, the shape cache and one worker process pool; a failed agency does not stop
+        the others.
+    :param batch: list of Configuration objects, one per agency
+    :return: 0, or 1 if any agency failed.
+    """
+    start_time = datetime.now()
+    jobs = max([configs.jobs for configs in batch if not configs.pipeline] + [1])
+    pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+
+    def run_agency(configs):
+        agency_start = datetime.now()
+        try:
+            if generate(configs, pool):
+                return configs, 'no feed', datetime.now() - agency_start
+            return configs, 'ok', datetime.now() - agency_start
+        except Exception as e:
+            print(colored('Agency {} from {} failed: {!r}'.format(configs.agency_id, configs.config_file, e), 'red'))
+            return configs, 'failed: {!r}'.format(e), datetime.now() - agency_start
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(batch[0].batch_workers, 1)) as agencies:
+            results = list(agencies.map(run_agency, batch))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    summary = VeryPrettyTable(['Agency', 'Config', 'Result', 'Elapsed'])
+    summary.align['Config'] = 'l'
+    for configs, result, elapsed in results:
+        summary.add_row([configs.agency_id, configs.config_file, result, '{:.1f}s'.format(elapsed.total_seconds())])
+    print(summary)
+    print(colored('Batch of {} agencies in {:.1f}s'.format(len(batch), (datetime.now() - start_time).total_seconds()),
+                  'magenta'))
+    return 1 if any(result != 'ok' for configs, result, elapsed in results) else 0
 
 
 def main (argv=None):
@@ -1407,26 +2956,18 @@ def main (argv=None):
     config_parser_for_passed_in_config_file = get_config_parser_for_passed_in_config_file()
     configs, remaining_argv = config_parser_for_passed_in_config_file.parse_known_args()
 
-    defaults = Configuration(configs.config_file).get_defaults()
+    if configs.batch:
+        batch = get_batch_configs(get_batch_config_files(configs.batch), config_parser_for_passed_in_config_file,
+                                  remaining_argv)
+        if not batch:
+            return 1
+        return run_batch(batch)
 
-    # Parse rest of arguments
-    parser = argparse.ArgumentParser(
-        # Inherit options from config_parser
-        parents=[config_parser_for_passed_in_config_file]
-    )
+    defaults = Configuration(configs.config_file).get_defaults()
 
     if defaults is not None:
-        parser.set_defaults(**defaults)
-        parser.add_argument('-e', '--error', action='store_true',
-                            help='Generate GTFS worksheet feed_validator error report.')
-        parser.add_argument('-g', '--generate', action='store_true',
-                            help='Generate GTFS feed from a Google spreadsheet containing '
-                                 'turn-by-turn instructions, and KML files.')
-        parser.add_argument('-m', '--merge', action='store_true', help=
-            'Merge existing feedfiles from a dictionary of Workbooks:worksheets[] specified in a configuration file.')
-        parser.add_argument('-r', '--revision', action='version', version='%(prog)s')
-        parser.add_argument('-t', '--test', action='store_true', help='Run a function test.')
-        parser.add_argument('-v', '--verbose', action='store_true', help='Increase verbosity of output.')
+        # Parse rest of arguments
+        parser = get_argument_parser(config_parser_for_passed_in_config_file, defaults)
 
         configs = parser.parse_args(remaining_argv)
         pretty_print_args(configs)
@@ -1456,200 +2997,27 @@ def main (argv=None):
             wrkbk_dict = google_worksheets_by_workbook_to_dict(configs)
             write_workbook_dictionary(wrkbk_dict, configs)
             x = GtfsWrite()
-            x.merge_files(wrkbk_dict, configs)
+            if configs.incremental:
+                x.merge_files_incremental(wrkbk_dict, configs)
+            else:
+                x.merge_files(wrkbk_dict, configs)
+            if configs.columnar:
+                export_columnar(configs)
 
 # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
 
-        elif configs.generate is True:
-
-            # <<<<<<<<<< Generate Generate Generate Generate Generate >>>>>>>>>>
-
-            start_time = datetime.now()
-            print("generating...\n")
-            wrkbk_dict = google_worksheets_by_workbook_to_dict(configs)
-            write_workbook_dictionary(wrkbk_dict, configs)
-
-            workbooks = configs.google_workbook_names.split(',')
-
-            # Clear existing info report, write header.
-            note = ('{} Workbooks: {}.'.format(configs.agency_id.upper(), workbooks))
-            clear_run_info_file(note, configs)
-            all_stops = []
-
-            for workbook_title in workbooks:
-
-                # Retreive worksheets from workbook
-                route_workbook = open_google_workbook(workbook_title, configs)
-                worksheets = route_workbook.worksheets()
-
-                if configs.verbose:
-                    print('worksheets:{}'.format(worksheets))
-                c_note = colored(note,color='green',on_color='on_grey')
-                if configs.verbose:
-                    print(c_note)
-                    note = '{}'.format('{}\nStart processing {} workbook {} with {} worksheets.'.format( \
-                    start_time, configs.agency_id, workbook_title, len(wrkbk_dict)))
-                    print_et(text_color='green', start_time=start_time, title='Workbook start.', note=note, configs=configs)
-                    print('Workbook:{}'.format(workbook_title))
-
-                # Select the sheets to process. Create empty list to hold processed sheet titles.
-                sheets  = []
-
-                for worksheet in worksheets:
-                    sheets.append(worksheet.title)
-                # print('sheets:{}'.format(sheets))
-                p_sheets   = []
-
-                # Exclude worksheet list, i.e. Master and Template
-                ignore_list = configs.ignore_sheets.split(',')
-                if configs.verbose:
-                    print('ignore list:{}'.format(ignore_list))
-
-                create_exceptions_file(configs)
-                if configs.verbose:
-                    print('Creating exceptions file...')
-
-                # Worksheet loop.
-                for worksheet in worksheets:
-                    worksheet_title = worksheet.title
-
-                    note = '{} start.'.format(worksheet)
-
-                    if not worksheet_title in ignore_list:
-                        if worksheet_title in sheets:
-                            if configs.verbose:
-                                note = '{}'.format('{}.'.format(worksheet_title))
-                                c_note = colored(note,color='yellow',on_color='on_grey')
-                                print(c_note)
-                                print_et(text_color='green', start_time=start_time, title='Begin processing.', note=note, configs=configs)
-
-                            if configs.verbose:
-                                print('Creating output directory...')
-
-                            create_wrkbk_wrksht_output_dir(workbook_title, worksheet_title, configs=configs)
+        elif configs.worker:
+            return run_worker(configs)
 
-                            # Required rows: r2=headings(optional) r3=data r6=trip headings from configuration
-                            head_data_rows = [int(s) for s in configs.head_data_rows.split(",")]
+        elif configs.benchmark:
+            return run_benchmark(configs, generate)
 
-                            # Required columns: 2=stop seq 3=stopID 10-21=stop info 22-25=trip info from configuration file.
-                            stops_column_list = [int(s) for s in configs.stop_data_columns.split(",")]
+        elif configs.watch:
+            watch(configs)
 
-                            # Print the current worksheet title in color
-                            current_worksheet_colored = colored(worksheet.title, 'green', 'on_grey')
-
-                            if configs.verbose:
-                                print('{}'.format(current_worksheet_colored))
-                                note = '{}'.format('')
-                                print_et(text_color='green', start_time=start_time, title='>>> Begin worksheet data retrieval. <<<', note=note,
-                                         configs=configs)
-
-                            if configs.source_type == 'google':
-
-                                # Return a list of row numbers that contain stop data; append columns with time data
-                                stop_rows, stops_column_list = get_google_worksheet_row_col_list(stops_column_list,
-                                                                                                 worksheet, configs)
-                                # Combine static (non-stop info) and dynamic (stop info) row numbers
-                                row_list = head_data_rows + stop_rows
-                                row_list.sort()
-
-                                # Get the cell values for all rows with information from the G_worksheet.
-                                ws_data = get_google_worksheet_data(row_list, worksheet, workbook_title, configs)
-
-                            if configs.verbose:
-                                note = '{}'.format('')
-                                print_et(text_color='green', start_time=start_time, title='Getting worksheet row data.',
-                                     note=note, configs=configs)
-
-                            # ==========> Agency.txt processing
-                            write_agency_file(workbook=workbook_title, worksheet_title=worksheet_title, configs=configs)
-
-                            # ==========> Fare_attributes.txt processing.
-                            write_fare_attributes_file(workbook=workbook_title, worksheet_title=worksheet_title, configs=configs)
-
-                            # ==========> Fare_rules.txt processing.
-                            write_fare_rules_file(workbook=workbook_title, worksheet_title=worksheet_title, configs=configs)
-
-                            # ==========> Feed_info.txt processing.
-                            write_feed_info_file(workbook=workbook_title, worksheet_title=worksheet_title, configs=configs)
-
-                            # ==========> Routes.txt processing.
-                            write_routes_file(workbook_title, worksheet_title, ws_data, configs)
-
-                            # ==========> Calendar.txt processing
-                            write_calendar_file( workbook_title, worksheet_title, ws_data, configs)
-
-                            # ==========> Calendar_dates.txt processing
-                            service_id = ws_data[1][28]
-                            write_calendar_dates_file(service_id, workbook_title, worksheet_title, configs)
-
-                            # ==========> Stops.txt processing
-                            # Merge stops to stops-list.
-                            all_stops = write_stops_file(all_stops, workbook_title, worksheet_title, row_list, ws_data, configs)
-
-                            # Trips.txt header. Trips are written from stop_times.txt processing
-                            write_trips_header(workbook=workbook_title, worksheet_title=worksheet_title, configs=configs)
-
-                            # ==========> Stop times and trips processing
-                            write_stop_times_file(workbook_title, worksheet_title, rows=row_list, columns=stops_column_list, stops=all_stops, worksheet_data=ws_data, configs=configs)
-
-                            # ==========> Write_shapes.txt processing
-                            write_shapes_header(workbook=workbook_title, worksheet_title=worksheet_title, configs=configs)
-                            # print('****** From main - write_shapes_header: current_worksheet_title:{}'.format(worksheet_title))
-                            shapeID     = ws_data[1][25]
-                            if configs.verbose:
-                                print('shapeID:{}'.format(shapeID))
-                            write_shape_from_kml(shapeID=shapeID, workbook=workbook_title, title=worksheet_title, configs=configs)
-                            if configs.verbose:
-                                print('Worksheet {} processing complete.'.format(worksheet_title))
-
-                            # Zip the worksheet GTFS files
-                            if configs.verbose:
-                                print('Zipping GTFS.txt files...')
-                            output_path = os.path.join(os.path.expanduser(configs.gtfs_path_root), workbook_title, worksheet_title)
-                            out_filename = worksheet_title
-                            create_gtfs_zip(output_path, out_filename)
-
-                            folder_path = os.path.join(os.path.expanduser(configs.gtfs_path_root), workbook_title, worksheet_title)
-                            filename = worksheet_title
-
-                            run_validator(start_time, folder_path, filename, configs)
-                            if configs.verbose:
-                                note = '{}  {}-{}  {}\nValidation results\n'.format(15 * '^', workbook_title, worksheet_title, 15 * '^')
-                                print_et(text_color='green', start_time=start_time, title='Worksheet >> |{}-{}| <<complete.\n'.format(workbook_title, worksheet_title), note=note, configs=configs)
-                            # Add worksheet title to list of processed worksheets for merge function
-                            p_sheets.append('{}.{}'.format(workbook_title, worksheet_title))
-
-                write_proc_sheet_list(p_sheets, configs)
-
-            if len(p_sheets) > 1:
-                if configs.verbose:
-                    print('\nCombining {} gtfs feeds from {}'.format(len(p_sheets),p_sheets))
-                    note = '{}'.format('')
-                    print_et(text_color='green', start_time=start_time, title='Combining worksheets {}.'.format(p_sheets), note=note, configs=configs)
-                x = GtfsWrite()
-                x.merge_files(wrkbk_dict, configs)
-            else:
-                folder_path = os.path.join(os.path.expanduser(configs.gtfs_path_root), workbook_title, worksheet_title)
-                gtfs_source = os.path.join(folder_path, worksheet_title + '.zip')
-                gtfs_destination = os.path.join(os.path.expanduser(configs.gtfs_path_root), configs.agency_id + '.zip')
-                if configs.verbose:
-                    print('Source:{}\n  Destination:{}'.format(gtfs_source, gtfs_destination))
-                copyfile(gtfs_source, gtfs_destination)
-
-            # Run validator on final feed
-            folder_path = ''
-            filename    = configs.agency_id
-            run_validator(start_time, folder_path, filename, configs)
-            # Report on all Validator.html results
-            report_errors(configs)
-
-            # Startup the schedule_viewer with the master GTFS.zip
-            # run_schedule_viewer(configs)
+        elif configs.generate is True:
+            return generate(configs)
 
-            # Copy finished zipped gtfs to Google Drive for pickup.
-            #copy_file(start_time, configs)
-            print_et(text_color='red', start_time=start_time, title='Finished processing.\n', note='END',
-                     configs=configs)
         else:
             print(colored("Defaults are of type None.", 'cyan'))
         return 0
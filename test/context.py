@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import os
+import sys
+
+# Run the tests from a checkout without installing: src holds the gtfsgenerator package.
+source_root = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+if source_root not in sys.path:
+    sys.path.insert(0, source_root)
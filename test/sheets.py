@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import os
+import re
+from types import SimpleNamespace
+
+import context  # noqa: F401, puts src on sys.path
+
+from gtfsgenerator.Configuration import Configuration
+
+config_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'configs', 'Master.ini')
+
+
+class Cell():
+    '''
+    A worksheet cell, as gspread returns it from Worksheet.range().
+    '''
+
+    def __init__(self, row, col, value):
+        self.row = row
+        self.col = col
+        self.value = value
+
+
+class Worksheet():
+    '''
+    A worksheet held in memory, with the gspread Worksheet calls the generator makes.
+
+     Attributes:
+        title: worksheet name
+        updated: revision time, ISO 8601 UTC
+        rows: list of row values
+    '''
+
+    def __init__(self, title, rows, updated='2000-01-01T00:00:00.000000Z'):
+        self.title = title
+        self.updated = updated
+        self.rows = rows
+
+    @property
+    def row_count(self):
+        return len(self.rows)
+
+    @property
+    def col_count(self):
+        return max([len(row) for row in self.rows] + [1])
+
+    def get_addr_int(self, row, col):
+        letters = ''
+        while col > 0:
+            col, remainder = divmod(col - 1, 26)
+            letters = chr(ord('A') + remainder) + letters
+        return '{}{}'.format(letters, row)
+
+    def cell_value(self, row, col):
+        if row <= len(self.rows) and col <= len(self.rows[row - 1]):
+            return self.rows[row - 1][col - 1]
+        return ''
+
+    def range(self, address):
+        corners = []
+        for label in address.split(':'):
+            letters, row = re.match(r'^([A-Z]+)(\d+)$', label).groups()
+            col = 0
+            for letter in letters:
+                col = col * 26 + ord(letter) - ord('A') + 1
+            corners.append((int(row), col))
+        (first_row, first_col), (last_row, last_col) = corners
+        return [Cell(row, col, self.cell_value(row, col))
+                for row in range(first_row, last_row + 1) for col in range(first_col, last_col + 1)]
+
+    def row_values(self, row):
+        return [self.cell_value(row, col) for col in range(1, self.col_count + 1)]
+
+
+class Workbook():
+    '''
+    A workbook held in memory: a list of Worksheets.
+    '''
+
+    def __init__(self, title, sheets):
+        self.title = title
+        self.sheets = sheets
+
+    def worksheets(self):
+        return list(self.sheets)
+
+    def worksheet(self, title):
+        return [sheet for sheet in self.sheets if sheet.title == title][0]
+
+
+def route_rows(route_id, shape_id, stops, trips):
+    '''
+    Rows of a route worksheet: headings in row 2, route, trip and calendar data in row 3, trip start times in row 6
+        and one stop per row from row 7, departures every 15 minutes from 5:00, two minutes between stops, timed at
+        every other stop.
+    '''
+    rows = [[''] * max(27 + trips, 40) for row in range(6 + stops)]
+    data = rows[2]
+    data[10:18] = [route_id, route_id, 'Route {}'.format(route_id), '', '3', '', '', '']
+    data[18:28] = [route_id, 'wkdy', route_id, 'Downtown', '', '0', '', shape_id, '', '']
+    data[28:36] = ['wkdy', '1', '1', '1', '1', '1', '0', '0']
+    for trip in range(trips):
+        start = 300 + trip * 15
+        rows[5][27 + trip] = '{}{:02d}'.format(start // 60, start % 60)
+    for stop in range(stops):
+        row = rows[6 + stop]
+        row[2] = '{}'.format(stop + 1)
+        row[3] = 'S{}'.format(stop + 1)
+        row[10:22] = ['', 'Stop {}'.format(stop + 1), '', '{:.6f}'.format(38.0 + stop * 0.001),
+                      '{:.6f}'.format(-81.0 - stop * 0.001), '', '', '0', '', '', '0', '']
+        row[22:26] = ['', '0', '0', '']
+        if stop % 2 == 0:
+            for trip in range(trips):
+                departure = 300 + trip * 15 + stop * 2
+                row[27 + trip] = '{}:{:02d}:00'.format(departure // 60, departure % 60)
+    return rows
+
+
+def write_kml(kml_file, shape_id, points):
+    '''
+    A KML file with one LineString of points coordinates.
+    '''
+    coordinates = ' '.join('{:.6f},{:.6f},0'.format(-81.0 - point * 0.0001, 38.0 + point * 0.0001)
+                           for point in range(points))
+    with open(kml_file, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2"><Document>'
+                '<name>{}</name><Placemark><LineString><coordinates>{}</coordinates></LineString></Placemark>'
+                '</Document></kml>\n'.format(shape_id, coordinates))
+
+
+def agency_workbook(title, kml_files_root, worksheets=3, stops=6, trips=4, points=50):
+    '''
+    A workbook of route worksheets named 101, 102, ..., with one KML shape per route in kml_files_root.
+    '''
+    if not os.path.exists(kml_files_root):
+        os.makedirs(kml_files_root)
+    sheets = []
+    for worksheet in range(worksheets):
+        route_id = '{}'.format(101 + worksheet)
+        shape_id = 'shape{}'.format(route_id)
+        write_kml(os.path.join(kml_files_root, '{}.kml'.format(shape_id)), shape_id, points)
+        sheets.append(Worksheet(route_id, route_rows(route_id, shape_id, stops, trips)))
+    return Workbook(title, sheets)
+
+
+def agency_configs(root, **options):
+    '''
+    The options of configs/Master.ini and the command line defaults, with the agency's files under root.
+    :param root: directory of the KML, GTFS and report files
+    :param options: options to change, ie., jobs=2
+    :return: Configuration object
+    '''
+    configs = SimpleNamespace(**Configuration(config_file).get_defaults())
+    configs.kml_files_root = os.path.join(root, 'kml')
+    configs.gtfs_path_root = os.path.join(root, 'gtfs')
+    configs.report_path = os.path.join(root, 'reports')
+    configs.agency_id = 'test'
+    configs.ignore_sheets = 'Master,Template'
+    configs.feed_start_date = '20260101'
+    configs.feed_end_date = '20261201'
+    for name in ('verbose', 'assemble', 'incremental', 'store', 'worksheet_validator', 'no_validation_cache',
+                 'worksheet_files', 'pipeline', 'distribute', 'rebuild', 'resume', 'profile', 'memory'):
+        setattr(configs, name, False)
+    configs.pipeline_workers = ''
+    configs.pipeline_queue = 2
+    configs.columnar = None
+    configs.metrics_dir = None
+    configs.jobs = 1
+    configs.merge_workers = 1
+    configs.validate_workers = 1
+    configs.zip_level = 6
+    configs.zip_threads = 1
+    configs.fetch_retries = 1
+    configs.fetch_backoff = 0
+    configs.queue = None
+    configs.lease = 60
+    configs.max_attempts = 3
+    configs.worker_idle = 1
+    for name, value in options.items():
+        setattr(configs, name, value)
+    os.makedirs(configs.report_path, exist_ok=True)
+    return configs
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import sheets
+
+from gtfsgenerator import __main__ as generator
+from gtfsgenerator.Feed import Feed
+
+
+class TestShapeCache(unittest.TestCase):
+    '''
+    Shapes are built once per state of their KML files: an edited file replaces the shape's rows in the cache, and
+        the shapes least recently used leave it past shape_cache_limit points.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+        self.configs = sheets.agency_configs(self.root, assemble=True)
+        os.makedirs(self.configs.kml_files_root)
+        generator.shape_cache.clear()
+
+    def tearDown(self):
+        generator.shape_cache.clear()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def shape(self, shape_id, points=None):
+        kml_file = os.path.join(self.configs.kml_files_root, '{}.kml'.format(shape_id))
+        if points is not None:
+            sheets.write_kml(kml_file, shape_id, points)
+            # A new state even within the file system's timestamp resolution.
+            os.utime(kml_file, ns=(points, points))
+        feed = Feed()
+        with contextlib.redirect_stdout(io.StringIO()):
+            generator.write_shape_from_kml(shape_id, 'WB', '101', self.configs, feed)
+        return feed.tables['shapes'].sorted_rows()
+
+    def test_edited_kml_replaces_rows(self):
+        rows = self.shape('shp', 50)
+        self.assertEqual(len(rows), 50)
+        with mock.patch.object(generator, 'get_kml_elements', side_effect=AssertionError('parsed again')):
+            self.assertEqual(self.shape('shp'), rows)
+        self.assertEqual(len(self.shape('shp', 60)), 60)
+        self.assertEqual([len(rows) for states, rows in generator.shape_cache.values()], [60])
+
+    def test_least_recently_used_leave(self):
+        with mock.patch.object(generator, 'shape_cache_limit', 120):
+            for shape_id in ('a', 'b'):
+                self.shape(shape_id, 50)
+            self.shape('a')
+            self.shape('c', 50)
+        self.assertEqual([key[0] for key in generator.shape_cache], ['a', 'c'])
+
+
+class TestBatch(unittest.TestCase):
+    '''
+    A batch run generates every agency, reports a failed one without stopping the others, and refuses configs whose
+        agencies would write to the same paths.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write_config(self, name, agency_id):
+        with open(sheets.config_file) as f:
+            text = f.read()
+        text = text.replace('/krt/', '/{}/'.format(agency_id)).replace('= krt', '= {}'.format(agency_id))
+        config_file = os.path.join(self.root, '{}.ini'.format(name))
+        with open(config_file, 'w') as f:
+            f.write(text)
+        return config_file
+
+    def parse(self, *paths):
+        config_parser = generator.get_config_parser_for_passed_in_config_file()
+        with contextlib.redirect_stdout(io.StringIO()):
+            return generator.get_batch_configs(generator.get_batch_config_files(paths), config_parser, ['-g'])
+
+    def test_agencies_are_isolated(self):
+        self.write_config('hat', 'hat')
+        self.write_config('krt', 'krt')
+        batch = self.parse(self.root)
+        self.assertEqual([configs.agency_id for configs in batch], ['hat', 'krt'])
+        self.assertNotEqual(batch[0].report_path, batch[1].report_path)
+
+        # The same output paths twice.
+        self.assertIsNone(self.parse(self.write_config('krt2', 'krt'), os.path.join(self.root, 'krt.ini')))
+
+    def test_failed_agency_does_not_stop_others(self):
+        batch = self.parse(self.write_config('hat', 'hat'), self.write_config('krt', 'krt'))
+        generated = []
+
+        def generate(configs, pool=None):
+            generated.append(configs.agency_id)
+            if configs.agency_id == 'hat':
+                raise ValueError('no workbook')
+            return 0
+
+        with mock.patch.object(generator, 'generate', side_effect=generate), \
+                contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(generator.run_batch(batch), 1)
+        self.assertEqual(sorted(generated), ['hat', 'krt'])
+
+
+if __name__ == '__main__':
+    unittest.main()
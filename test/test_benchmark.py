@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import sheets
+
+from gtfsgenerator import __main__ as generator
+from gtfsgenerator import Benchmark
+from gtfsgenerator.SheetSource import memory_clients
+
+
+class TestBenchmark(unittest.TestCase):
+    '''
+    --benchmark generates a synthetic agency offline from the in-memory sheet source, reports the stages of its
+        trace and the serial and sharded merge of its files, stores a baseline when there is none and exits 1 when
+        a stage regressed against it.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+        self.configs = sheets.agency_configs(self.root, benchmark_scales='1:2:6:4:20', benchmark_repeat=1,
+                                             benchmark_threshold=0.25,
+                                             benchmark_baseline=os.path.join(self.root, 'baseline.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_parse_scale(self):
+        self.assertEqual(Benchmark.parse_scale('small')['points'], 200)
+        self.assertEqual(Benchmark.parse_scale('2:5:25:24:1000'),
+                         {'workbooks': 2, 'worksheets': 5, 'stops': 25, 'trips': 24, 'points': 1000})
+        for name in ('huge', '2:5:25:24', '2:0:25:24:1000'):
+            with self.assertRaises(ValueError):
+                Benchmark.parse_scale(name)
+
+    def test_synthetic_agency(self):
+        result = Benchmark.run_scale(self.configs, generator.generate, '1:2:6:4:20', 1)
+        self.assertEqual(sorted(result['best']), ['generate', 'merge', 'merge_parallel', 'merge_serial', 'shapes',
+                                                  'stop_times', 'wall', 'zip'])
+        self.assertTrue(all(seconds > 0 for seconds in result['best'].values()))
+        # The sharded merge is timed against the serial one on --merge_workers, or 4 workers.
+        self.assertEqual(result['merge_workers'], 4)
+        self.assertEqual(memory_clients, {})
+
+    def benchmark(self, generate=generator.generate):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return Benchmark.run_benchmark(self.configs, generate)
+
+    def test_baseline_regression(self):
+        self.assertEqual(self.benchmark(), 0)
+        with open(self.configs.benchmark_baseline) as f:
+            baseline = json.load(f)
+        self.assertEqual(baseline['scales']['1:2:6:4:20']['scale']['stops'], 6)
+
+        def slow_generate(configs):
+            time.sleep(0.1)
+            return generator.generate(configs)
+        # Slower end to end than the baseline by more than the threshold and the minimum.
+        baseline['scales']['1:2:6:4:20']['best']['wall'] = 0.01
+        with open(self.configs.benchmark_baseline, 'w') as f:
+            json.dump(baseline, f)
+        self.assertEqual(self.benchmark(slow_generate), 1)
+
+        self.configs.benchmark_threshold = 100.0
+        self.assertEqual(self.benchmark(slow_generate), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
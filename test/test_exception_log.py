@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import context  # noqa: F401, puts src on sys.path
+
+from gtfsgenerator.ExceptionLog import ExceptionLog
+from gtfsgenerator.ExceptionLog import ExceptionRecord
+from gtfsgenerator.ExceptionLog import exception_record
+
+
+class TestExceptionLog(unittest.TestCase):
+    '''
+    The ExceptionLog takes the typed records of a run and the tuples of older build graphs, and writes them once as
+        JSON lines and a summary grouped by worksheet and code.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+        self.log = ExceptionLog(os.path.join(self.root, 'reports'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_older_tuples(self):
+        self.assertEqual(exception_record(('Bad time.', 'WB', '101', 'Mon Jan  5 10:00:00 2026')),
+                         ExceptionRecord('Bad time.', 'WB', '101', 'Mon Jan  5 10:00:00 2026', None, None, None, None))
+        record = exception_record(('Bad time.', 'WB', '101', 'Mon Jan  5 10:00:00 2026', 'time_format', 'WB_101_1'))
+        self.assertEqual((record.code, record.trip_id), ('time_format', 'WB_101_1'))
+        self.assertIs(exception_record(record), record)
+
+    def test_write(self):
+        self.log.add([ExceptionRecord('Bad time.', 'WB', '101', 0.0, 8, 'AB', 'time_format', 'WB_101_1'),
+                      ('Stop missing.', 'WB', '101', 'Mon Jan  5 10:00:00 2026'),
+                      ExceptionRecord('Bad time.', 'WB', '102', 0.0, 9, 'AC', 'time_format', 'WB_102_1'),
+                      ExceptionRecord('Late.', 'WB', '101', 0.0, 9, 'AB', 'time_format', 'WB_101_2')])
+        self.assertEqual(self.log.counts(), {'time_format': 3, '': 1})
+        jsonl_file = self.log.write()
+        with open(jsonl_file) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([(record['worksheet'], record['trip_id']) for record in records],
+                         [('101', 'WB_101_1'), ('101', None), ('102', 'WB_102_1'), ('101', 'WB_101_2')])
+        self.assertEqual(records[0]['time'], '1970-01-01T00:00:00Z')
+        with open(os.path.join(self.root, 'reports', 'exceptions.txt')) as f:
+            summary = f.read().splitlines()
+        self.assertEqual(summary[1], '4 exceptions in 2 worksheets.')
+        self.assertIn('Workbook: WB Worksheet:101  3 exceptions', summary)
+        self.assertEqual(summary[summary.index('  time_format: 2') + 1][:21], '    AB8 exception:Bad')
+
+    def test_pickled_log_starts_empty(self):
+        self.log.add([ExceptionRecord('Bad time.', 'WB', '101', 0.0, 8, 'AB', 'time_format', 'WB_101_1')])
+        self.assertEqual(pickle.loads(pickle.dumps(self.log)).records, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from types import SimpleNamespace
+
+import context  # noqa: F401, puts src on sys.path
+
+from gtfsgenerator import __main__ as generator
+from gtfsgenerator.Feed import Feed
+from gtfsgenerator.Feed import StaticTables
+from gtfsgenerator.GTFS import GtfsWrite
+
+# Rows of two worksheets; they share stop S1 and disagree on S2.
+worksheets = {
+    'A': {'stops': [('S1', '', 'One', '', '38.1', '-81.1', '', '', '0', '', '', '0'),
+                    ('S2', '', 'Two', '', '38.2', '-81.2', '', '', '0', '', '', '0')],
+          'trips': [('r1', 'wkdy', 'A-600', 'Downtown', '', '0', '', 'shp', '', '')]},
+    'B': {'stops': [('S1', '', 'One', '', '38.1', '-81.1', '', '', '0', '', '', '0'),
+                    ('S2', '', 'Second', '', '38.2', '-81.2', '', '', '0', '', '', '0'),
+                    ('S10', '', 'Ten', '', '38.3', '-81.3', '', '', '0', '', '', '0')],
+          'trips': [('r2', 'wkdy', 'B-600', 'Uptown', '', '0', '', 'shp', '', '')]},
+}
+
+
+class TestFeed(unittest.TestCase):
+    '''
+    Worksheets assembled into a Feed serialize to the same tables and conflicts as their worksheet files merged by
+        merge_files, without writing worksheet files.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+        self.configs = SimpleNamespace(gtfs_path_root=os.path.join(self.root, 'gtfs'),
+                                       report_path=os.path.join(self.root, 'reports'), verbose=False,
+                                       worksheet_files=False, merge_workers=1, agency_id='test',
+                                       zip_level=6, zip_threads=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write_rows(self, feed=None):
+        for worksheet_title, tables in sorted(worksheets.items()):
+            generator.create_wrkbk_wrksht_output_dir('W', worksheet_title, self.configs)
+            for gtfs_file, rows in sorted(tables.items()):
+                generator.write_gtfs_rows(gtfs_file, rows, 'W', worksheet_title, self.configs, feed)
+
+    def test_assembled_feed_equals_merge(self):
+        feed = Feed()
+        self.write_rows(feed)
+        self.assertEqual(os.listdir(os.path.join(self.configs.gtfs_path_root, 'W', 'A')), [])
+        feed.report(self.configs)
+        with open(os.path.join(self.configs.report_path, 'merge_conflicts.txt')) as f:
+            assembled_conflicts = f.read()
+        zip_file = os.path.join(self.configs.gtfs_path_root, 'test.zip')
+        feed.write_zip(zip_file)
+        with zipfile.ZipFile(zip_file) as z:
+            assembled = dict((name, z.read(name).decode('utf-8')) for name in ('stops.txt', 'trips.txt'))
+
+        self.write_rows()
+        GtfsWrite().merge_files({'W': ['A', 'B']}, self.configs)
+        for name, text in assembled.items():
+            with open(os.path.join(self.configs.gtfs_path_root, name)) as f:
+                self.assertEqual(f.read(), text)
+        with open(os.path.join(self.configs.report_path, 'merge_conflicts.txt')) as f:
+            self.assertEqual(f.read(), assembled_conflicts)
+        self.assertEqual(assembled['stops.txt'].splitlines()[1:4], [
+            'S1,,One,,38.1,-81.1,,,0,,,0', 'S2,,Two,,38.2,-81.2,,,0,,,0', 'S10,,Ten,,38.3,-81.3,,,0,,,0'])
+        self.assertIn('stops.txt key:S2 kept:W.A rejected:W.B', assembled_conflicts)
+
+
+class TestStaticTables(unittest.TestCase):
+    '''
+    The config-derived tables are rendered once, with one feed_version, and every copy of them has the same bytes.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+        self.configs = SimpleNamespace(
+            gtfs_path_root=os.path.join(self.root, 'gtfs'), report_path=os.path.join(self.root, 'reports'),
+            verbose=False, worksheet_files=False, merge_workers=1, zip_level=6, zip_threads=1, local_tz='US/Eastern',
+            agency_id='test', agency_name='Test', agency_url='http://example.com', agency_timezone='America/New_York',
+            agency_lang='en', agency_phone='555', feed_publisher_name='Test', feed_publisher_url='http://example.com',
+            feed_lang='en', feed_start_date='20260101', feed_end_date='20261201', delta_max='364', fare_ids='one,day',
+            prices='1.50,2.50', currency='USD', payment_method='0', transfers='0,0', durations='0,86400')
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_rendered_once(self):
+        static_tables = generator.render_static_tables(self.configs)
+        self.assertEqual(sorted(static_tables.content), StaticTables.names)
+        feed_info = static_tables.content['feed_info'].decode('utf-8').splitlines()
+        self.assertTrue(feed_info[1].endswith(',20260101,20261201,{}'.format(static_tables.feed_version)))
+        self.assertEqual(len(static_tables.tables['fare_attributes'].rows), 2)
+
+        for worksheet_title in ('A', 'B'):
+            generator.write_static_tables(static_tables, 'W', worksheet_title, self.configs)
+        GtfsWrite().merge_files({'W': ['A', 'B']}, self.configs, static_tables)
+        for gtfs_file, content in static_tables.content.items():
+            for path in ('W/A', 'W/B', ''):
+                with open(os.path.join(self.configs.gtfs_path_root, path, gtfs_file + '.txt'), 'rb') as f:
+                    self.assertEqual(f.read(), content)
+
+        feed = Feed()
+        static_tables.add_to(feed)
+        self.assertEqual(feed.tables['agency'].sorted_rows(), static_tables.tables['agency'].sorted_rows())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import context  # noqa: F401, puts src on sys.path
+
+from gtfsgenerator import FeedArrow
+from gtfsgenerator.FeedZip import FeedZip
+from gtfsgenerator.GTFS import GtfsHeader
+
+
+@unittest.skipIf(FeedArrow.pa is None, 'pyarrow is not installed')
+class TestColumnar(unittest.TestCase):
+    '''
+    The columnar export types times as seconds, coordinates as floats and integer fields as int32, and keeps ids,
+        zero padding included, as text.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+        self.zip_file = os.path.join(self.root, 'test.zip')
+        feed_zip = FeedZip(self.zip_file)
+        x = GtfsHeader()
+        feed_zip.add('stops.txt', (x.return_header('stops') + '\n007,,Mall,,38.25,-81.5,,,0,,,1\n').encode('utf-8'))
+        feed_zip.add('stop_times.txt', (x.return_header('stop_times') + '\nt1,25:10:00,25:10:00,007,2,,0,0,\n'
+                                        't1,,,008,3,,0,0,1.5\n').encode('utf-8'))
+        feed_zip.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_types(self):
+        for out_format in ('arrow', 'parquet'):
+            out_dir = os.path.join(self.root, out_format)
+            written = FeedArrow.write_columnar(self.zip_file, out_dir, out_format)
+            self.assertEqual(sorted(os.path.basename(name) for name in written),
+                             ['stop_times.{}'.format(out_format), 'stops.{}'.format(out_format)])
+
+            stop_times = FeedArrow.load_table(out_dir, 'stop_times', out_format).to_pydict()
+            self.assertEqual(stop_times['arrival_time'], [90600, None])
+            self.assertEqual(stop_times['stop_id'], ['007', '008'])
+            self.assertEqual(stop_times['stop_sequence'], [2, 3])
+            self.assertEqual(stop_times['shape_dist_traveled'], [None, 1.5])
+            stops = FeedArrow.load_table(out_dir, 'stops', out_format).to_pydict()
+            self.assertEqual((stops['stop_lat'], stops['wheelchair_boarding']), ([38.25], [1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
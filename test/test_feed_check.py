@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import unittest
+
+import context  # noqa: F401, puts src on sys.path
+
+from gtfsgenerator.FeedCheck import FeedCheck
+from gtfsgenerator.GTFS import GtfsTable
+
+tables = {
+    'routes': [('r1', '', '1', 'Main', '', '3', '', '', '')],
+    'calendar': [('wkdy', '1', '1', '1', '1', '1', '0', '0', '20260101', '20261231')],
+    'stops': [('S1', '', 'One', '', '38.1', '-81.1', '', '', '0', '', '', '0'),
+              ('S2', '', 'Two', '', '38.2', '-81.2', '', '', '0', '', '', '0')],
+    'trips': [('r1', 'wkdy', 't1', 'Downtown', '', '0', '', 'shp', '', ''),
+              ('r9', 'sat', 't2', 'Uptown', '', '0', '', '', '', '')],
+    'stop_times': [('t1', '06:00:00', '06:00:00', 'S1', '1', '', '0', '0', ''),
+                   ('t1', '05:59:00', '05:59:00', 'S9', '3', '', '0', '0', ''),
+                   ('t1', '', '', 'S2', '2', '', '0', '0', ''),
+                   ('t2', '07:00:00', '07:00:00', 'S1', 'x', '', '0', '0', ''),
+                   ('t2', '7:5', '07:10:00', 'S2', '2', '', '0', '0', ''),
+                   ('t3', '08:00:00', '08:00:00', 'S1', '1', '', '0', '0', '')],
+}
+
+
+class TestFeedCheck(unittest.TestCase):
+    '''
+    FeedCheck reports unresolved references, stop_sequences that are not increasing integers, untimed first and last
+        stops, malformed times and times that decrease along a trip.
+    '''
+
+    def test_check(self):
+        gtfs_tables = {}
+        for gtfs_file, rows in tables.items():
+            gtfs_tables[gtfs_file] = GtfsTable(gtfs_file)
+            for row in rows:
+                gtfs_tables[gtfs_file].add(row)
+        errors = FeedCheck(gtfs_tables).check()
+        for expected in [
+                ('stop_times', 'trip_id t3 not in trips.txt'),
+                ('stop_times', 'stop_id S9 not in stops.txt'),
+                ('trips', 'route_id r9 not in routes.txt'),
+                ('trips', 'service_id sat not in calendar.txt or calendar_dates.txt'),
+                ('trips', 'shape_id shp not in shapes.txt'),
+                ('stop_times', 'trip_id t1 stop_sequence 2 after 3 does not increase'),
+                ('stop_times', 'trip_id t1 stop_sequence 2 last stop has no arrival/departure time'),
+                ('stop_times', 'trip_id t1 stop_sequence 3 time 05:59:00 before 06:00:00'),
+                ('stop_times', 'trip_id t2 stop_sequence x is not a non-negative integer'),
+                ('stop_times', 'trip_id t2 stop_sequence 2 malformed time 7:5/07:10:00'),
+                ('stop_times', 'trip_id t2 stop_sequence 2 last stop has no arrival/departure time')]:
+            self.assertIn(expected, errors)
+        # trip t2 has no shape, which is optional; stops S1 and S2 resolve.
+        self.assertNotIn(('trips', 'shape_id  not in shapes.txt'), errors)
+        self.assertEqual(len(errors), 11)
+
+
+if __name__ == '__main__':
+    unittest.main()
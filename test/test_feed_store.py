@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import context  # noqa: F401, puts src on sys.path
+
+from gtfsgenerator.Feed import Feed
+from gtfsgenerator.FeedStore import FeedStore
+
+# Rows of two worksheets: identical stop S1, conflicting stop S2, a stop_sequence repeated within worksheet B.
+worksheets = [
+    ('W.A', {'stops': [('S1', '', 'One', '', '38.1', '-81.1', '', '', '0', '', '', '0'),
+                       ('S2', '', 'Two', '', '38.2', '-81.2', '', '', '0', '', '', '0')],
+             'stop_times': [('t1', '06:00:00', '06:00:00', 'S1', '1', '', '0', '0', ''),
+                            ('t1', '06:10:00', '06:10:00', 'S2', '10', '', '0', '0', ''),
+                            ('t1', '06:05:00', '06:05:00', 'S2', '2', '', '0', '0', '')],
+             'trips': [('r1', 'wkdy', 't1', 'Downtown', '', '0', '', 'shp', '', '')]}),
+    ('W.B', {'stops': [('S1', '', 'One', '', '38.1', '-81.1', '', '', '0', '', '', '0'),
+                       ('S2', '', 'Second', '', '38.2', '-81.2', '', '', '0', '', '', '0'),
+                       ('S10', '', 'Ten', '', '38.3', '-81.3', '', '', '0', '', '', '0')],
+             'stop_times': [('t2', '07:00:00', '07:00:00', 'S10', '1', '', '0', '0', ''),
+                            ('t2', '07:05:00', '07:05:00', 'S1', '1', '', '0', '0', '')],
+             'trips': [('r1', 'wkdy', 't2', 'Uptown', '', '0', '', 'shp', '', '')]}),
+]
+
+
+class TestFeedStore(unittest.TestCase):
+    '''
+    The store keeps the first row of a key and records the same conflicts and duplicates as an in-memory Feed, and
+        exports the same table text.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+        self.store = FeedStore(os.path.join(self.root, 'test.sqlite'))
+        self.feed = Feed()
+        for source, tables in worksheets:
+            for gtfs_file, rows in sorted(tables.items()):
+                self.store.add_rows(gtfs_file, rows, source)
+                self.feed.add_rows(gtfs_file, rows, source)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_conflicts(self):
+        self.assertEqual(sorted(self.store.conflicts()), sorted(self.feed.conflicts()))
+        self.assertEqual(sorted(self.store.conflicts()), [('stop_times', ('t2', '1'), 'W.B', 'W.B'),
+                                                          ('stops', ('S2',), 'W.A', 'W.B')])
+        self.assertEqual(self.store.duplicates['stops'], 1)
+        self.assertEqual(self.store.query('SELECT stop_name FROM stops WHERE stop_id = ?', ('S2',)), [('Two',)])
+
+    def test_export_matches_feed(self):
+        for gtfs_file in ('stops', 'stop_times', 'trips'):
+            exported = io.StringIO(newline='')
+            self.store.serialize(gtfs_file, exported)
+            serialized = io.StringIO(newline='')
+            self.feed.tables[gtfs_file].serialize(serialized)
+            self.assertEqual(exported.getvalue(), serialized.getvalue())
+
+    def test_validate(self):
+        self.assertIn(('trips', 'route_id r1 not in routes.txt', 'W.A'), self.store.validate())
+        self.assertNotIn('stop_id', ' '.join(message for gtfs_file, message, source in self.store.validate()))
+
+
+if __name__ == '__main__':
+    unittest.main()
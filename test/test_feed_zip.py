@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+import context  # noqa: F401, puts src on sys.path
+
+from gtfsgenerator.FeedZip import FeedZip
+from gtfsgenerator.FeedZip import read_zip_state
+
+# A member large enough to be written in several chunks.
+stop_times = ''.join('{},{},{:02d}:{:02d}:00\n'.format(trip, stop, 5 + stop // 60, stop % 60)
+                     for trip in range(2000) for stop in range(40))
+
+
+class TestFeedZip(unittest.TestCase):
+    '''
+    FeedZip archives, streamed on one thread or rendered on several, are valid zip files: unchanged archives are not
+        replaced, a new compresslevel rewrites them, members past the zip limits get ZIP64 headers, and a failing
+        member leaves the previous archive in place.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+        self.zip_file = os.path.join(self.root, 'feed.zip')
+        self.stops_file = os.path.join(self.root, 'stops.txt')
+        with open(self.stops_file, 'w') as f:
+            f.write('stop_id,stop_name\nS1,One\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write(self, threads, compresslevel=6, extra=''):
+        feed_zip = FeedZip(self.zip_file, compresslevel, threads)
+        feed_zip.add('agency.txt', b'agency_id,agency_name\ntest,Test\n')
+        feed_zip.add('stop_times.txt', lambda f: f.write(stop_times + extra))
+        feed_zip.add('stops.txt', self.stops_file)
+        return feed_zip.close()
+
+    def check(self, extra=''):
+        with zipfile.ZipFile(self.zip_file) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(z.namelist(), ['agency.txt', 'stop_times.txt', 'stops.txt'])
+            self.assertEqual(z.read('stop_times.txt').decode('utf-8'), stop_times + extra)
+            self.assertEqual(z.read('stops.txt'), b'stop_id,stop_name\nS1,One\n')
+        self.assertFalse(os.path.exists(self.zip_file + '.tmp'))
+
+    def test_output_is_valid(self):
+        for threads in (1, 4):
+            self.assertTrue(self.write(threads, extra='{}\n'.format(threads)))
+            self.check('{}\n'.format(threads))
+
+    def test_unchanged_archive_is_not_replaced(self):
+        for threads in (1, 4):
+            self.assertTrue(self.write(threads, extra='{}\n'.format(threads)))
+            inode = os.stat(self.zip_file).st_ino
+            self.assertFalse(self.write(threads, extra='{}\n'.format(threads)))
+            self.assertEqual(os.stat(self.zip_file).st_ino, inode)
+            self.check('{}\n'.format(threads))
+
+    def test_new_compresslevel_rewrites(self):
+        for threads in (1, 4):
+            self.write(threads, 6)
+            self.assertTrue(self.write(threads, 9))
+            self.assertEqual(read_zip_state(self.zip_file)['compresslevel'], 9)
+            self.check()
+
+    def test_zip64(self):
+        for threads in (1, 4):
+            with mock.patch.object(zipfile, 'ZIP64_LIMIT', 1000):
+                self.assertTrue(self.write(threads, 5, extra='{}\n'.format(threads)))
+            self.check('{}\n'.format(threads))
+            self.assertEqual(read_zip_state(self.zip_file)['compresslevel'], 5)
+
+    def test_failing_member_keeps_previous_archive(self):
+        def fail(f):
+            f.write(stop_times)
+            raise ValueError('render failed')
+
+        self.write(1)
+        for threads in (1, 4):
+            feed_zip = FeedZip(self.zip_file, 6, threads)
+            feed_zip.add('stop_times.txt', fail)
+            feed_zip.add('stops.txt', lambda f: f.write(stop_times))
+            with self.assertRaises(ValueError):
+                feed_zip.close()
+            self.check()
+
+
+if __name__ == '__main__':
+    unittest.main()
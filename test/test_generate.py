@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import contextlib
+import functools
+import io
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+
+import sheets
+
+from gtfsgenerator import __main__ as generator
+from gtfsgenerator.BuildGraph import BuildGraph
+from gtfsgenerator.Checkpoint import Checkpoint
+from gtfsgenerator.ExceptionLog import ExceptionLog
+from gtfsgenerator.Feed import Feed
+from gtfsgenerator.FeedStore import FeedStore
+from gtfsgenerator.Trace import Tracer
+from gtfsgenerator.WorkQueue import WorkQueue
+
+
+class TestBuildWorkbook(unittest.TestCase):
+    '''
+    build_workbook finishes worksheets in worksheet order: built on a --jobs pool or in the --pipeline, the worksheet
+        files, assembled feed and exceptions are the same as built one after another. A worksheet the build graph
+        finds up to date is added from its last build, one whose trip columns alone changed is patched, and the
+        SQLite store kept between runs holds what a full build of the same worksheets would. A resumed run builds
+        the worksheets the interrupted one could not retrieve into the same feed, and builds queued for --worker
+        processes are finished in worksheet order too. Traced, the stages of a worksheet nest under its span wherever
+        it is built.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+        self.workbook = sheets.agency_workbook('WB', os.path.join(self.root, 'kml'))
+        # A stop_sequence used twice in the first worksheet: an exception to report in worksheet order.
+        self.workbook.sheets[0].rows[7][2] = '1'
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def build(self, name, jobs, store=False, resume=False, queue=False, trace=False, **options):
+        configs = sheets.agency_configs(os.path.join(self.root, name), jobs=jobs, worksheet_files=True,
+                                        kml_files_root=os.path.join(self.root, 'kml'), **options)
+        static_tables = generator.render_static_tables(configs)
+        feed = Feed()
+        static_tables.add_to(feed)
+        pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 and not configs.pipeline else None
+        self.graph = BuildGraph(generator.get_build_graph_file(configs), configs)
+        checkpoint = Checkpoint(generator.get_checkpoint_file(configs), self.graph.config)
+        checkpoint.begin(resume)
+        configs.exception_log = ExceptionLog(configs.report_path)
+        if trace:
+            configs.tracer = Tracer(os.path.join(configs.report_path, 'trace.jsonl'))
+        self.failed = []
+        run = {'start_time': None, 'static_tables': static_tables, 'feed': feed, 'store': None, 'graph': self.graph,
+               'checkpoint': checkpoint, 'validators': None, 'validation_cache': None, 'files': True, 'pool': pool,
+               'shared_pool': None, 'work_queue': None, 'all_stops': [], 'failed': self.failed}
+        workers = []
+        if queue:
+            # Two workers claiming the queued builds, stopped once the queue stays empty.
+            run['work_queue'] = WorkQueue(generator.get_queue_file(configs), configs.lease)
+            workers = [threading.Thread(target=generator.run_worker, args=(configs,)) for worker in range(2)]
+        if store:
+            run['store'] = FeedStore(generator.get_store_file(configs))
+            run['store'].remove_source('config')
+            static_tables.add_to(run['store'])
+        with mock.patch.object(generator, 'open_google_workbook', return_value=self.workbook), \
+                contextlib.redirect_stdout(io.StringIO()):
+            for worker in workers:
+                worker.start()
+            completed = generator.build_workbook('WB', run, configs)
+            for worker in workers:
+                worker.join()
+        if run['work_queue'] is not None:
+            run['work_queue'].close()
+        if pool is not None:
+            pool.shutdown()
+        if trace:
+            self.records = configs.tracer.records()
+            configs.tracer.close()
+        if store:
+            return completed, self.read_store(run['store'])
+        files = {}
+        for source in completed:
+            worksheet = source.split('.', 1)[1]
+            path = os.path.join(configs.gtfs_path_root, 'WB', worksheet)
+            for name in ('stops.txt', 'stop_times.txt', 'trips.txt', 'shapes.txt', 'manifest.json'):
+                with open(os.path.join(path, name)) as f:
+                    files[worksheet, name] = f.read()
+        configs.exception_log.write()
+        with open(os.path.join(configs.report_path, 'exceptions.txt')) as f:
+            # Exceptions carry the time they were raised; compare them without it.
+            exceptions = re.sub(r'\w{3} \w{3} [ \d]\d \d\d:\d\d:\d\d \d{4}', '', f.read())
+        tables = dict((gtfs_file, table.sorted_rows()) for gtfs_file, table in feed.tables.items())
+        return completed, run['all_stops'], files, tables, exceptions
+
+    def read_store(self, store):
+        # Worksheets no longer in the workbook leave the store, as at the end of a --store run.
+        for source in sorted(store.sources - set(store.placed)):
+            store.remove_source(source)
+        tables = {}
+        for gtfs_file in store.columns:
+            f = io.StringIO(newline='')
+            store.serialize(gtfs_file, f)
+            tables[gtfs_file] = f.getvalue()
+        state = tables, sorted(store.conflicts()), store.duplicates, store.sources
+        store.close()
+        return state
+
+    def test_pool_matches_sequential(self):
+        sequential = self.build('sequential', 1)
+        self.assertEqual(sequential[0], ['WB.101', 'WB.102', 'WB.103'])
+        self.assertIn('Duplicate stop_times.txt key', sequential[4])
+        self.assertEqual(len(sequential[3]['trips']), 12)
+        self.assertEqual(len(sequential[3]['shapes']), 150)
+        self.assertEqual(self.build('pooled', 3), sequential)
+
+    def test_pipeline_matches_sequential(self):
+        sequential = self.build('sequential', 1)
+        self.assertEqual(self.build('pipeline', 1, pipeline=True, pipeline_workers='fetch=2,tables=2'), sequential)
+        self.assertEqual(self.build('pipeline_jobs', 2, pipeline=True), sequential)
+
+    def test_work_queue_matches_sequential(self):
+        sequential = self.build('sequential', 1)
+        self.assertEqual(self.build('queue', 1, queue=True), sequential)
+        # --pipeline does not apply to a --distribute run.
+        self.assertEqual(self.build('queue_pipeline', 1, queue=True, pipeline=True), sequential)
+
+    def test_stages_nest_under_worksheets(self):
+        for name, jobs, options in (('traced', 1, {}), ('traced_pooled', 2, {}), ('traced_queue', 1, {'queue': True})):
+            self.build(name, jobs, trace=True, **options)
+            worksheets = dict((record['id'], record['name']) for record in self.records
+                              if record['kind'] == 'worksheet')
+            self.assertEqual(sorted(worksheets.values()), ['WB.101', 'WB.102', 'WB.103'])
+            stages = [record for record in self.records if record['kind'] == 'stage']
+            self.assertEqual(set(record['name'] for record in stages),
+                             {'fetch', 'routes', 'calendar', 'stops', 'stop_times', 'shapes', 'check', 'zip'})
+            for record in stages:
+                self.assertEqual(worksheets[record['parent']], record['attributes']['worksheet'])
+
+    def test_up_to_date_worksheets_are_reused(self):
+        built = self.build('graph', 1)
+        self.assertEqual(self.graph.stats(), 'reused:0 patched:0 rebuilt:3')
+        for jobs, options in ((1, {}), (2, {}), (1, {'pipeline': True})):
+            self.assertEqual(self.build('graph', jobs, **options), built)
+            self.assertEqual(self.graph.stats(), 'reused:3 patched:0 rebuilt:0')
+
+        # An edited worksheet, with a later update time, is rebuilt; the others are reused.
+        self.workbook.sheets[1].rows[2][21] = 'Uptown'
+        self.workbook.sheets[1].updated = '2000-01-02T00:00:00.000000Z'
+        rebuilt = self.build('graph', 1)
+        self.assertEqual(self.graph.stats(), 'reused:2 patched:0 rebuilt:1')
+        self.assertEqual(rebuilt, self.build('rebuilt', 1))
+        self.assertNotEqual(rebuilt[3]['trips'], built[3]['trips'])
+
+    def edit(self, sheet, row, column, value):
+        worksheet = self.workbook.sheets[sheet]
+        worksheet.rows[row][column] = value
+        self.edits = getattr(self, 'edits', 0) + 1
+        worksheet.updated = '2001-01-01T00:00:{:02d}.000000Z'.format(self.edits)
+
+    def test_trip_columns_are_patched(self):
+        for jobs, options in ((1, {}), (2, {}), (1, {'pipeline': True})):
+            name = 'patch{}{}'.format(jobs, len(options))
+            self.build(name, jobs, **options)
+            # A later departure of the second trip at every timed stop, and a trip removed from the last worksheet.
+            for stop in range(0, 6, 2):
+                self.edit(1, 6 + stop, 28, '5:{:02d}:00'.format(20 + stop * 2))
+            self.edit(2, 5, 30, '')
+            for row in range(6, 12):
+                self.edit(2, row, 30, '')
+            patched = self.build(name, jobs, **options)
+            self.assertEqual(self.graph.stats(), 'reused:1 patched:2 rebuilt:0')
+            self.assertEqual(patched, self.build(name + 'full', 1))
+            self.assertEqual(len(patched[3]['trips']), 11)
+            self.setUp()
+
+    def store_runs(self):
+        '''
+        Edits applied between --store runs: a stop row, a trip column, the worksheet order and a worksheet removed.
+        '''
+        yield 'built'
+        # The first worksheet keeps its S1 over the others'; rebuilt, it is added after them but still wins.
+        self.edit(0, 6, 11, 'First')
+        yield 'stop row'
+        self.edit(0, 6, 11, 'Renamed')
+        self.edit(1, 6, 11, 'Second')
+        yield 'stop rows'
+        self.edit(0, 6, 28, '5:16:00')
+        yield 'trip column'
+        self.workbook.sheets.reverse()
+        yield 'reordered'
+        del self.workbook.sheets[1]
+        yield 'removed'
+
+    def test_store_matches_full_build(self):
+        for step in self.store_runs():
+            incremental = self.build('store', 1, store=True)
+            full = self.build('full_{}'.format(step.replace(' ', '_')), 1, store=True)
+            self.assertEqual(incremental, full, step)
+        # Reordered, the last worksheet's S1 is kept over the renamed one.
+        self.assertEqual(incremental[0], ['WB.103', 'WB.101'])
+        self.assertIn(('stops', ('S1',), 'WB.103', 'WB.101'), incremental[1][1])
+        self.assertIn('S1,,Stop 1,', incremental[1][0]['stops'])
+
+    def test_resume_matches_uninterrupted(self):
+        # Without revision times every worksheet is fetched, unless the checkpoint has it done.
+        for worksheet in self.workbook.sheets:
+            worksheet.updated = None
+        fetch_worksheet_rows = generator.fetch_worksheet_rows
+        fetched = []
+
+        def fetch(worksheet, workbook_title, configs, fail=()):
+            fetched.append(worksheet.title)
+            if worksheet.title in fail:
+                raise OSError('timed out')
+            return fetch_worksheet_rows(worksheet, workbook_title, configs)
+
+        for jobs, options in ((1, {}), (2, {}), (1, {'pipeline': True})):
+            name = 'resume{}{}'.format(jobs, len(options))
+            with mock.patch.object(generator, 'fetch_worksheet_rows', side_effect=functools.partial(
+                    fetch, fail=('102',))):
+                interrupted = self.build(name, jobs, **options)
+            self.assertEqual(interrupted[0], ['WB.101', 'WB.103'])
+            self.assertEqual(self.failed, ['WB.102'])
+            self.assertEqual(fetched.count('102'), 2)
+
+            del fetched[:]
+            with mock.patch.object(generator, 'fetch_worksheet_rows', side_effect=fetch):
+                resumed = self.build(name, jobs, resume=True, **options)
+            self.assertEqual(fetched, ['102'])
+            self.assertEqual(self.failed, [])
+            self.assertEqual(resumed, self.build(name + 'full', jobs, **options))
+            del fetched[:]
+
+
+if __name__ == '__main__':
+    unittest.main()
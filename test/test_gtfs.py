@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import context  # noqa: F401, puts src on sys.path
+
+from gtfsgenerator.GTFS import GtfsHeader
+from gtfsgenerator.GTFS import GtfsWrite
+from gtfsgenerator.GTFS import natural_key
+from gtfsgenerator.GTFS import natural_text
+
+
+def write_table(path, gtfs_file, lines):
+    '''
+    Write a worksheet's GTFS file with its header.
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+    with open(os.path.join(path, '{}.txt'.format(gtfs_file)), 'w') as f:
+        f.write(GtfsHeader().return_header(gtfs_file).strip() + '\n' + ''.join(line + '\n' for line in lines))
+
+
+class TestMerge(unittest.TestCase):
+    '''
+    merge_files keeps one row per primary key, ordered by key with numbers compared numerically, and reports rows
+        that share a key with different values.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+        self.configs = SimpleNamespace(gtfs_path_root=os.path.join(self.root, 'gtfs'),
+                                       report_path=os.path.join(self.root, 'reports'), verbose=False,
+                                       merge_workers=1, agency_id='test', zip_level=6, zip_threads=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def read(self, name):
+        with open(os.path.join(self.root, name)) as f:
+            return f.read().splitlines()
+
+    def test_natural_key(self):
+        self.assertEqual(sorted(['10', '2', '1'], key=lambda value: natural_key((value,))), ['1', '2', '10'])
+        self.assertLess(natural_key(('t9', '2')), natural_key(('t10', '1')))
+
+    def test_natural_text(self):
+        keys = [('t10', '1'), ('t9', '2'), ('t9', '10'), ('07',), ('7',), ('12345678901234567890123',), ('8',),
+                ('a',), ('ab',), ('a1',), ('',)]
+        self.assertEqual(sorted(keys, key=natural_text), sorted(keys, key=lambda key: (natural_key(key), key)))
+
+    def test_merge_on_primary_key(self):
+        worksheet_a = os.path.join(self.configs.gtfs_path_root, 'W', 'A')
+        worksheet_b = os.path.join(self.configs.gtfs_path_root, 'W', 'B')
+        write_table(worksheet_a, 'stop_times', ['t1,6:10:00,6:10:00,S3,10,,0,0,', 't1,6:00:00,6:00:00,S1,2,,0,0,'])
+        write_table(worksheet_a, 'trips', ['r1,wkdy,t1,Downtown,,0,,shp,,'])
+        # The same trip again with a trailing space, and a trip_id of A's with different values.
+        write_table(worksheet_b, 'stop_times', ['t1,6:00:00,6:00:00,S1,2,,0,0, '])
+        write_table(worksheet_b, 'trips', ['r1,wkdy,t1,Uptown,,0,,shp,,'])
+
+        GtfsWrite().merge_files({'W': ['A', 'B']}, self.configs)
+
+        stop_times = self.read('gtfs/stop_times.txt')
+        self.assertEqual([line.split(',')[4] for line in stop_times[1:]], ['2', '10'])
+        trips = self.read('gtfs/trips.txt')
+        self.assertEqual(trips[1:], ['r1,wkdy,t1,Downtown,,0,,shp,,'])
+        conflicts = self.read('reports/merge_conflicts.txt')
+        self.assertEqual(conflicts, ['Primary key conflicts:1', 'trips.txt key:t1 kept:W.A rejected:W.B'])
+
+
+class TestParallelMerge(unittest.TestCase):
+    '''
+    With merge_workers > 1, stop_times and shapes are partitioned once and merged by shard; the feed and the conflicts
+        are the same bytes as the serial merge.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+        self.wrkbk_dict = {'W': ['A', 'B', 'C', 'D']}
+        for n, worksheet_title in enumerate(self.wrkbk_dict['W']):
+            path = os.path.join(self.root, 'gtfs', 'W', worksheet_title)
+            # Trips overlap between neighbouring worksheets, and every fifth trip of a later one has another time.
+            lines = ['t{},6:{:02d}:00,6:{:02d}:00,S{},{},,0,0,'.format(trip, sequence, sequence + (trip % 5 == 0) * n,
+                                                                       sequence, sequence)
+                     for trip in range(n * 20, n * 20 + 40) for sequence in range(1, 12)]
+            write_table(path, 'stop_times', lines)
+            write_table(path, 'shapes', ['shp{},38.{},-81.{},{},'.format(n % 2, sequence, sequence, sequence)
+                                         for sequence in range(1, 30)])
+            write_table(path, 'trips', ['r1,wkdy,t{},Downtown,,0,,shp{},,'.format(trip, n % 2)
+                                        for trip in range(n * 20, n * 20 + 40)])
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def merge(self, workers):
+        configs = SimpleNamespace(gtfs_path_root=os.path.join(self.root, 'gtfs'),
+                                  report_path=os.path.join(self.root, 'reports{}'.format(workers)), verbose=False,
+                                  merge_workers=workers, agency_id='test', zip_level=6, zip_threads=1)
+        GtfsWrite().merge_files(self.wrkbk_dict, configs)
+        files = {}
+        for name in ('stop_times', 'shapes', 'trips'):
+            with open(os.path.join(configs.gtfs_path_root, '{}.txt'.format(name)), 'rb') as f:
+                files[name] = f.read()
+        with open(os.path.join(configs.report_path, 'merge_conflicts.txt'), 'rb') as f:
+            files['conflicts'] = f.read()
+        return files
+
+    def test_workers_match_serial(self):
+        serial = self.merge(1)
+        self.assertEqual(len(serial['stop_times'].splitlines()), 1 + 100 * 11)
+        self.assertIn(b'stop_times.txt key:t20,1 kept:W.A rejected:W.B', serial['conflicts'])
+        for workers in (2, 3):
+            self.assertEqual(self.merge(workers), serial)
+        self.assertEqual([name for name in os.listdir(os.path.join(self.root, 'gtfs')) if name.startswith('.merge_')],
+                         [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import context  # noqa: F401, puts src on sys.path
+
+from gtfsgenerator.GTFS import GtfsWrite
+
+stops_heading = ('stop_id,stop_code,stop_name,stop_desc,stop_lat,stop_lon,zone_id,stop_url,location_type,'
+                 'parent_station,stop_timezone,wheelchair_boarding\n')
+trips_heading = ('route_id,service_id,trip_id,trip_headsign,trip_short_name,direction_id,block_id,shape_id,'
+                 'wheelchair_accessible,bikes_allowed\n')
+
+
+class TestMergeIndex(unittest.TestCase):
+    '''
+    The incremental merge writes the same master tables and conflicts as a full merge, as worksheets withdraw and
+        re-add keys and workbooks add, remove and reorder worksheets. The first worksheet in workbook order keeps a
+        key; when it withdraws the key, the row of the next worksheet that has it is merged.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+        self.configs = SimpleNamespace(gtfs_path_root=os.path.join(self.root, 'gtfs'),
+                                       report_path=os.path.join(self.root, 'reports'), verbose=False,
+                                       merge_workers=1, agency_id='test', zip_level=6, zip_threads=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def worksheet(self, workbook, worksheet, stops, trips):
+        '''
+        Write a worksheet's stops and trips and record its manifest, as its build does.
+        '''
+        path = os.path.join(self.configs.gtfs_path_root, workbook, worksheet)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with open(os.path.join(path, 'stops.txt'), 'w') as f:
+            f.write(stops_heading + ''.join('{},,{},,38.1,-81.1,,,0,,,0\n'.format(*stop) for stop in stops))
+        with open(os.path.join(path, 'trips.txt'), 'w') as f:
+            f.write(trips_heading + ''.join('{},wkdy,{},Downtown,,0,,,,\n'.format(worksheet, trip) for trip in trips))
+        GtfsWrite().write_manifest(path)
+
+    def masters(self):
+        tables = {}
+        for gtfs_file in glob.glob(os.path.join(self.configs.gtfs_path_root, '*.txt')):
+            with open(gtfs_file) as f:
+                tables[os.path.basename(gtfs_file)] = f.read()
+        with open(os.path.join(self.configs.report_path, 'merge_conflicts.txt')) as f:
+            return tables, f.read()
+
+    def check(self, workbooks):
+        GtfsWrite().merge_files_incremental(workbooks, self.configs)
+        incremental = self.masters()
+        GtfsWrite().merge_files(workbooks, self.configs)
+        self.assertEqual(incremental, self.masters())
+        return incremental[0]
+
+    def test_incremental_merge_equals_full_merge(self):
+        self.worksheet('W', 'A', [(1, 'one'), (2, 'two'), (10, 'ten')], ['t1', 't2'])
+        self.worksheet('W', 'B', [(2, 'TWO'), (3, 'three')], ['t3'])
+        self.assertIn(',two,', self.check({'W': ['A', 'B']})['stops.txt'])
+
+        # A withdraws stop 2: B's row of it is merged.
+        self.worksheet('W', 'A', [(1, 'one'), (10, 'ten')], ['t1', 't2'])
+        self.assertIn(',TWO,', self.check({'W': ['A', 'B']})['stops.txt'])
+
+        # A adds it back and keeps it again.
+        self.worksheet('W', 'A', [(1, 'one'), (2, 'two'), (10, 'ten')], ['t1', 't2'])
+        self.assertIn(',two,', self.check({'W': ['A', 'B']})['stops.txt'])
+
+        # Reordered, B keeps it.
+        self.assertIn(',TWO,', self.check({'W': ['B', 'A']})['stops.txt'])
+
+        self.worksheet('W', 'C', [(4, 'four')], ['t9'])
+        self.assertIn('C,wkdy,t9', self.check({'W': ['B', 'A', 'C']})['trips.txt'])
+
+        masters = self.check({'W': ['A', 'C']})
+        self.assertNotIn('three', masters['stops.txt'])
+        self.assertNotIn('B,wkdy,t3', masters['trips.txt'])
+
+    def test_stop_ids_sort_naturally(self):
+        self.worksheet('W', 'A', [(10, 'ten'), (2, 'two'), (1, 'one')], ['t1'])
+        stops = self.check({'W': ['A']})['stops.txt']
+        self.assertEqual([line.split(',')[0] for line in stops.splitlines()[1:]], ['1', '2', '10'])
+
+
+if __name__ == '__main__':
+    unittest.main()
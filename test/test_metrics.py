@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import context  # noqa: F401, puts src on sys.path
+
+from gtfsgenerator.Metrics import RunMetrics
+from gtfsgenerator.Metrics import escape_label
+
+
+def record(span_id, parent, kind, name, ms=1000.0, rows=0, written=0, counts=None):
+    return {'id': span_id, 'parent': parent, 'kind': kind, 'name': name, 'ms': ms, 'rows': rows, 'bytes': written,
+            'counts': counts or {}}
+
+
+class TestRunMetrics(unittest.TestCase):
+    '''
+    RunMetrics sums the stage spans and counters of a trace by the workbook they are nested in, and writes them as
+        JSON and a Prometheus textfile whose label values are escaped.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+        self.metrics = RunMetrics('krt')
+        self.metrics.add_trace([
+            record('r', None, 'run', 'krt', ms=5000.0),
+            record('w', 'r', 'workbook', 'Route "A"\\B'),
+            record('s', 'w', 'worksheet', '101', counts={'rows.trips': 4, 'rows.shapes': 50, 'shape_cache.hits': 1}),
+            record('z', 's', 'stage', 'zip', ms=250.0, written=1000),
+            record('z2', 'w', 'stage', 'zip', ms=250.0, written=500),
+            record('m', 'r', 'stage', 'merge_zip', written=2000, counts={'shape_cache.misses': 3}),
+        ])
+        self.metrics.result = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_escape_label(self):
+        self.assertEqual(escape_label('a"b\\c\nd'), 'a\\"b\\\\c\\nd')
+
+    def test_summary(self):
+        summary = self.metrics.summary()
+        self.assertEqual(summary['duration_seconds'], 5.0)
+        self.assertEqual([(stage['workbook'], stage['stage'], stage['spans'], stage['seconds'])
+                          for stage in summary['stages']],
+                         [('', 'merge_zip', 1, 1.0), ('Route "A"\\B', 'zip', 2, 0.5)])
+        self.assertEqual(summary['shape_points'], 50)
+        self.assertEqual(summary['bytes_written'], 3500)
+        self.assertEqual(summary['caches']['shape_cache'], {'hits': 1, 'misses': 3, 'hit_rate': 0.25})
+
+    def test_prometheus(self):
+        lines = self.metrics.prometheus().splitlines()
+        self.assertIn('gtfsgenerator_table_rows{agency="krt",table="trips",workbook="Route \\"A\\"\\\\B"} 4', lines)
+        self.assertIn('gtfsgenerator_cache_hit_rate{agency="krt",cache="shape_cache"} 0.25', lines)
+        # No sample without a value: there is no zip size.
+        self.assertNotIn('# TYPE gtfsgenerator_feed_zip_bytes gauge', lines)
+
+    def test_write(self):
+        json_file = os.path.join(self.root, 'report', 'metrics.json')
+        history_file = os.path.join(self.root, 'report', 'metrics_history.jsonl')
+        for run in range(2):
+            self.metrics.write(json_file, os.path.join(self.root, 'prom', 'krt.prom'), history_file)
+        with open(json_file) as f:
+            self.assertEqual(json.load(f)['agency'], 'krt')
+        with open(history_file) as f:
+            self.assertEqual(len(f.readlines()), 2)
+        self.assertEqual(os.listdir(os.path.join(self.root, 'prom')), ['krt.prom'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import asyncio
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import context  # noqa: F401, puts src on sys.path
+
+from gtfsgenerator.Pipeline import Pipeline
+from gtfsgenerator.Pipeline import Stage
+
+
+class TestPipeline(unittest.TestCase):
+    '''
+    Items leave the pipeline in input order however the stages finish them, a bounded queue holds back the stage in
+        front of it, and a failing stage stops the run with its exception.
+    '''
+
+    def test_input_order(self):
+        def slow_first(item):
+            # Earlier items take longer, so later ones finish first.
+            time.sleep(0.02 * (5 - item['n']))
+            item['path'].append('build')
+            return item
+
+        async def check(item):
+            await asyncio.sleep(0)
+            item['path'].append('check')
+            return item
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            pipeline = Pipeline([Stage('build', slow_first, 4, executor), Stage('check', check, 2)])
+            items = pipeline.run([{'n': n, 'path': []} for n in range(6)])
+        self.assertEqual([item['n'] for item in items], list(range(6)))
+        self.assertTrue(all(item['path'] == ['build', 'check'] for item in items))
+        self.assertEqual([stage.items for stage in pipeline.stages], [6, 6])
+        self.assertEqual(len(pipeline.report()), 2)
+
+    def test_bounded_queue(self):
+        fetched = []
+        built = []
+
+        async def fetch(item):
+            fetched.append(item)
+            return item
+
+        async def build(item):
+            # The fetch stage can only run queue_size items ahead of the builds.
+            self.assertLessEqual(len(fetched) - len(built), 1 + 2 + 1)
+            await asyncio.sleep(0.01)
+            built.append(item)
+            return item
+
+        Pipeline([Stage('fetch', fetch), Stage('build', build, queue_size=2)]).run(range(10))
+        self.assertEqual(built, list(range(10)))
+
+    def test_failing_stage(self):
+        async def fail(item):
+            if item == 3:
+                raise ValueError('bad worksheet')
+            return item
+
+        async def slow(item):
+            await asyncio.sleep(0.01)
+            return item
+
+        with self.assertRaises(ValueError):
+            Pipeline([Stage('build', fail, 2), Stage('zip', slow)]).run(range(20))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import unittest
+
+import context  # noqa: F401, puts src on sys.path
+
+from gtfsgenerator.Trace import Tracer
+
+
+class TestTracer(unittest.TestCase):
+    '''
+    Spans nest in their thread, under() a span of another thread, and, in a copy of the tracer, under the span
+        current where it was copied. Every finished span is a line of trace_file, summed up by kind and name. With
+        --memory, stages record their traced peak and the allocation sites they left memory at.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+        self.tracer = Tracer(os.path.join(self.root, 'report', 'trace.jsonl'))
+
+    def tearDown(self):
+        self.tracer.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_spans_nest(self):
+        with self.tracer.span('krt', 'run') as run:
+            with self.tracer.span('WB', 'workbook') as workbook:
+                with self.tracer.span('stops') as stops:
+                    stops.add(rows=3, written=10)
+        records = dict((record['name'], record) for record in self.tracer.records())
+        self.assertEqual([records[name]['parent'] for name in ('krt', 'WB', 'stops')], [None, run.id, workbook.id])
+        self.assertEqual((records['stops']['rows'], records['stops']['bytes']), (3, 10))
+        self.assertEqual(self.tracer.summary().rowcount, 3)
+
+    def test_copies_and_threads_nest_under_current(self):
+        with self.tracer.span('WB.101', 'worksheet') as worksheet:
+            copy = pickle.loads(pickle.dumps(self.tracer))
+
+            def stage():
+                with copy.span('zip'):
+                    pass
+            thread = threading.Thread(target=stage)
+            thread.start()
+            thread.join()
+        copy.close()
+        records = dict((record['name'], record) for record in self.tracer.records())
+        self.assertEqual(records['zip']['parent'], worksheet.id)
+
+    def test_error_is_recorded(self):
+        with self.assertRaises(ValueError):
+            with self.tracer.span('check'):
+                raise ValueError('bad row')
+        self.assertEqual(self.tracer.records()[0]['attributes'], {'error': 'ValueError'})
+
+    def test_stage_memory(self):
+        self.tracer.close()
+        self.tracer = Tracer(os.path.join(self.root, 'report', 'trace.jsonl'),
+                             memory_file=os.path.join(self.root, 'report', 'memory.txt'))
+        with self.tracer.span('stops'):
+            kept = [bytearray(1024) for block in range(1000)]
+        with self.tracer.span('routes'):
+            pass
+        memory = dict((record['name'], record['memory']) for record in self.tracer.records())
+        self.assertGreater(memory['stops']['peak'], 1000 * 1024)
+        self.assertGreater(memory['stops']['growth'], 1000 * 1024)
+        self.assertLess(memory['routes']['growth'], 100 * 1024)
+        with open(self.tracer.write_memory()) as f:
+            report = f.read()
+        self.assertIn(__file__, report.split('stops peak traced')[1])
+        self.assertEqual(len(kept), 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import os
+import shutil
+import sys
+import tempfile
+import json
+import unittest
+import zipfile
+from unittest import mock
+
+import context  # noqa: F401, puts src on sys.path
+
+from gtfsgenerator import Validation
+
+# Stands in for feedvalidator.py: takes a while, writes its report to the working directory and prints it.
+fake_validator = [sys.executable, '-c', 'import os, sys, time; start = time.time(); time.sleep(1); '
+                  'open("validator.html", "w").write("{} {} {}".format(sys.argv[-1], start, time.time())); '
+                  'print(os.getcwd())',
+                  '-n', '-o', 'validator.html']
+
+
+class TestValidationScheduler(unittest.TestCase):
+    '''
+    Validator runs get their own working directory and log, run side by side up to the number of workers and are
+        reported in submission order; a validator that cannot be started is reported, not raised.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+        self.dirs = []
+        for worksheet in ('A', 'B', 'C'):
+            self.dirs.append(os.path.join(self.root, worksheet))
+            os.makedirs(self.dirs[-1])
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_concurrent_runs(self):
+        cwd = os.getcwd()
+        with mock.patch.object(Validation, 'validator_command', fake_validator):
+            validators = Validation.ValidationScheduler(3)
+            for path in self.dirs:
+                validators.submit(os.path.join(path, 'feed.zip'), path, os.path.basename(path))
+            results = validators.wait()
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertEqual([label for label, returncode, seconds, output in results], ['A', 'B', 'C'])
+        runs = []
+        for path, (label, returncode, seconds, output) in zip(self.dirs, results):
+            self.assertEqual(returncode, 0)
+            with open(os.path.join(path, 'validator.log')) as f:
+                self.assertEqual(os.path.realpath(f.read().strip()), os.path.realpath(path))
+            with open(os.path.join(path, 'validator.html')) as f:
+                gtfs_zip, start, end = f.read().split()
+            self.assertEqual(gtfs_zip, os.path.join(path, 'feed.zip'))
+            runs.append((float(start), float(end)))
+        # Every run started before any of them finished.
+        self.assertLess(max(start for start, end in runs), min(end for start, end in runs))
+
+    def test_missing_validator(self):
+        with mock.patch.object(Validation, 'validator_command', ['no-such-feedvalidator.py']):
+            label, returncode, seconds, output = Validation.validate_feed('feed.zip', self.dirs[0], 'A')
+        self.assertIsNone(returncode)
+        self.assertIn('could not be started', output)
+
+
+class TestValidationCache(unittest.TestCase):
+    '''
+    A zip whose tables were validated before, feed_version aside, gets the stored report instead of a validator
+        run.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write_zip(self, name, feed_version, stop_name='One'):
+        path = os.path.join(self.root, name)
+        os.makedirs(path)
+        with zipfile.ZipFile(os.path.join(path, 'feed.zip'), 'w') as z:
+            z.writestr('feed_info.txt', 'feed_publisher_name,feed_lang,feed_version\nTest,en,{}\n'.format(feed_version))
+            z.writestr('stops.txt', 'stop_id,stop_name\nS1,{}\n'.format(stop_name))
+        return os.path.join(path, 'feed.zip'), path
+
+    def test_hits_ignore_feed_version(self):
+        with mock.patch.object(Validation, 'validator_command', fake_validator):
+            cache = Validation.ValidationCache(os.path.join(self.root, 'validation_cache'))
+            first = Validation.validate_feed(*self.write_zip('A', '1'), label='A', cache=cache)
+            second = Validation.validate_feed(*self.write_zip('B', '2'), label='B', cache=cache)
+            changed = Validation.validate_feed(*self.write_zip('C', '3', 'Uno'), label='C', cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertEqual(second[1:4:2], first[1:4:2])
+        self.assertNotEqual(changed[3], first[3])
+        # The hit got A's report and log, without a run in B.
+        with open(os.path.join(self.root, 'A', 'validator.html')) as f:
+            report = f.read()
+        with open(os.path.join(self.root, 'B', 'validator.html')) as f:
+            self.assertEqual(f.read(), report)
+        with open(os.path.join(self.root, 'B', 'validator.log')) as f:
+            self.assertEqual(f.read(), first[3])
+
+    def test_without_feed_version(self):
+        self.assertEqual(Validation.without_feed_version(b'feed_lang,feed_version\nen,20260101\n'),
+                         b'feed_lang,feed_version\nen,\n')
+        self.assertEqual(Validation.without_feed_version(b'feed_lang\nen\n'), b'feed_lang\nen\n')
+
+
+# The parts of a feedvalidator.py validator.html the parser reads.
+validator_html = '''<html><body><h2>Summary</h2><p>Found 2 errors and 1 warning</p>
+<h3>Errors:</h3><ul><li>Invalid value 6:01 in field arrival_time in stop_times.txt line 12</li>
+<li>Missing column route_type in routes.txt</li></ul>
+<h3>Warnings:</h3><ul><li>Stop S1 is too far from its parent in stops.txt line 3</li></ul></body></html>'''
+
+
+class TestValidationReport(unittest.TestCase):
+    '''
+    validator.html is read into structured problems, and aggregate_reports totals the results of the current
+        build's worksheets, deleting those a withdrawn worksheet left behind.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+        self.gtfs = os.path.join(self.root, 'gtfs')
+        for worksheet in ('A', 'B', 'Withdrawn'):
+            path = os.path.join(self.gtfs, 'W', worksheet)
+            os.makedirs(path)
+            with open(os.path.join(path, 'validator.html'), 'w') as f:
+                f.write(validator_html)
+            Validation.write_results(path, 'validation.json', dict(Validation.parse_validator_html(
+                os.path.join(path, 'validator.html')), label='W.' + worksheet, validator='feedvalidator'))
+            Validation.write_check_results(path, 'W.' + worksheet, [('trips', 'Trip t1 has no stop times.')])
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_parse_validator_html(self):
+        results = Validation.parse_validator_html(os.path.join(self.gtfs, 'W', 'A', 'validator.html'))
+        self.assertEqual((results['errors'], results['warnings']), (2, 1))
+        self.assertEqual(results['problems'][0], {'severity': 'error', 'file': 'stop_times.txt', 'line': 12,
+                                                  'message': 'Invalid value 6:01 in field arrival_time in '
+                                                             'stop_times.txt line 12'})
+        self.assertEqual([(item['severity'], item['file'], item['line']) for item in results['problems'][1:]],
+                         [('error', 'routes.txt', None), ('warning', 'stops.txt', 3)])
+
+    def test_withdrawn_worksheet_is_not_reported(self):
+        report_path = os.path.join(self.root, 'reports')
+        totals = Validation.aggregate_reports(self.gtfs, report_path, ['W/A', 'W/B'])
+        self.assertEqual(totals, {'error': 6, 'warning': 2})
+        with open(os.path.join(report_path, 'validation_report.json')) as f:
+            self.assertEqual(sorted(json.load(f)['routes']), ['W/A', 'W/B'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.gtfs, 'W', 'Withdrawn'))), ['validator.html'])
+        # An offline report afterwards sees the same worksheets.
+        self.assertEqual(Validation.aggregate_reports(self.gtfs, report_path), totals)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import sheets
+
+from gtfsgenerator import __main__ as generator
+from gtfsgenerator.SheetSource import LocalSheetClient
+from gtfsgenerator.Watch import Watcher
+
+
+class TestWatcher(unittest.TestCase):
+    '''
+    Watcher.wait returns once the inputs changed and stayed the same for a poll, with the inputs that changed since
+        the last build.
+    '''
+
+    def test_burst_is_one_change(self):
+        states = [{'a': 1, 'b': 1}, {'a': 1, 'b': 1}, {'a': 2, 'b': 1}, {'a': 3, 'b': 1}, {'a': 3, 'b': 2},
+                  {'a': 3, 'b': 2}]
+        watcher = Watcher(lambda: states.pop(0), interval=0, debounce=0)
+        watcher.start()
+        self.assertEqual(watcher.wait(), ['a', 'b'])
+        self.assertEqual(watcher.state, {'a': 3, 'b': 2})
+        self.assertEqual(states, [])
+
+
+class TestLocalSheets(unittest.TestCase):
+    '''
+    With source_type = local, workbooks are directories of worksheet CSV files, and --watch follows the worksheets
+        the build does, by the same ignore list.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+        self.configs = sheets.agency_configs(self.root, source_type='local',
+                                             sheet_source_root=os.path.join(self.root, 'sheets'),
+                                             google_workbook_names='WB')
+        os.makedirs(self.configs.kml_files_root)
+        workbook = os.path.join(self.configs.sheet_source_root, 'WB')
+        os.makedirs(workbook)
+        for title in ('Master', 'Ma', '101'):
+            with open(os.path.join(workbook, '{}.csv'.format(title)), 'w', newline='') as f:
+                csv.writer(f).writerows(sheets.route_rows('101', 'shape101', 4, 2))
+        sheets.write_kml(os.path.join(self.configs.kml_files_root, 'shape101.kml'), 'shape101', 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_local_worksheets(self):
+        worksheet = LocalSheetClient(self.configs.sheet_source_root).open('WB').worksheet('101')
+        self.assertEqual(worksheet.range('AB6:AC6')[1].value, '515')
+        self.assertEqual(worksheet.row_values(7)[3], 'S1')
+        self.assertEqual(worksheet.get_addr_int(7, 28), 'AB7')
+
+    def test_watch_state_follows_build(self):
+        with mock.patch.object(generator, 'print'):
+            state = generator.get_watch_state(self.configs)
+            self.assertEqual(sorted(generator.google_worksheets_by_workbook_to_dict(self.configs)['WB']),
+                             ['101', 'Ma'])
+        self.assertEqual(sorted(key for key in state if key.startswith('WB.')), ['WB.101', 'WB.Ma'])
+        self.assertIn(os.path.join(self.configs.kml_files_root, 'shape101.kml'), state)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+__author__ = 'dr.pete.dailey'
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import context  # noqa: F401, puts src on sys.path
+
+from gtfsgenerator.WorkQueue import JobError
+from gtfsgenerator.WorkQueue import WorkQueue
+
+
+class TestWorkQueue(unittest.TestCase):
+    '''
+    A queued job is leased to one worker at a time; a job whose worker stopped renewing its lease is claimed again,
+        and fails once it was claimed max_attempts times.
+    '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='gtfsgenerator_test_')
+        self.queue = WorkQueue(os.path.join(self.root, 'queue', 'work_queue.sqlite'), lease=10, max_attempts=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_jobs_complete_in_order(self):
+        futures = [self.queue.submit('WB.{}'.format(n), 'square', n) for n in range(3)]
+        worker = WorkQueue(self.queue.db_file, lease=10)
+        self.assertEqual(worker.claim('a')[1:], ('WB.0', 'square', (0,)))
+        self.assertEqual(worker.claim('b')[1:], ('WB.1', 'square', (1,)))
+        worker.complete(2, 'b', 1)
+        job_id, name, function, args = worker.claim('b')
+        worker.fail(job_id, 'b', 'Traceback')
+        self.assertIsNone(worker.claim('b'))
+        worker.complete(1, 'a', 0)
+        self.queue.wait(poll=0)
+        self.assertEqual([future.result() for future in futures[:2]], [0, 1])
+        with self.assertRaises(JobError):
+            futures[2].result()
+        self.assertEqual(self.queue.counts(), {'done': 2, 'failed': 1})
+        self.queue.close()
+        self.assertEqual(self.queue.counts(), {})
+
+    def test_expired_lease_is_claimed_again(self):
+        future = self.queue.submit('WB.101', 'build', 1)
+        now = 1000.0
+        with mock.patch('time.time', side_effect=lambda: now):
+            job_id = self.queue.claim('a')[0]
+            self.assertIsNone(self.queue.claim('b'))
+            now += 11
+            self.assertEqual(self.queue.claim('b')[0], job_id)
+            # The first worker's late result is ignored.
+            self.queue.complete(job_id, 'a', 'late')
+            self.assertFalse(self.queue.renew(job_id, 'a'))
+            now += 11
+            self.assertIsNone(self.queue.claim('c'))
+            self.queue.wait(poll=0)
+        with self.assertRaises(JobError):
+            future.result()
+
+
+if __name__ == '__main__':
+    unittest.main()